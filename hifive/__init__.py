@@ -11,6 +11,7 @@ import hic_binning
 import plotting
 import hic_domains
 import quasar
+import mrh
 import schic
 
 from hic import HiC
@@ -22,6 +23,7 @@ from fivec_data import FiveCData
 from hic_domains import TAD
 from hic_domains import Compartment
 from quasar import Quasar
+from mrh import MRH
 from schic import scHiC
 
 from .version import version as __version__
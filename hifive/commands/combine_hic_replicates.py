@@ -8,147 +8,115 @@ import h5py
 
 
 def run(args):
-    in_fname1 = args.replicate1
-    in_fname2 = args.replicate2
+    in_fnames = args.replicates
     out_fname = args.output
     silent = args.silent
+    blocksize = args.blocksize
+    if len(in_fnames) < 2:
+        if not silent:
+            print >> sys.stderr, ("At least two replicates are needed to combine, but only %s was given.\n") %\
+                                 (', '.join(in_fnames)),
+        return None
     history = ""
-    infile1 = h5py.File(in_fname1, 'r')
-    history += infile1['/'].attrs['history']
-    infile2 = h5py.File(in_fname2, 'r')
-    history += infile2['/'].attrs['history']
-    fendfilename = infile1['/'].attrs['fendfilename']
+    infiles = []
+    for fname in in_fnames:
+        infiles.append(h5py.File(fname, 'r'))
+        history += infiles[-1]['/'].attrs['history']
+    fendfilename = infiles[0]['/'].attrs['fendfilename']
     if fendfilename[:2] == './':
         fendfilename = fendfilename[2:]
     parent_count = fendfilename.count('../')
-    fendfilename = '/'.join(os.path.abspath(in_fname1).split('/')[:-(1 + parent_count)] +
+    fendfilename = '/'.join(os.path.abspath(in_fnames[0]).split('/')[:-(1 + parent_count)] +
                             fendfilename.lstrip('/').split('/')[parent_count:])
-    maxinsert = infile1['/'].attrs['maxinsert']
-    output = h5py.File(out_fname, 'w')
-    output.attrs['maxinsert'] = maxinsert
-    output.attrs['fendfilename'] = "%s/%s" % (os.path.relpath(os.path.dirname(fendfilename),
-                                              os.path.dirname(out_fname)), os.path.basename(fendfilename))
     fends = h5py.File(fendfilename, 'r')
     num_fends = fends['fends'].shape[0]
     fends.close()
-    data1 = infile1['cis_data'][...]
-    data2 = infile2['cis_data'][...]
-    indices1 = infile1['cis_indices'][...]
-    indices2 = infile2['cis_indices'][...]
-    cindices = numpy.zeros(indices1.shape[0], dtype=numpy.int64)
-    fend2 = numpy.zeros(data1.shape[0] + data2.shape[0], dtype=numpy.int32)
-    pos = 0
-    for i in range(num_fends):
-        if not silent:
-            print >> sys.stderr, ("\rCis phase 1, %08i of %08i") % (i, num_fends),
-        f1 = indices1[i + 1] - indices1[i]
-        f2 = indices2[i + 1] - indices2[i]
-        if f1 > 0 and f2 > 0:
-            temp = numpy.unique(numpy.hstack((data1[indices1[i]:indices1[i + 1], 1],
-                                              data2[indices2[i]:indices2[i + 1], 1])))
-            fend2[pos:(pos + temp.shape[0])] = temp
-            pos += temp.shape[0]
-        elif f1 > 0:
-            fend2[pos:(pos + f1)] = data1[indices1[i]:indices1[i + 1], 1]
-            pos += f1
-        elif f2 > 0:
-            fend2[pos:(pos + f2)] = data2[indices2[i]:indices2[i + 1], 1]
-            pos += f2
-        cindices[i + 1] = pos
-    cis_data = numpy.zeros((cindices[-1], 3), dtype=numpy.int32)
-    cis_data[:, 1] = fend2[:cindices[-1]]
-    del fend2
-    for i in range(num_fends):
-        if not silent:
-            print >> sys.stderr, ("\rCis phase 2, %08i of %08i") % (i, num_fends),
-        cis_data[cindices[i]:cindices[i + 1], 0] = i
-        f1 = indices1[i + 1] - indices1[i]
-        f2 = indices2[i + 1] - indices2[i]
-        if f1 > 0:
-            pos = numpy.searchsorted(cis_data[cindices[i]:cindices[i + 1], 1], data1[indices1[i]:indices1[i + 1], 1])
-            if pos.shape[0] > 0: 
-                cis_data[pos + cindices[i], 2] += data1[indices1[i]:indices1[i + 1], 2]
-        if f2 > 0:
-            pos = numpy.searchsorted(cis_data[cindices[i]:cindices[i + 1], 1], data2[indices2[i]:indices2[i + 1], 1])
-            if pos.shape[0] > 0: 
-                cis_data[pos + cindices[i], 2] += data2[indices2[i]:indices2[i + 1], 2]
-    del data1
-    del data2
-    del indices1
-    del indices2
-    output.create_dataset(name='cis_data', data=cis_data)
-    output.create_dataset(name='cis_indices', data=cindices)
-    count = 0
-    valid = 0
-    for i in range(cindices.shape[0] - 1):
-        if cindices[i + 1] > cindices[i]:
-            count += 1
-            if cis_data[cindices[i], 0] == cis_data[cindices[i + 1] - 1, 0]:
-                valid += 1
-    if not silent:
-        print >> sys.stderr, ("\r%s\r%i out of %i cis fends validated\n") % (" " * 80, valid, count),
-    del cis_data
-    del cindices
-    data1 = infile1['trans_data'][...]
-    data2 = infile2['trans_data'][...]
-    indices1 = infile1['trans_indices'][...]
-    indices2 = infile2['trans_indices'][...]
-    tindices = numpy.zeros(indices1.shape[0], dtype=numpy.int64)
-    fend2 = numpy.zeros(data1.shape[0] + data2.shape[0], dtype=numpy.int32)
-    pos = 0
-    for i in range(num_fends):
-        if not silent:
-            print >> sys.stderr, ("\rTrans phase 1, %08i of %08i") % (i, num_fends),
-        f1 = indices1[i + 1] - indices1[i]
-        f2 = indices2[i + 1] - indices2[i]
-        if f1 > 0 and f2 > 0:
-            temp = numpy.unique(numpy.hstack((data1[indices1[i]:indices1[i + 1], 1],
-                                              data2[indices2[i]:indices2[i + 1], 1])))
-            fend2[pos:(pos + temp.shape[0])] = temp
-            pos += temp.shape[0]
-        elif f1 > 0:
-            fend2[pos:(pos + f1)] = data1[indices1[i]:indices1[i + 1], 1]
-            pos += f1
-        elif f2 > 0:
-            fend2[pos:(pos + f2)] = data2[indices2[i]:indices2[i + 1], 1]
-            pos += f2
-        tindices[i + 1] = pos
-    trans_data = numpy.zeros((tindices[-1], 3), dtype=numpy.int32)
-    trans_data[:, 1] = fend2[:tindices[-1]]
-    del fend2
-    for i in range(num_fends):
-        if not silent:
-            print >> sys.stderr, ("\rTrans phase 2, %08i of %08i") % (i, num_fends),
-        trans_data[tindices[i]:tindices[i + 1], 0] = i
-        f1 = indices1[i + 1] - indices1[i]
-        f2 = indices2[i + 1] - indices2[i]
-        if f1 > 0:
-            pos = numpy.searchsorted(trans_data[tindices[i]:tindices[i + 1], 1], data1[indices1[i]:indices1[i + 1], 1])
-            if pos.shape[0] > 0: 
-                trans_data[pos + tindices[i], 2] += data1[indices1[i]:indices1[i + 1], 2]
-        if f2 > 0:
-            pos = numpy.searchsorted(trans_data[tindices[i]:tindices[i + 1], 1], data2[indices2[i]:indices2[i + 1], 1])
-            if pos.shape[0] > 0: 
-                trans_data[pos + tindices[i], 2] += data2[indices2[i]:indices2[i + 1], 2]
-    del data1
-    del data2
-    del indices1
-    del indices2
-    output.create_dataset(name='trans_data', data=trans_data)
-    output.create_dataset(name='trans_indices', data=tindices)
+    for i in range(len(infiles)):
+        if infiles[i]['cis_indices'].shape[0] != num_fends + 1:
+            if not silent:
+                print >> sys.stderr, ("%s was not created with the same fend file as %s.\n") %\
+                                     (in_fnames[i], in_fnames[0]),
+            return None
+    output = h5py.File(out_fname, 'w')
+    if 'maxinsert' in infiles[0]['/'].attrs:
+        output.attrs['maxinsert'] = infiles[0]['/'].attrs['maxinsert']
+    output.attrs['fendfilename'] = "%s/%s" % (os.path.relpath(os.path.dirname(fendfilename),
+                                              os.path.dirname(out_fname)), os.path.basename(fendfilename))
+    for name in ['cis', 'trans']:
+        _combine_interactions(infiles, output, name, num_fends, blocksize, silent)
     output.attrs['history'] = history
-    count = 0
-    valid = 0
-    for i in range(tindices.shape[0] - 1):
-        if tindices[i + 1] > tindices[i]:
-            count += 1
-            if trans_data[tindices[i], 0] == trans_data[tindices[i + 1] - 1, 0]:
-                valid += 1
-    if not silent:
-        print >> sys.stderr, ("\r%s\r%i out of %i trans fends validate\n") % (" " * 80, valid, count),
-    del trans_data
-    del tindices
     output.close()
+    for infile in infiles:
+        infile.close()
     if not silent:
         print >> sys.stderr, ("\r%s\rCombining HiC replicates... Done\n") % (" " * 80),
     return None
+
+
+def _combine_interactions(infiles, output, name, num_fends, blocksize, silent):
+    """Merge one interaction type from all replicates, a block of first fends at a time."""
+    all_indices = []
+    total_indices = numpy.zeros(num_fends + 1, dtype=numpy.int64)
+    for infile in infiles:
+        all_indices.append(infile['%s_indices' % name][...].astype(numpy.int64))
+        total_indices += all_indices[-1]
+    # break the fend range so no block holds more than 'blocksize' interactions across all replicates
+    # (a single fend's interactions are never split)
+    block_starts = [0]
+    while block_starts[-1] < num_fends:
+        start = block_starts[-1]
+        stop = numpy.searchsorted(total_indices, total_indices[start] + blocksize, side='right') - 1
+        block_starts.append(min(num_fends, max(start + 1, stop)))
+    indices = numpy.zeros(num_fends + 1, dtype=numpy.int64)
+    dataset = output.create_dataset('%s_data' % name, shape=(0, 3), maxshape=(None, 3), dtype=numpy.int32,
+                                    chunks=(16384, 1))
+    pos = 0
+    for i in range(len(block_starts) - 1):
+        start = block_starts[i]
+        stop = block_starts[i + 1]
+        if not silent:
+            print >> sys.stderr, ("\r%s\rCombining %s data... fends %i to %i of %i") %\
+                                 (" " * 80, name, start, stop, num_fends),
+        if total_indices[stop] == total_indices[start]:
+            continue
+        keys = numpy.zeros(total_indices[stop] - total_indices[start], dtype=numpy.int64)
+        counts = numpy.zeros(keys.shape[0], dtype=numpy.int64)
+        offset = 0
+        for j in range(len(infiles)):
+            start_index = all_indices[j][start]
+            stop_index = all_indices[j][stop]
+            if stop_index == start_index:
+                continue
+            data = infiles[j]['%s_data' % name][start_index:stop_index, :]
+            n = data.shape[0]
+            keys[offset:(offset + n)] = data[:, 0].astype(numpy.int64) * num_fends + data[:, 1]
+            counts[offset:(offset + n)] = data[:, 2]
+            offset += n
+            del data
+        order = numpy.argsort(keys)
+        keys = keys[order]
+        counts = counts[order]
+        del order
+        # sum counts across runs of identical fend pairs
+        run_starts = numpy.r_[0, numpy.where(keys[1:] != keys[:-1])[0] + 1]
+        counts = numpy.add.reduceat(counts, run_starts)
+        keys = keys[run_starts]
+        del run_starts
+        block = numpy.zeros((keys.shape[0], 3), dtype=numpy.int32)
+        block[:, 0] = keys / num_fends
+        block[:, 1] = keys % num_fends
+        block[:, 2] = counts
+        del keys, counts
+        indices[(start + 1):(stop + 1)] = numpy.cumsum(numpy.bincount(block[:, 0] - start,
+                                                                      minlength=(stop - start)))
+        indices[(start + 1):(stop + 1)] += pos
+        dataset.resize((pos + block.shape[0], 3))
+        dataset[pos:, :] = block
+        pos += block.shape[0]
+        del block
+    # carry the running total past any trailing empty blocks
+    indices[1:] = numpy.maximum.accumulate(indices[1:])
+    output.create_dataset('%s_indices' % name, data=indices)
+    if not silent:
+        print >> sys.stderr, ("\r%s\r%i %s interactions combined\n") % (" " * 80, pos, name),
+    return None
@@ -92,7 +92,7 @@ def run(args):
             comm.send(1, dest=i, tag=11)
     else:
         comm.recv(source=0, tag=11)
-    hic = HiC(project_fname, 'w', silent=args.silent)
+    hic = HiC(project_fname, 'w', silent=args.silent, processes=args.processes)
     hic.load_data(data_fname)
     hic.filter_fends(mininteractions=args.minint, mindistance=args.mindist, maxdistance=args.maxdist)
     hic.find_distance_parameters(minsize=args.minbin, numbins=args.numbins)
@@ -107,12 +107,13 @@ def run(args):
         hic.find_probability_fend_corrections(mindistance=args.mindist, maxdistance=args.maxdist,
                                               minchange=args.change, max_iterations=args.probiter,
                                               learningstep=args.step, chroms=chroms,
-                                              precalculate=args.precalc, precorrect=precorrect)
+                                              precalculate=args.precalc, precorrect=precorrect,
+                                              threads=args.threads)
     elif args.algorithm in ['express', 'binning-express']:
         hic.find_express_fend_corrections(iterations=args.expiter, mindistance=args.mindist,
                                           maxdistance=args.maxdist, remove_distance=args.nodist,
                                           usereads=args.expreads, mininteractions=args.minint,
                                           chroms=chroms, minchange=args.change, precorrect=precorrect,
-                                          binary=args.binary, kr=args.kr)
+                                          binary=args.binary, kr=args.kr, threads=args.threads)
     if rank == 0:
         hic.save()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+
+import sys
+
+from ..hic import HiC
+
+
+def run(args):
+    if args.chroms is None:
+        chroms = None
+    else:
+        chroms = args.chroms.split(',')
+        if len(chroms) == 1 and chroms[0] == '':
+            chroms = None
+    hic = HiC(args.project, 'r', silent=args.silent, lazy=True)
+    hic.export_cooler(args.output, binsize=args.binsize, chroms=chroms, zoomify=(not args.single),
+                      blocksize=args.blocksize)
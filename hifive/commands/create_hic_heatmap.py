@@ -36,17 +36,18 @@ def run(args):
         chroms = args.chroms.split(',')
         if len(chroms) == 1 and chroms[0] == '':
             chroms = []
-    hic = HiC(args.project, 'r', silent=args.silent)
+    hic = HiC(args.project, 'r', silent=args.silent, lazy=True)
     hic.write_heatmap(args.output, binsize=args.binsize, includetrans=args.trans,
                       datatype=args.datatype, chroms=chroms, dynamically_binned=args.dynamic,
                       expansion_binsize=args.expbinsize, minobservations=args.minobs,
-                      searchdistance=args.search, removefailed=args.remove, format=args.format)
+                      searchdistance=args.search, removefailed=args.remove, format=args.format,
+                      blocksize=args.blocksize)
     if rank > 0:
         sys.exit(0)
     if not args.image is None:
-        if args.format == 'txt':
+        if args.format in ['txt', 'sparse']:
             if rank == 0:
-                print >> sys.stderr, ("Plotting is only available for non-txt formats.\n"),
+                print >> sys.stderr, ("Plotting is only available for hdf5 and npz formats.\n"),
             return None
         kwargs = {}
         for arg in args.keywords:
@@ -15,7 +15,7 @@ def run(args):
         chroms = args.chroms.split(',')
         if len(chroms) == 1 and chroms[0] == '':
             chroms = None
-    hic = HiC(args.project, 'r', silent=args.silent)
+    hic = HiC(args.project, 'r', silent=args.silent, lazy=True, processes=args.processes)
     hic.write_multiresolution_heatmap(args.output, datatype=args.datatype, maxbinsize=args.maxbin,
                                       minbinsize=args.minbin, trans_maxbinsize=args.maxtransbin,
                                       trans_minbinsize=args.mintransbin, minobservations=args.minobs,
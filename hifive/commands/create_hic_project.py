@@ -20,7 +20,7 @@ def run(args):
         rank = 0
         num_procs = 1
     if rank == 0:
-        hic = HiC(args.output, 'w', silent=args.silent)
+        hic = HiC(args.output, 'w', silent=args.silent, processes=args.processes)
         hic.load_data(args.data)
         hic.filter_fends(mininteractions=args.minint, mindistance=args.mindist, maxdistance=args.maxdist)
         hic.save()
@@ -111,7 +111,7 @@ def run(args):
                 print >> sys.stderr, ("HiC file appears incomplete. Rerun with HiC project argument.\n"),
             return None
         q1.find_transformation(hic1, chroms=args.chroms, resolutions=args.resolutions,
-                         coverages=args.coverages, seed=args.seed)
+                         coverages=args.coverages, seed=args.seed, processes=args.processes)
     qscores = q1.find_quality_scores(chroms=args.chroms)
     rscores = None
     q1.save()
@@ -124,7 +124,7 @@ def run(args):
                     print >> sys.stderr, ("Second HiC file appears incomplete. Rerun with HiC project argument.\n"),
                 return None
             q2.find_transformation(hic2, chroms=args.chroms, resolutions=args.resolutions,
-                             coverages=args.coverages, seed=args.seed)
+                             coverages=args.coverages, seed=args.seed, processes=args.processes)
         q2.save()
         rscores = q1.find_replicate_scores(q2, chroms=args.chroms)
         q2.close()
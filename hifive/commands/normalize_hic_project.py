@@ -40,7 +40,7 @@ def run(args):
             if rank == 0:
                 print sys.stderr, ("-v/--model, -n/--modelbins, and -u/--parameter-types must be equal lengths.")
             return 1
-    hic = HiC(args.project, 'r', silent=args.silent)
+    hic = HiC(args.project, 'r', silent=args.silent, processes=args.processes)
     precorrect = False
     if args.algorithm in ['binning', 'binning-express', 'binning-probability']:
         hic.find_binning_fend_corrections(mindistance=args.mindist, maxdistance=args.maxdist,
@@ -53,12 +53,12 @@ def run(args):
                                               minchange=args.change, max_iterations=args.probiter,
                                               learningstep=args.step, chroms=chroms,
                                               precalculate=args.precalc, precorrect=precorrect,
-                                              model=args.probmodel)
+                                              model=args.probmodel, threads=args.threads)
     elif args.algorithm in ['express', 'binning-express']:
         hic.find_express_fend_corrections(iterations=args.expiter, mindistance=args.mindist,
                                           maxdistance=args.maxdist, remove_distance=args.nodist,
                                           usereads=args.expreads, mininteractions=args.minint,
                                           chroms=chroms, minchange=args.change, precorrect=precorrect,
-                                          binary=args.binary, kr=args.kr)
+                                          binary=args.binary, kr=args.kr, threads=args.threads)
     if rank == 0:
         hic.save(args.output)
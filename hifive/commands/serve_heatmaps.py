@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import json
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+import numpy
+
+from ..hic import HiC, _ArrayCache
+from ..mrh import MRH
+from ..hic_binning import find_cis_subregion_signal, find_trans_signal
+from ..plotting import plot_full_array
+
+
+def run(args):
+    try:
+        server = create_server(args.heatmaps, host=args.host, port=args.port, cachesize=args.cachesize,
+                               binsize=args.binsize, datatype=args.datatype, silent=args.silent)
+    except (IOError, TypeError, ValueError), error:
+        print >> sys.stderr, ("%s\n") % str(error),
+        return None
+    if not args.silent:
+        print >> sys.stderr, ("Serving %s on http://%s:%i/\n") % (', '.join(sorted(server.sources.keys())),
+                                                                 server.server_address[0], server.server_address[1]),
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return None
+
+
+def create_server(filenames, host='127.0.0.1', port=8000, cachesize=100000000, binsize=10000, datatype='fend',
+                  silent=False):
+    """Load each MRH file or HiC project once and return a threaded HTTP server for them (not yet serving)."""
+    sources = {}
+    for fname in filenames:
+        name = os.path.basename(fname)
+        if name in sources:
+            raise ValueError("More than one heatmap source is named %s" % name)
+        infile = open(fname, 'rb')
+        magic = infile.read(4)
+        infile.close()
+        if magic == '\x42\x05\x42\x05':
+            sources[name] = MRH(fname)
+        else:
+            sources[name] = HiC(fname, 'r', silent=True, lazy=True)
+    server = _HeatmapServer((host, port), _HeatmapRequestHandler)
+    server.sources = sources
+    server.cache = _ArrayCache(cachesize)
+    server.cache_lock = threading.Lock()
+    # HiC objects keep their own unsynchronized caches, so each project handles one query at a time
+    server.source_locks = {}
+    for name in sources:
+        server.source_locks[name] = threading.Lock()
+    server.binsize = binsize
+    server.datatype = datatype
+    server.silent = silent
+    return server
+
+
+class _HeatmapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """An HTTP server answering each request in its own thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _HeatmapRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Answer heatmap requests of the form /<source>?chrom1=...&format=json|npy|png from a shared tile cache."""
+
+    int_params = ['start1', 'stop1', 'start2', 'stop2', 'binsize', 'minresolution']
+    float_params = ['minscore', 'maxscore']
+    str_params = ['chrom1', 'chrom2', 'datatype', 'format']
+    content_types = {'json': 'application/json', 'npy': 'application/octet-stream', 'png': 'image/png'}
+
+    def do_GET(self):
+        start_time = time.time()
+        status_note = '-'
+        try:
+            url = urlparse.urlparse(self.path)
+            name = urlparse.unquote(url.path.strip('/'))
+            if name == '':
+                body = self._describe_sources()
+                content_type = 'application/json'
+            elif name not in self.server.sources:
+                raise KeyError("No heatmap source named %s" % name)
+            else:
+                params = self._parse_query(url.query)
+                content_type = self.content_types[params['format']]
+                key = (name,) + tuple(sorted(params.items()))
+                cache = self.server.cache
+                with self.server.cache_lock:
+                    cached = key in cache.entries
+                    if cached:
+                        body = cache.get(key, None)
+                if not cached:
+                    rendered = numpy.frombuffer(self._render(name, params), dtype=numpy.uint8)
+                    with self.server.cache_lock:
+                        body = cache.get(key, lambda: rendered)
+                status_note = ['miss', 'hit'][cached]
+                body = body.tostring()
+            status = 200
+        except KeyError, error:
+            status, body, content_type = 404, str(error.args[0]), 'text/plain'
+        except ValueError, error:
+            status, body, content_type = 400, str(error), 'text/plain'
+        except Exception, error:
+            status, body, content_type = 500, str(error), 'text/plain'
+        latency = (time.time() - start_time) * 1000.0
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', status_note)
+        self.send_header('X-Response-Time', '%0.2fms' % latency)
+        self.end_headers()
+        self.wfile.write(body)
+        if not self.server.silent:
+            print >> sys.stderr, ('%s "%s" %i %s %0.2fms\n') % (self.client_address[0], self.path, status,
+                                                                status_note, latency),
+        return None
+
+    def log_message(self, format, *args):
+        # requests are reported along with their latency in do_GET
+        return None
+
+    def _describe_sources(self):
+        """Return a JSON summary of the loaded heatmap sources and the tile cache."""
+        sources = {}
+        for name, heatmap in self.server.sources.iteritems():
+            if isinstance(heatmap, MRH):
+                sources[name] = {'type': 'mrh', 'chromosomes': list(heatmap.chromosomes),
+                                 'trans': heatmap.includes_trans}
+            else:
+                sources[name] = {'type': 'hic_project', 'chromosomes': list(heatmap.fends['chromosomes'][...]),
+                                 'trans': True}
+        cache = self.server.cache
+        with self.server.cache_lock:
+            stats = {'entries': len(cache.entries), 'size': cache.size, 'maxsize': cache.maxsize,
+                     'hits': cache.hits, 'misses': cache.misses}
+        return json.dumps({'sources': sources, 'cache': stats})
+
+    def _parse_query(self, query):
+        """Convert query string arguments to typed request parameters, filling in defaults."""
+        params = {'format': 'json'}
+        for key, values in urlparse.parse_qs(query).iteritems():
+            value = values[-1]
+            if key in self.int_params:
+                try:
+                    params[key] = int(value)
+                except ValueError:
+                    raise ValueError("%s must be an integer" % key)
+            elif key in self.float_params:
+                try:
+                    params[key] = float(value)
+                except ValueError:
+                    raise ValueError("%s must be a number" % key)
+            elif key in self.str_params:
+                params[key] = value
+            else:
+                raise ValueError("Unrecognized parameter %s" % key)
+        if 'chrom1' not in params:
+            raise ValueError("chrom1 is required")
+        if params['format'] not in self.content_types:
+            raise ValueError("format must be one of %s" % ', '.join(sorted(self.content_types.keys())))
+        if 'binsize' in params and params['binsize'] <= 0:
+            raise ValueError("binsize must be positive")
+        if params.get('chrom2', params['chrom1']) == params['chrom1']:
+            params.pop('chrom2', None)
+        return params
+
+    def _render(self, name, params):
+        """Find the requested scores and encode them in the requested format."""
+        heatmap = self.server.sources[name]
+        if isinstance(heatmap, MRH):
+            scores, bounds = self._find_mrh_scores(heatmap, params)
+            header = heatmap.get_header(params['chrom1'], params.get('chrom2'))
+            minscore = params.get('minscore', header['minscore'])
+            maxscore = params.get('maxscore', header['maxscore'])
+        else:
+            with self.server.source_locks[name]:
+                scores, bounds = self._find_project_scores(heatmap, params)
+            minscore = params.get('minscore')
+            maxscore = params.get('maxscore')
+        if params['format'] == 'json':
+            response = {'chrom1': params['chrom1'], 'chrom2': params.get('chrom2', params['chrom1'])}
+            response.update(bounds)
+            response['scores'] = [[value if value == value else None for value in row]
+                                  for row in scores.astype(numpy.float64).tolist()]
+            return json.dumps(response)
+        output = StringIO()
+        if params['format'] == 'npy':
+            numpy.save(output, scores)
+            return output.getvalue()
+        if 'PIL' not in sys.modules.keys():
+            raise ValueError("The PIL module must be installed to render PNG tiles")
+        data = numpy.zeros((scores.shape[0], scores.shape[1], 2), dtype=numpy.float64)
+        valid = numpy.where(numpy.logical_not(numpy.isnan(scores)))
+        data[valid[0], valid[1], 0] = scores[valid]
+        data[valid[0], valid[1], 1] = 1
+        if valid[0].shape[0] == 0:
+            minscore, maxscore = -1.0, 1.0
+        img = plot_full_array(data, maxscore=maxscore, minscore=minscore, logged=False, silent=True)
+        img.save(output, 'PNG')
+        return output.getvalue()
+
+    def _find_mrh_scores(self, heatmap, params):
+        """Return a dense tile of log2 scores and its bounds from a multi-resolution heatmap."""
+        chrom1 = params['chrom1']
+        chrom2 = params.get('chrom2')
+        header = heatmap.get_header(chrom1, chrom2)
+        bounds = {}
+        for key in ['start1', 'stop1']:
+            bounds[key] = int(params.get(key, header[key]))
+        for key in ['start2', 'stop2']:
+            if chrom2 is None:
+                bounds[key] = params.get(key, bounds[key[:-1] + '1'])
+            else:
+                bounds[key] = int(params.get(key, header[key]))
+        bounds['binsize'] = int(params.get('binsize', header['hres']))
+        scores = heatmap.get_tile(chrom1, bounds['start1'], bounds['stop1'], chrom2, bounds['start2'],
+                                  bounds['stop2'], binsize=bounds['binsize'],
+                                  minresolution=params.get('minresolution'))
+        return scores, bounds
+
+    def _find_project_scores(self, hic, params):
+        """Return a binned matrix of log2 scores and its bounds from a HiC project."""
+        chrom1 = params['chrom1']
+        chrom2 = params.get('chrom2')
+        for chrom in [chrom1, chrom2]:
+            if chrom is not None and chrom not in hic.chr2int:
+                raise KeyError("Project does not contain chromosome %s" % chrom)
+        binsize = params.get('binsize', self.server.binsize)
+        datatype = params.get('datatype', self.server.datatype)
+        if datatype not in ['raw', 'fend', 'distance', 'enrichment']:
+            raise ValueError("datatype must be one of raw, fend, distance, or enrichment")
+        if chrom2 is None:
+            results = find_cis_subregion_signal(hic, chrom1, binsize=binsize, start1=params.get('start1'),
+                                                stop1=params.get('stop1'),
+                                                start2=params.get('start2', params.get('start1')),
+                                                stop2=params.get('stop2', params.get('stop1')),
+                                                datatype=datatype, returnmapping=True, silent=True)
+        else:
+            results = find_trans_signal(hic, chrom1, chrom2, binsize=binsize, start1=params.get('start1'),
+                                        stop1=params.get('stop1'), start2=params.get('start2'),
+                                        stop2=params.get('stop2'), datatype=datatype, returnmapping=True,
+                                        silent=True)
+        if results is None or results[0].shape[0] == 0 or results[0].shape[1] == 0:
+            raise ValueError("No data could be found for the requested region")
+        data, mapping1, mapping2 = results
+        scores = numpy.empty(data.shape[:2], dtype=numpy.float32)
+        scores.fill(numpy.nan)
+        where = numpy.where((data[:, :, 0] > 0) & (data[:, :, 1] > 0))
+        scores[where] = numpy.log2(data[where[0], where[1], 0] / data[where[0], where[1], 1])
+        bounds = {'start1': int(mapping1[0, 0]), 'stop1': int(mapping1[-1, 1]), 'start2': int(mapping2[0, 0]),
+                  'stop2': int(mapping2[-1, 1]), 'binsize': binsize}
+        return scores, bounds
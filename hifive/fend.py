@@ -7,6 +7,8 @@ import sys
 
 import numpy
 import h5py
+
+from hic_data import _map_dataset
 #from reportlab.graphics.shapes import Drawing
 #from reportlab.graphics.charts.lineplots import LinePlot
 #from reportlab.lib.colors import Color
@@ -440,66 +442,84 @@ class Fend(object):
         return [bins, chromosomes]
 
 
-    def add_hdf5_feature(self, name, filename, window):
+    def add_hdf5_feature(self, name, filename, window, blocksize=10000000):
         """
         Load feature from an hdf5 file, finding mean values for bases within some distance upstream of restriction sites specified by 'window'.
 
-        :param name: A name to associate with this feature. This will be the key in the fend numpy object as well as in the hdf5 file that feature data are loaded from.
-        :type name: str.
-        :param filename: The file path of the hdf5 file containing the feature data. Each chromosome should have a numpy array dataset named "CHR.FEATURE" with 'FEATURE' matching the parameter 'name'. Features should have one line per base and start at base 0. 
+        :param name: A name to associate with this feature or a list of names to load several features in one pass. This will be the key in the fend numpy object as well as in the hdf5 file that feature data are loaded from.
+        :type name: str. or list
+        :param filename: The file path of the hdf5 file containing the feature data. Each chromosome should have a numpy array dataset named "CHR.FEATURE" with 'FEATURE' matching the parameter 'name'. Features should have one line per base and start at base 0. Contiguous, uncompressed datasets are memory-mapped rather than loaded.
         :type filename: str.
         :param window: A maximum number of bases upstream of restriction sites to pull feature data from. If a fragment is shorter than the window, the full length of the fragment is used instead.
         :type window: int.
+        :param blocksize: The number of bases of each feature track to read into memory at a time.
+        :type blocksize: int.
         :returns: None
         """
+        if isinstance(name, str):
+            names = [name]
+        else:
+            names = list(name)
         infile = h5py.File(filename, 'r')
-        self['%s_window' % name] = window
         if self.binned is not None:
-            scores = numpy.zeros(self.bins.shape[0], dtype=numpy.float64)
             bins = self.bins
             bin_indices = self.bin_indices
-            for i, chrom in enumerate(self.chromosomes):
-                if "%s.%s" % (chrom, name) in infile:
-                    track = infile["%s.%s" % (chrom, name)][...]
-                else:
-                    continue
-                for j in range(bin_indices[i], bin_indices[i + 1]):
-                    start1 = self.bins['start'][j]
-                    stop1 = self.bins['start'][j] + window
-                    start2 = self.bins['stop'][j] - window
-                    stop2 = self.bins['stop'][j]
-                    if stop1 >= start2:
-                        scores[j] = numpy.sum(track[start1:stop2]) / float(stop2 - start1)
-                    else:
-                        scores[j] = ((numpy.sum(track[start1:stop1]) + numpy.sum(track[start2:stop2])) /
-                                     float(stop1 + stop2 - start1 - start2))
         else:
-            scores = numpy.zeros(self.fends.shape[0], dtype=numpy.float64)
             bins = self.fends
             bin_indices = self.chr_indices
-            for i, chrom in enumerate(self.chromosomes):
-                if "%s.%s" % (chrom, name) in infile:
-                    track = infile["%s.%s" % (chrom, name)][...]
-                else:
+        scores = numpy.zeros((bins.shape[0], len(names)), dtype=numpy.float64)
+        for i, chrom in enumerate(self.chromosomes):
+            if bin_indices[i + 1] == bin_indices[i]:
+                continue
+            starts = bins['start'][bin_indices[i]:bin_indices[i + 1]].astype(numpy.int64)
+            stops = bins['stop'][bin_indices[i]:bin_indices[i + 1]].astype(numpy.int64)
+            # each score is the mean of a first window [start1, stop1) and a second window [start2, stop2)
+            if self.binned is not None:
+                stop1 = starts + window
+                start2 = stops - window
+                overlap = stop1 >= start2
+                stop1[overlap] = stops[overlap]
+                start2[overlap] = stops[overlap]
+                start1 = starts
+                stop2 = stops
+            else:
+                # fends come in pairs from each fragment, the second of which lies upstream of the fragment's end
+                partners = numpy.arange(bin_indices[i], bin_indices[i + 1]) ^ 1
+                upstream = partners < numpy.arange(bin_indices[i], bin_indices[i + 1])
+                start1 = numpy.where(upstream,
+                                     numpy.maximum(bins['start'][partners], stops - window), starts)
+                stop1 = numpy.where(upstream, stops,
+                                    numpy.minimum(bins['stop'][partners], starts + window))
+                start2 = stop1
+                stop2 = stop1
+            lengths = (stop1 - start1 + stop2 - start2).astype(numpy.float64)
+            for j, feature in enumerate(names):
+                if "%s.%s" % (chrom, feature) not in infile:
                     continue
-                for j in range(bin_indices[i], bin_indices[i + 1]):
-                    if bins['orientation'][j]:
-                        start = max(self.bins['start'][j - 1], self.bins['stop'][j] - window)
-                        stop = self.bins['stop'][j]
-                    else:
-                        start = self.bins['start'][j]
-                        stop = min(self.bins['stop'][j + 1], self.bins['start'][j] + window)
-                    scores[j] = numpy.sum(track[start:stop]) / float(stop - start)
-        if numpy.sum(numpy.abs(scores)) == 0.0:
-            if self.verbose > 0:
-                print >> sys.stderr, ("No valid data appears to have been loaded. Not adding feature.\nIt is possible that the feature name doesn't match the key values in the file.\n"),
-            return None
+                dataset = infile["%s.%s" % (chrom, feature)]
+                track = _map_dataset(filename, dataset)
+                if track is None:
+                    track = dataset
+                sums = _find_track_sums(track, numpy.r_[start1, start2], numpy.r_[stop1, stop2], blocksize)
+                scores[bin_indices[i]:bin_indices[i + 1], j] = (sums[:starts.shape[0]] +
+                                                                sums[starts.shape[0]:]) / lengths
+                del track
+        infile.close()
+        valid = numpy.where(numpy.sum(numpy.abs(scores), axis=0) > 0.0)[0]
+        if valid.shape[0] < len(names):
+            if not self.silent:
+                print >> sys.stderr, ("No valid data appears to have been loaded for %s. Not adding feature.\nIt is possible that the feature name doesn't match the key values in the file.\n") % (', '.join([names[j] for j in range(len(names)) if j not in valid])),
+            if valid.shape[0] == 0:
+                return None
         dtypes = bins.dtype.descr
-        dtypes.append((name, numpy.float64))
+        for j in valid:
+            self['%s_window' % names[j]] = window
+            dtypes.append((names[j], numpy.float64))
         new_bins = numpy.zeros(bins.shape[0], dtype=dtypes)
         for label in bins.dtype.names:
             new_bins[label] = bins[label]
-        new_bins[name] = scores
+        for j in valid:
+            new_bins[names[j]] = scores[:, j]
         if self.binned is not None:
             self.bins = new_bins
         else:
@@ -507,6 +527,24 @@ class Fend(object):
         return None
 
 
+def _find_track_sums(track, starts, stops, blocksize):
+    """Return the sums of 'track' over each range from 'starts' to 'stops', reading 'blocksize' values at a time."""
+    size = track.shape[0]
+    positions = numpy.minimum(numpy.maximum(numpy.r_[starts, stops], 0), size)
+    order = numpy.argsort(positions)
+    positions = positions[order]
+    # cumulative sums of the track up to each start and stop position
+    prefix = numpy.zeros(positions.shape[0], dtype=numpy.float64)
+    total = 0.0
+    for i in range(0, size, blocksize):
+        block = numpy.r_[0.0, numpy.cumsum(track[i:min(size, i + blocksize)], dtype=numpy.float64)]
+        first = numpy.searchsorted(positions, i)
+        last = numpy.searchsorted(positions, i + blocksize)
+        prefix[order[first:last]] = total + block[positions[first:last] - i]
+        total += block[-1]
+    prefix[order[numpy.searchsorted(positions, size):]] = total
+    return prefix[starts.shape[0]:] - prefix[:starts.shape[0]]
+
 if __name__ == '__main__':
     filename = sys.argv[1]
     fend = Fend('.'.join(filename.split('.')[:-1] + ['.hdf5']), 'w')
@@ -4,6 +4,7 @@
 
 import os
 import sys
+import zlib
 
 import numpy
 import h5py
@@ -12,6 +13,8 @@ try:
 except:
     pass
 
+from hic_data import _find_name_keys
+
 
 
 class FiveCData(object):
@@ -197,7 +200,57 @@ class FiveCData(object):
         self.history += "Success\n"
         return None
 
-    def load_data_from_bam(self, fragfilename, filelist):
+    def _open_bam(self, fname, threads):
+        """Open a BAM file, using multiple decompression threads if supported by pysam."""
+        if threads > 1:
+            try:
+                return pysam.AlignmentFile(fname, 'rb', threads=threads)
+            except (AttributeError, TypeError):
+                pass
+        return pysam.Samfile(fname, 'rb')
+
+    def _read_bam_ends(self, fname, names, threads):
+        """Return arrays of two independent read name hashes and fragment indices for uniquely-aligned reads in a BAM file."""
+        input = self._open_bam(fname, threads)
+        tid2frag = []
+        for i in range(len(input.header['SQ'])):
+            tid2frag.append(names.get(input.getrname(i), -1))
+        # fill fixed-size blocks of arrays rather than growing python lists
+        blocksize = 1000000
+        hashes = []
+        checks = []
+        frags = []
+        a = blocksize
+        for read in input.fetch(until_eof=True):
+            # Only consider reads with an alignment
+            if read.is_unmapped:
+                continue
+            # if mapping name not in fragment names, skip
+            if tid2frag[read.tid] < 0:
+                continue
+            # skip multiply-aligned reads
+            for tag in read.tags:
+                if tag[0] == 'XS':
+                    break
+            else:
+                if a == blocksize:
+                    hashes.append(numpy.empty(blocksize, dtype=numpy.int64))
+                    checks.append(numpy.empty(blocksize, dtype=numpy.int32))
+                    frags.append(numpy.empty(blocksize, dtype=numpy.int32))
+                    a = 0
+                hashes[-1][a] = hash(read.qname)
+                checks[-1][a] = zlib.crc32(read.qname)
+                frags[-1][a] = tid2frag[read.tid]
+                a += 1
+        input.close()
+        if len(hashes) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32)
+        hashes[-1] = hashes[-1][:a]
+        checks[-1] = checks[-1][:a]
+        frags[-1] = frags[-1][:a]
+        return numpy.concatenate(hashes), numpy.concatenate(checks), numpy.concatenate(frags)
+
+    def load_data_from_bam(self, fragfilename, filelist, threads=1):
         """
         Read interaction counts from pairs of BAM files and place in h5dict.
 
@@ -205,6 +258,8 @@ class FiveCData(object):
         :type fragfilename: str.
         :param filelist: A list containing lists of paired read end files.
         :type filelist: list
+        :param threads: The number of threads pysam should use to decompress each BAM file.
+        :type threads: int.
         :returns: None
 
         :Attributes: * **fragfilename** (*str.*) - A string containing the relative path of the fragment file.
@@ -216,7 +271,7 @@ class FiveCData(object):
 
         When data is loaded the 'history' attribute is updated to include the history of the Fragment file that becomes associated with it.
         """
-        self.history += "FiveCData.load_data_from_counts(fragfilename='%s', filelist=%s) - " % (fragfilename, str(filelist))
+        self.history += "FiveCData.load_data_from_counts(fragfilename='%s', filelist=%s, threads=%i) - " % (fragfilename, str(filelist), threads)
         if 'pysam' not in sys.modules.keys():
             if not self.silent:
                 print >> sys.stderr, ("The pysam module must be installed to use this function.")
@@ -261,58 +316,47 @@ class FiveCData(object):
                 if not self.silent:
                     print >> sys.stderr, ("No data for one or both ends could be located. Skipping this run.\n")
             reads = 0
-            unpaired = {}
             # load first half of paired ends
             if not self.silent:
                 print >> sys.stderr, ("Loading data from %s...") % (filepair[0].split('/')[-1]),
-            input = pysam.Samfile(filepair[0], 'rb')
-            for read in input.fetch(until_eof=True):
-                # Only consider reads with an alignment
-                if read.is_unmapped:
-                    continue
-                # if mapping name not in fragment names, skip
-                seq_name = input.getrname(read.tid)
-                if seq_name not in names:
-                    continue
-                # skip multiply-aligned reads
-                for tag in read.tags:
-                    if tag[0] == 'XS':
-                        break
-                else:
-                    unpaired[read.qname] = names[seq_name]
-            input.close()
+            hashes1, checks1, frags1 = self._read_bam_ends(filepair[0], names, threads)
             if not self.silent:
                 print >> sys.stderr, ("Done\n"),
             # load second half of paired ends
             if not self.silent:
                 print >> sys.stderr, ("Loading data from %s...") % (filepair[1].split('/')[-1]),
-            input = pysam.Samfile(filepair[1], 'rb')
-            for read in input.fetch(until_eof=True):
-                # Only consinder reads whose paired end was valid
-                if read.qname not in unpaired:
-                    continue
-                # Only consider reads with an alignment
-                if read.is_unmapped:
-                    continue
-                # if mapping name not in fragment names, skip
-                seq_name = input.getrname(read.tid)
-                if seq_name not in names:
-                    continue
-                # skip multiply-aligned reads
-                for tag in read.tags:
-                    if tag[0] == 'XS':
-                        break
-                else:
-                    # if both ends map to the same orientation, skip
-                    if strands[unpaired[read.qname]] != strands[names[seq_name]]:
-                        pair = (min(unpaired[read.qname], names[seq_name]),
-                                max(unpaired[read.qname], names[seq_name]))
-                        if pair not in data:
-                            data[pair] = 0
-                        data[pair] += 1
-                        reads += 1
-                    del unpaired[read.qname]
-            input.close()
+            hashes2, checks2, frags2 = self._read_bam_ends(filepair[1], names, threads)
+            # identify read names by a key that needs both name hashes to match
+            keys1, keys2 = _find_name_keys(hashes1, checks1, hashes2, checks2)
+            del hashes1, checks1, hashes2, checks2
+            # keep only the last alignment for each read name, sorted by name key
+            order = numpy.argsort(keys1, kind='mergesort')
+            keys1 = keys1[order]
+            last = numpy.where(numpy.r_[keys1[1:] != keys1[:-1], True])[0]
+            keys1 = keys1[last]
+            frags1 = frags1[order[last]]
+            del order, last
+            if keys1.shape[0] > 0 and keys2.shape[0] > 0:
+                # only the first valid second end for each read name is paired
+                indices = numpy.minimum(numpy.searchsorted(keys1, keys2), keys1.shape[0] - 1)
+                matched = numpy.where(keys1[indices] == keys2)[0]
+                matched = matched[numpy.unique(keys2[matched], return_index=True)[1]]
+                pairs = numpy.empty((matched.shape[0], 2), dtype=numpy.int64)
+                pairs[:, 0] = frags1[indices[matched]]
+                pairs[:, 1] = frags2[matched]
+                del indices, matched
+                # if both ends map to the same orientation, skip
+                pairs = pairs[numpy.where(strands[pairs[:, 0]] != strands[pairs[:, 1]])[0], :]
+                pairs.sort(axis=1)
+                keys, counts = numpy.unique((pairs[:, 0] << 32) | pairs[:, 1], return_counts=True)
+                for i in range(keys.shape[0]):
+                    pair = (int(keys[i] >> 32), int(keys[i] & (2 ** 32 - 1)))
+                    if pair not in data:
+                        data[pair] = 0
+                    data[pair] += int(counts[i])
+                reads += pairs.shape[0]
+                del pairs, keys, counts
+            del keys1, frags1, keys2, frags2
             if not self.silent:
                 print >> sys.stderr, ("Done\n"),
             if not self.silent:
@@ -5,6 +5,10 @@
 import os
 import sys
 import struct
+import datetime
+import shutil
+import multiprocessing
+from collections import OrderedDict
 
 import numpy
 import h5py
@@ -20,12 +24,89 @@ except:
     pass
 
 import hic_binning
+from hic_data import _load_lazy_dataset, _read_lazy_dataset, _materialize_lazy_datasets, _reopen_hdf5_file
+from quasar import _downsample_counts
 import libraries._hic_binning as _binning
 import libraries._hic_distance as _distance
 import libraries._hic_interactions as _interactions
 import libraries._hic_optimize as _optimize
 import plotting
 
+# libgomp's thread pool doesn't survive a fork, so once this process has run a multithreaded kernel any forked
+# local worker processes must stick to a single thread
+_openmp_started = False
+
+
+class _ArrayCache(object):
+
+    """A least-recently-used cache of read-only numpy arrays with a total size limit in bytes."""
+
+    def __init__(self, maxsize):
+        """Create an empty cache."""
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        return None
+
+    def get(self, key, load):
+        """Return the array stored under 'key', calling 'load' to read it if it isn't cached."""
+        if key in self.entries:
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        self.misses += 1
+        value = load()
+        if value.nbytes > self.maxsize:
+            return value
+        value.flags.writeable = False
+        self.entries[key] = value
+        self.size += value.nbytes
+        while self.size > self.maxsize:
+            self.size -= self.entries.popitem(last=False)[1].nbytes
+        return value
+
+    def clear(self):
+        """Remove all cached arrays."""
+        self.entries.clear()
+        self.size = 0
+        return None
+
+
+class _PipeComm(object):
+
+    """A minimal stand-in for an MPI communicator connecting locally forked processes with pipes."""
+
+    def __init__(self, rank, size, connections):
+        """Create a communicator for 'rank' with a dictionary of pipe connections keyed by rank."""
+        self.rank = rank
+        self.size = size
+        self.connections = connections
+        return None
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def send(self, obj, dest, tag=0):
+        self.connections[dest].send(obj)
+        return None
+
+    def recv(self, source, tag=0):
+        return self.connections[source].recv()
+
+    def Send(self, array, dest, tag=0):
+        self.connections[dest].send_bytes(numpy.ascontiguousarray(array).tostring())
+        return None
+
+    def Recv(self, array, source, tag=0):
+        self.connections[source].recv_bytes_into(array)
+        return None
+
 
 class HiC(object):
 
@@ -45,6 +126,12 @@ class HiC(object):
     :type mode: str.
     :param silent: Indicates whether to print information about function execution for this object.
     :type silent: bool.
+    :param lazy: If True, analysis arrays are not copied into memory when the h5dict is loaded. Contiguous, uncompressed datasets are memory-mapped (copy-on-write) and all other datasets are read on first access.
+    :type lazy: bool.
+    :param cachesize: The maximum number of bytes of fend arrays and interaction data slices to keep in memory between region queries. A value of zero disables caching.
+    :type cachesize: int.
+    :param processes: The number of local processes used by MPI-compatible methods (:func:`find_distance_parameters`, :func:`find_probability_fend_corrections`, :func:`find_express_fend_corrections`, :func:`write_multiresolution_heatmap`, and :func:`calculate_quality`) when not run under MPI. Additional processes are forked for each call and share read-only arrays with the calling process.
+    :type processes: int.
     :returns: :class:`HiC <hifive.hic.HiC>` class object.
 
     :attributes: * **file** (*str.*) - A string containing the name of the file passed during object creation for saving the object to.
@@ -54,14 +141,19 @@ class HiC(object):
                  * **comm** (*class*) - A link to the MPI.COMM_WORLD class from the mpi4py package. If this package isn't present, this is set to 'None'.
                  * **rank** (*int.*) - The rank integer of this process, if running with mpi, otherwise set to zero.
                  * **num_procs** (*int.*) - The number of processes being executed in parallel. If mpi4py package is not present, this is set to one.
+                 * **cache** (*class*) - A least-recently-used cache of arrays read for region queries. Its 'hits' and 'misses' attributes count cache lookups.
 
     In addition, many other attributes are initialized to the 'None' state.
     """
 
-    def __init__(self, filename, mode='r', silent=False):
+    def __init__(self, filename, mode='r', silent=False, lazy=False, cachesize=100000000, processes=1):
         """Create a HiC object."""
         self.file = os.path.abspath(filename)
         self.filetype = 'hic_project'
+        self.processes = processes
+        self.lazy = lazy
+        self._lazy = {}
+        self.cache = _ArrayCache(cachesize)
         if 'mpi4py' in sys.modules.keys():
             self.comm = MPI.COMM_WORLD
             self.rank = self.comm.Get_rank()
@@ -94,9 +186,100 @@ class HiC(object):
         """Dictionary-like lookup."""
         if key in self.__dict__:
             return self.__dict__[key]
+        elif key in self.__dict__.get('_lazy', {}):
+            return getattr(self, key)
         else:
             return None
 
+    def __getattr__(self, key):
+        """Read lazily-loaded datasets on first access."""
+        return _read_lazy_dataset(self, key)
+
+    def _find_fend_array(self, name, field=None):
+        """Return a read-only, cached copy of an array or record field from the fend file."""
+        def load():
+            if field is None:
+                return self.fends[name][...]
+            else:
+                return self.fends[name][field][...]
+        return self.cache.get(('fends', name, field), load)
+
+    def _find_data_slice(self, datatype, startfend, stopfend):
+        """Return copies of the 'cis' or 'trans' data indices and interactions for fends 'startfend' to 'stopfend'."""
+        indices = self.cache.get(('data', datatype, 'indices'),
+                                 lambda: self.data['%s_indices' % datatype][...])
+        def load():
+            return self.data['%s_data' % datatype][indices[startfend]:indices[stopfend], :]
+        data = self.cache.get(('data', datatype, startfend, stopfend), load)
+        return indices[startfend:(stopfend + 1)].copy(), data.copy()
+
+    def _find_distance_table(self, binsize=None):
+        """Return a cached table of distance-dependent expected signal (without chromosome means) for the binning kernels.
+
+        Without 'binsize', rows hold the signal at _hic_binning.DISTANCE_TABLE_STEPS log-spaced distances per doubling plus the step to the next row for interpolation (NaN where a line segment changes). With 'binsize', rows hold the signal at each whole number of bins of separation.
+        """
+        if self.distance_parameters is None:
+            return None
+        parameters = numpy.ascontiguousarray(self.distance_parameters, dtype=numpy.float32)
+        def load():
+            if self.binned is not None:
+                chr_indices = self._find_fend_array('bin_indices')
+                mids = self._find_fend_array('bins', 'mid')
+            else:
+                chr_indices = self._find_fend_array('chr_indices')
+                mids = self._find_fend_array('fends', 'mid')
+            valid = numpy.where(chr_indices[1:] > chr_indices[:-1])[0]
+            span = max(1, numpy.amax(mids[chr_indices[valid + 1] - 1] - mids[chr_indices[valid]]))
+            if binsize is None:
+                steps = _binning.DISTANCE_TABLE_STEPS
+                levels = int(numpy.floor(numpy.log2(span))) + 1
+                positions = numpy.r_[(2.0 ** numpy.repeat(numpy.arange(levels), steps) *
+                                     (1.0 + numpy.tile(numpy.arange(steps), levels) / float(steps))), 2.0 ** levels]
+            else:
+                positions = numpy.maximum(1, numpy.arange(span / binsize + 1) * binsize).astype(numpy.float64)
+            # match the kernels' segment search, which stops at the first cutoff not less than the log-distance
+            log_positions = numpy.log(positions)
+            segments = numpy.searchsorted(parameters[:, 0].astype(numpy.float64), log_positions)
+            signal = numpy.exp(log_positions * parameters[segments, 1].astype(numpy.float64) +
+                               parameters[segments, 2].astype(numpy.float64))
+            if binsize is not None:
+                return signal
+            table = numpy.zeros((positions.shape[0] - 1, 2), dtype=numpy.float64)
+            table[:, 0] = signal[:-1]
+            table[:, 1] = signal[1:] - signal[:-1]
+            table[numpy.where(segments[1:] != segments[:-1])[0], 1] = numpy.nan
+            return table
+        return self.cache.get(('distance_table', binsize, parameters.tostring()), load)
+
+    def _use_local_processes(self):
+        """Determine whether an MPI-compatible method should be spread across forked local processes."""
+        return self.processes > 1 and self.num_procs == 1 and not isinstance(self.comm, _PipeComm)
+
+    def _run_local_processes(self, name, **kwargs):
+        """Run the MPI-compatible method 'name' with additional forked processes acting as the other ranks."""
+        connections = []
+        for i in range(1, self.processes):
+            connections.append(multiprocessing.Pipe())
+        workers = []
+        for i in range(1, self.processes):
+            workers.append(multiprocessing.Process(target=_run_local_rank, args=(self, name, i, connections, kwargs)))
+            workers[-1].start()
+        for i in range(len(connections)):
+            connections[i][1].close()
+        comm = self.comm
+        self.comm = _PipeComm(0, self.processes, dict([(i + 1, connections[i][0]) for i in range(len(connections))]))
+        self.num_procs = self.processes
+        try:
+            getattr(self, name)(**kwargs)
+        finally:
+            self.comm = comm
+            self.num_procs = 1
+            for i in range(len(connections)):
+                connections[i][0].close()
+            for worker in workers:
+                worker.join()
+        return None
+
     def __setitem__(self, key, value):
         """Dictionary-like value setting."""
         self.__dict__[key] = value
@@ -130,6 +313,7 @@ class HiC(object):
         self.datafilename = "%s/%s" % (os.path.relpath(os.path.dirname(os.path.abspath(filename)),
                                        os.path.dirname(self.file)), os.path.basename(filename))
         self.data = h5py.File(filename, 'r')
+        self.cache.clear()
         self.history = self.data['/'].attrs['history'] + self.history
         fendfilename = self.data['/'].attrs['fendfilename']
         if fendfilename[:2] == './':
@@ -198,9 +382,11 @@ class HiC(object):
                 datafilename = self.datafilename
             if 'fendfilename' in self.__dict__:
                 fendfilename = self.fendfilename
+        _materialize_lazy_datasets(self)
         datafile = h5py.File(out_fname, 'w')
         for key in self.__dict__.keys():
-            if key in ['data', 'fends', 'file', 'chr2int', 'comm', 'rank', 'num_procs', 'silent']:
+            if key in ['data', 'fends', 'file', 'chr2int', 'comm', 'rank', 'num_procs', 'silent', 'lazy', '_lazy',
+                       'cache', 'processes']:
                 continue
             elif self[key] is None:
                 continue
@@ -236,10 +422,15 @@ class HiC(object):
         self.normalization = 'none'
         self.binned = None
         self.history = ''
+        self._lazy = {}
+        self.cache.clear()
         # load data hdf5 dict 
         datafile = h5py.File(self.file, 'r')
         for key in datafile.keys():
-            self[key] = numpy.copy(datafile[key])
+            if self.lazy:
+                _load_lazy_dataset(self, datafile, key)
+            else:
+                self[key] = numpy.copy(datafile[key])
         for key in datafile['/'].attrs.keys():
             self[key] = datafile['/'].attrs[key]
         # ensure data h5dict exists
@@ -357,7 +548,7 @@ class HiC(object):
             data = self.data['cis_data'][...]
             indices = self.data['cis_indices'][...]
         if usereads != 'cis':
-            transdata = self.data['trans_data'][...][:, :2]
+            transdata = self.data['trans_data'][:, :2]
         # repeat until all remaining fends have mininteraction valid interactions
         while current_valid < previous_valid:
             previous_valid = current_valid
@@ -406,6 +597,9 @@ class HiC(object):
         """
         if numbins == 0:
             return None
+        if self._use_local_processes():
+            return self._run_local_processes('find_distance_parameters', numbins=numbins, minsize=minsize,
+                                             maxsize=maxsize, corrected=corrected)
         self.history += "HiC.find_distance_parameters(numbins=%i, minsize=%i, maxsize=%s, corrected=%s) - " % (numbins, minsize, str(maxsize), corrected)
         if not self.silent:
             print >> sys.stderr, ('Finding distance arrays...'),
@@ -551,7 +745,7 @@ class HiC(object):
 
     def find_probability_fend_corrections(self, mindistance=0, maxdistance=0, minchange=0.0001,
                                           max_iterations=1000, learningstep=0.5, chroms=[], precalculate=True,
-                                          precorrect=False, model='binomial'):
+                                          precorrect=False, model='binomial', threads=1):
         """
         Using gradient descent, learn correction values for each valid fend based on a binomial or Poisson distribution of observations. This function is MPI compatible.
 
@@ -573,13 +767,28 @@ class HiC(object):
         :type precorrect: bool.
         :param model: Which probability model to use, either 'poisson' or 'binomial'. If 'poisson' is chosen, read counts are used. If 'binomial' is chosen, reads are converted to a 0/1 indicator of observed/unobserved status.
         :type model: str.
+        :param threads: The number of OpenMP threads to use for calculating costs and gradients within each process.
+        :type threads: int.
         :returns: None
 
         :Attributes: * **corrections** (*ndarray*) - A numpy array of type float32 and length equal to the number of fends. All invalid fends have an associated correction value of zero.
 
         The 'normalization' attribute is updated to 'probability' or 'binning-probability', depending on if the 'precorrect' option is selected. In addition, the 'chromosome_means' attribute is updated such that the mean correction (sum of all valid chromosomal correction value pairs) is adjusted to zero and the corresponding chromosome mean is adjusted the same amount but the opposite sign. 
         """
-        self.history += "HiC.find_probability_fend_corrections(mindistance=%i, maxdistance=%s, minchange=%f, max_iterations=%i, learningstep=%f, chroms=%s, precalculate=%s, precorrect=%s, model=%s) - " % (mindistance, str(maxdistance), minchange, max_iterations, learningstep, str(chroms), precalculate, precorrect, model)
+        if self._use_local_processes():
+            return self._run_local_processes('find_probability_fend_corrections', mindistance=mindistance,
+                                             maxdistance=maxdistance, minchange=minchange,
+                                             max_iterations=max_iterations, learningstep=learningstep,
+                                             chroms=chroms, precalculate=precalculate, precorrect=precorrect,
+                                             model=model, threads=threads)
+        _note_threads(threads)
+        self.history += "HiC.find_probability_fend_corrections(mindistance=%i, maxdistance=%s, minchange=%f, max_iterations=%i, learningstep=%f, chroms=%s, precalculate=%s, precorrect=%s, model=%s, threads=%i) - " % (mindistance, str(maxdistance), minchange, max_iterations, learningstep, str(chroms), precalculate, precorrect, model, threads)
+        # make sure there's at least one thread to sum into
+        if threads < 1:
+            if not self.silent:
+                print >> sys.stderr, ("The number of threads must be at least one.\n"),
+            self.history += "Error: '%i' not a valid value for 'threads'\n" % threads
+            return None
         if precorrect and self.binning_corrections is None:
             if not self.silent:
                 print >> sys.stderr, ("Precorrection can only be used in project has previously run 'find_binning_fend_corrections'.\n"),
@@ -785,6 +994,8 @@ class HiC(object):
             new_corrections = numpy.copy(corrections)
             # calculate correction gradients
             gradients = numpy.zeros(corrections.shape[0], dtype=numpy.float64)
+            # per-thread gradient rows, reused by every iteration
+            thread_sums = numpy.zeros((threads, corrections.shape[0]), dtype=numpy.float64)
             cont = True
             if not self.silent:
                 print >> sys.stderr, ("\r%s\rLearning corrections...") % (' ' * 80),
@@ -804,7 +1015,8 @@ class HiC(object):
                                        nonzero_means,
                                        zero_means,
                                        corrections,
-                                       log_corrections)
+                                       log_corrections,
+                                       threads)
             if self.rank == 0:
                 for i in range(1, self.num_procs):
                     start_cost += self.comm.recv(source=i, tag=11)
@@ -826,7 +1038,9 @@ class HiC(object):
                                   zero_means,
                                   corrections,
                                   inv_corrections,
-                                  gradients)
+                                  gradients,
+                                  threads,
+                                  thread_sums)
                 self._exchange_gradients(gradients, temp)
                 if self.rank == 0:
                     gradients /= interactions
@@ -853,7 +1067,8 @@ class HiC(object):
                                          nonzero_means,
                                          zero_means,
                                          new_corrections,
-                                         log_corrections)
+                                         log_corrections,
+                                         threads)
                     if self.rank == 0:
                         for i in range(1, self.num_procs):
                             cost += self.comm.recv(source=i, tag=11)
@@ -902,7 +1117,8 @@ class HiC(object):
                                  nonzero_means,
                                  zero_means,
                                  corrections,
-                                 log_corrections)
+                                 log_corrections,
+                                 threads)
             self.corrections[rev_mapping + start_fend] = corrections / (chrom_mean ** 0.5)
             if self.rank == 0:
                 for i in range(1, self.num_procs):
@@ -933,7 +1149,7 @@ class HiC(object):
 
     def find_express_fend_corrections(self, iterations=100, mindistance=0, maxdistance=0, remove_distance=True, 
                                       usereads='cis', mininteractions=0, minchange=0.0001, chroms=[], precorrect=False,
-                                      binary=False, kr=False):
+                                      binary=False, kr=False, threads=1):
         """
         Using iterative matrix-balancing approximation, learn correction values for each valid fend. This function is MPI compatible.
 
@@ -959,13 +1175,28 @@ class HiC(object):
         :type binary: bool.
         :param kr: Use the Knight Ruiz matrix balancing algorithm instead of weighted matrix balancing. This option ignores 'iterations'.
         :type kr: bool.
+        :param threads: The number of OpenMP threads to use for summing fend interactions within each process.
+        :type threads: int.
         :returns: None
 
         :Attributes: * **corrections** (*ndarray*) - A numpy array of type float32 and length equal to the number of fends. All invalid fends have an associated correction value of zero.
 
         The 'normalization' attribute is updated to 'express' or 'binning-express', depending on if the 'precorrect' option is selected. In addition, the 'chromosome_means' attribute is updated such that the mean correction (sum of all valid chromosomal correction value pairs) is adjusted to zero and the corresponding chromosome mean is adjusted the same amount but the opposite sign. 
         """
-        self.history += "HiC.find_express_fend_corrections(iterations=%i, mindistance=%i, maxdistance=%s, remove_distance=%s, usereads='%s', mininteractions=%i, minchange=%f, chroms=%s, precorrect=%s, binary=%s, kr=%s) - " % (iterations, mindistance, str(maxdistance), remove_distance, usereads, mininteractions, minchange, str(chroms), precorrect, binary, kr)
+        if self._use_local_processes():
+            return self._run_local_processes('find_express_fend_corrections', iterations=iterations,
+                                             mindistance=mindistance, maxdistance=maxdistance,
+                                             remove_distance=remove_distance, usereads=usereads,
+                                             mininteractions=mininteractions, minchange=minchange, chroms=chroms,
+                                             precorrect=precorrect, binary=binary, kr=kr, threads=threads)
+        _note_threads(threads)
+        self.history += "HiC.find_express_fend_corrections(iterations=%i, mindistance=%i, maxdistance=%s, remove_distance=%s, usereads='%s', mininteractions=%i, minchange=%f, chroms=%s, precorrect=%s, binary=%s, kr=%s, threads=%i) - " % (iterations, mindistance, str(maxdistance), remove_distance, usereads, mininteractions, minchange, str(chroms), precorrect, binary, kr, threads)
+        # make sure there's at least one thread to sum into
+        if threads < 1:
+            if not self.silent:
+                print >> sys.stderr, ("The number of threads must be at least one.\n"),
+            self.history += "Error: '%i' not a valid value for 'threads'\n" % threads
+            return None
         if mininteractions is None:
             if 'mininteractions' in self.__dict__.keys():
                 mininteractions = self.mininteractions
@@ -999,7 +1230,7 @@ class HiC(object):
         if kr:
             self._find_kr_corrections(mindistance, maxdistance, remove_distance, 
                                       usereads, mininteractions, minchange, chroms, precorrect,
-                                      binary)
+                                      binary, threads)
             return None
         # create needed arrays
         if self.binned is None:
@@ -1222,6 +1453,8 @@ class HiC(object):
             print >> sys.stderr, ("\r%s\rFinding fend corrections...") % (' ' * 80),
         # calculate corrections
         fend_means = numpy.zeros(filt.shape[0], dtype=numpy.float64)
+        # per-thread fend mean rows, reused by every iteration
+        thread_sums = numpy.zeros((threads, filt.shape[0]), dtype=numpy.float64)
         if self.rank == 0:
             temp = numpy.zeros(filt.shape[0], dtype=numpy.float64)
         corrections = numpy.copy(self.corrections)
@@ -1240,7 +1473,9 @@ class HiC(object):
                                       corrections,
                                       mu,
                                       trans_mu,
-                                      int(binary))
+                                      int(binary),
+                                      threads,
+                                      thread_sums)
             if self.rank == 0:
                 for i in range(1, self.num_procs):
                     self.comm.Recv(temp, source=i, tag=13)
@@ -1288,7 +1523,7 @@ class HiC(object):
 
     def _find_kr_corrections(self, mindistance=0, maxdistance=0, remove_distance=True, 
                              usereads='cis', mininteractions=0, minchange=0.0001, chroms=[], precorrect=False,
-                             binary=False):
+                             binary=False, threads=1):
         if (chroms is None or
                 (isinstance(chroms, list) and
                 (len(chroms) == 0 or
@@ -1352,7 +1587,7 @@ class HiC(object):
             if rev_mapping.shape[0] < 2:
                 if not self.silent:
                     print >> sys.stderr, ("\nInsufficient valid fends for this chromosome. Skipping.\n"),
-                    continue
+                continue
             mapping = numpy.zeros(chrfilt.shape[0], dtype=numpy.int32) - 1
             mapping[rev_mapping] = numpy.arange(rev_mapping.shape[0])
             if not data is None:
@@ -1497,16 +1732,19 @@ class HiC(object):
             Delta = 3
             v = numpy.zeros((corrections.shape[0], 1), dtype=numpy.float64)
             w = numpy.zeros((corrections.shape[0], 1), dtype=numpy.float64)
-            _optimize.calculate_v(data, trans_data, counts, trans_counts, corrections, v)
+            # per-thread rows for v and w, reused by every iteration
+            thread_sums = numpy.zeros((threads, corrections.shape[0]), dtype=numpy.float64)
+            _optimize.calculate_v(data, trans_data, counts, trans_counts, corrections, v, threads,
+                                  thread_sums)
             if self.rank == 0:
                 for i in range(1, self.num_procs):
-                    self.Recv(temp, source=i, tag=13)
+                    self.comm.Recv(temp, source=i, tag=13)
                     v += temp
                 for i in range(1, self.num_procs):
-                    self.Send(v, dest=i, tag=13)
+                    self.comm.Send(v, dest=i, tag=13)
             else:
-                self.Send(v, dest=0, tag=13)
-                self.Recv(v, source=0, tag=13)
+                self.comm.Send(v, dest=0, tag=13)
+                self.comm.Recv(v, source=0, tag=13)
             rk = 1.0 - v
             rho_km1 = numpy.dot(rk.T, rk)[0, 0]
             rho_km2 = rho_km1
@@ -1528,16 +1766,17 @@ class HiC(object):
                         p = Z + beta * p
                     # Update search direction efficiently
                     w.fill(0.0)
-                    _optimize.calculate_w(data, trans_data, counts, trans_counts, corrections, p, w)
+                    _optimize.calculate_w(data, trans_data, counts, trans_counts, corrections, p, w, threads,
+                                          thread_sums)
                     if self.rank == 0:
                         for j in range(1, self.num_procs):
-                            self.Recv(temp, source=j, tag=13)
+                            self.comm.Recv(temp, source=j, tag=13)
                             w += temp
                         for j in range(1, self.num_procs):
-                            self.Send(w, dest=j, tag=13)
+                            self.comm.Send(w, dest=j, tag=13)
                     else:
-                        self.Send(w, dest=0, tag=13)
-                        self.Recv(w, source=0, tag=13)
+                        self.comm.Send(w, dest=0, tag=13)
+                        self.comm.Recv(w, source=0, tag=13)
                     w += v * p
                     alpha = rho_km1 / numpy.dot(p.T, w)[0, 0]
                     ap = alpha * p
@@ -1562,16 +1801,17 @@ class HiC(object):
                     rho_km1 = numpy.dot(rk.T, Z)[0, 0]
                 corrections *= y
                 v.fill(0.0)
-                _optimize.calculate_v(data, trans_data, counts, trans_counts, corrections, v)
+                _optimize.calculate_v(data, trans_data, counts, trans_counts, corrections, v, threads,
+                                      thread_sums)
                 if self.rank == 0:
                     for j in range(1, self.num_procs):
-                        self.Recv(temp, source=j, tag=13)
+                        self.comm.Recv(temp, source=j, tag=13)
                         v += temp
                     for j in range(1, self.num_procs):
-                        self.Send(v, dest=j, tag=13)
+                        self.comm.Send(v, dest=j, tag=13)
                 else:
-                    self.Send(v, dest=0, tag=13)
-                    self.Recv(v, source=0, tag=13)
+                    self.comm.Send(v, dest=0, tag=13)
+                    self.comm.Recv(v, source=0, tag=13)
                 rk = 1.0 - v
                 rho_km1 = numpy.dot(rk.T, rk)[0, 0]
                 rout = rho_km1
@@ -1589,7 +1829,7 @@ class HiC(object):
                     print >> sys.stderr, ("\r%s\rIteration %i Residual: %e") % (" " * 80, i, rout),
             if not self.silent and self.rank == 0:
                 print >> sys.stderr, ("\r%s\rFinding fend corrections... Chrom: %s Done\n") % (' ' * 80, chrom),
-            self.corrections[rev_mapping + startfend] = 1.0 / corrections
+            self.corrections[rev_mapping + startfend] = 1.0 / corrections[:, 0]
         # calculate chromosome mean
         if self.chromosome_means is None:
             self.chromosome_means = numpy.zeros(chr_indices.shape[0] - 1, dtype=numpy.float32)
@@ -2379,7 +2619,7 @@ class HiC(object):
 
     def write_heatmap(self, filename, binsize, includetrans=True, datatype='enrichment', chroms=[], 
                       dynamically_binned=False, minobservations=0, searchdistance=0, expansion_binsize=0,
-                      removefailed=False, format='hdf5'):
+                      removefailed=False, format='hdf5', blocksize=1000):
         """
         Create a file containing binned interaction arrays, bin positions, and an index of included chromosomes. This function is MPI compatible.
 
@@ -2403,8 +2643,10 @@ class HiC(object):
         :type expansion_binsize: int.
         :param removefailed: If a non-zero 'searchdistance' is given, it is possible for a bin not to meet the 'minobservations' criteria before stopping looking. If this occurs and 'removefailed' is True, the observed and expected values for that bin are zero.
         :type removefailed: bool.
-        :param format: A string indicating whether to save heatmaps as text matrices ('txt'), an HDF5 file of numpy arrays ('hdf5'), or a numpy npz file ('npz').
+        :param format: A string indicating whether to save heatmaps as text matrices ('txt'), an HDF5 file of numpy arrays ('hdf5'), a numpy npz file ('npz'), or an HDF5 file of non-zero bins in coordinate format ('sparse'). Sparse heatmaps are built 'blocksize' by 'blocksize' bins at a time, so memory use scales with the non-zero bins of a block rather than with whole chromosomes. They are not available for dynamically binned data, unbinned data, or binned projects.
         :type format: str.
+        :param blocksize: The number of bins along each axis to find at a time when writing 'sparse' heatmaps.
+        :type blocksize: int.
         :returns: None
 
         The following attributes are created within the hdf5 dictionary file. Arrays are accessible as datasets while the resolution is held as an attribute.
@@ -2417,10 +2659,16 @@ class HiC(object):
                      * **N.enrichment** (*ndarray*) - A series of numpy arrays of type float32, one for each chromosome where N is the chromosome name, containing the observed / expected counts for valid fend combinations. Arrays are in an upper-triangle format such that they have N * (N - 1) / 2 entries where N is the number of fends in the chromosome.
                      * **N_by_M.counts** (*ndarray*) - A series of numpy arrays of type int32, one for each chromosome pair N and M if trans data are included, containing the observed counts for valid fend combinations. The chromosome name order specifies which axis corresponds to which chromosome.
                      * **N_by_M.expected** (*ndarray*) - A series of numpy arrays of type float32, one for each chromosome pair N and M if trans data are included, containing the expected counts for valid fend combinations. The chromosome name order specifies which axis corresponds to which chromosome.
+
+        Sparse heatmaps keep the resolution, chromosomes, and N.positions entries, covering every bin from the start to the end of each chromosome, and replace the arrays with one group per chromosome N or chromosome pair N_by_M containing only bins with non-zero observed values, in order of bin1 then bin2. Cis groups hold only the upper triangle.
+
+        :Groups: * **bin1**, **bin2** (*ndarray*) - Numpy arrays of type int32 containing the row and column bin of each entry.
+                 * **observed**, **expected** (*ndarray*) - Numpy arrays of type float32 containing the observed and expected values of each entry.
+                 * **indices** (*ndarray*) - A numpy array of type int64 with one more entry than the number of row bins, such that entries for row bin i are found from indices[i] to indices[i + 1].
         """
         history = self.history
-        history += "HiC.write_heatmap(filename='%s', binsize=%i, includetrans=%s, datatype='%s', chroms=%s, dynamically_binned=%s, minobservations=%i, searchdistance=%i, expansion_binsize=%i, removefailed=%s, format='%s')" % (filename, binsize, includetrans, datatype, str(chroms), dynamically_binned, minobservations, searchdistance, expansion_binsize, removefailed, format)
-        if format not in ['hdf5', 'txt', 'npz']:
+        history += "HiC.write_heatmap(filename='%s', binsize=%i, includetrans=%s, datatype='%s', chroms=%s, dynamically_binned=%s, minobservations=%i, searchdistance=%i, expansion_binsize=%i, removefailed=%s, format='%s', blocksize=%i)" % (filename, binsize, includetrans, datatype, str(chroms), dynamically_binned, minobservations, searchdistance, expansion_binsize, removefailed, format, blocksize)
+        if format not in ['hdf5', 'txt', 'npz', 'sparse']:
             if not self.silent:
                 print >> sys.stderr, ("Unrecognized output format. No data written.\n"),
             return None
@@ -2435,7 +2683,7 @@ class HiC(object):
                                        chroms=chroms, dynamically_binned=dynamically_binned,
                                        minobservations=minobservations, searchdistance=searchdistance,
                                        expansion_binsize=expansion_binsize, removefailed=removefailed,
-                                       silent=self.silent, history=history, format=format)
+                                       silent=self.silent, history=history, format=format, blocksize=blocksize)
         return None
 
     def write_multiresolution_heatmap(self, filename, datatype='fend', maxbinsize=1280000, minbinsize=5000,
@@ -2444,6 +2692,8 @@ class HiC(object):
         """
         Create a multi-resolution heatmap file containing data for each requested chromosome. This function is MPI-compatible.
 
+        Each chromosome and chromosome pair heatmap is calculated independently, with the largest heatmaps handed out first to whichever process has the least estimated work. Finished heatmaps are written to temporary part files next to 'filename' and concatenated in order once the header has been written, so only one heatmap is held in memory at a time by each process.
+
         :param filename: Location to write the multi-resolution heamtap to.
         :type filename: str.
         :param datatype: This specifies the type of data that is processed and returned. Options are 'raw', 'distance', 'fend', and 'enrichment'. Observed values are always in the first index along the last axis. If 'raw' is specified, unfiltered fends return value of one. Expected values are returned for 'distance', 'fend', 'enrichment', and 'expected' values of 'datatype'. 'distance' uses only the expected signal given distance for calculating the expected values, 'fend' uses only fend correction values, and 'enrichment' uses both correction and distance mean values.
@@ -2515,6 +2765,12 @@ class HiC(object):
 
         Each data array starts with a flattened array of the complete heatmap with the largest bin size. Intra-chromosomal heatmaps are upper-triangle arrays including the diagonal while inter-chromosomal arrays are rectangles. For each bin, there is a corresponding position in the index array pointing to the start index in the data array for the interactions contained within the data bin, partitioned into smaller bin sizes. Bins are always partitioned by a factor of 2. If none of the partitioned bins pass the minimum observation threshold, the index is -1. The shape array contains an interger indicating the number and position of valid bins (and therefore the number of bins, starting with the index number, containing data underneath the higher-level bin). Shape values are converted from a binary number with each bit representing whether or not each subpartition contains valid data, going left to right for the top row and then the bottom row. So a subdivision containing only data in the top-left bin would have a value of 2, whereas a completely full set of subpartitions would have a value of 15. The smallest binsize data does not have corresponding positions in the index array or shape array as there are no further sub-partitionings. Indices in the index array are relative to the data array start position, given in the 'chrom index bounds' portion of the header.
         """
+        if self._use_local_processes():
+            return self._run_local_processes('write_multiresolution_heatmap', filename=filename, datatype=datatype,
+                                             maxbinsize=maxbinsize, minbinsize=minbinsize,
+                                             trans_maxbinsize=trans_maxbinsize, trans_minbinsize=trans_minbinsize,
+                                             minobservations=minobservations, chroms=chroms,
+                                             includetrans=includetrans, midbinsize=midbinsize)
         # check trans data parameters
         if trans_maxbinsize is None:
             trans_maxbinsize = maxbinsize
@@ -2582,20 +2838,36 @@ class HiC(object):
         else:
             trans_chrom_bounds = cis_chrom_bounds
             num_trans_bins = numpy.zeros(chrom_bounds.shape[0], dtype=numpy.int32)
-        # determine which chromosome multi-resolution heatmaps need to be calculated and assign to workers
+        # determine which chromosome multi-resolution heatmaps need to be calculated
         all_needed = []
+        costs = []
         for i, chrom in enumerate(chroms):
             if num_cis_bins[i] > 0:
                 all_needed.append((chrom,))
+                costs.append(num_cis_bins[i] * (num_cis_bins[i] + 1) / 2.0 * (maxbinsize / minbinsize) ** 2)
             if includetrans and num_trans_bins[i] > 0:
                 for j, chrom2 in enumerate(chroms[(i + 1):]):
                     if num_trans_bins[i + j + 1] > 0:
                         all_needed.append((chrom, chrom2))
-        node_ranges = numpy.round(numpy.linspace(0, len(all_needed), self.num_procs + 1)).astype(numpy.int32)
-        node_needed = all_needed[node_ranges[self.rank]:node_ranges[self.rank + 1]]
+                        costs.append(float(num_trans_bins[i]) * num_trans_bins[i + j + 1] *
+                                     (trans_maxbinsize / trans_minbinsize) ** 2)
+        # assign heatmaps to workers, largest first, to whichever worker has the least estimated work so far
+        node_needed = [[] for i in range(self.num_procs)]
+        node_costs = numpy.zeros(self.num_procs, dtype=numpy.float64)
+        for i in numpy.argsort(-numpy.array(costs, dtype=numpy.float64), kind='mergesort'):
+            node = numpy.argmin(node_costs)
+            node_needed[node].append(i)
+            node_costs[node] += costs[i]
+        for i in range(self.num_procs):
+            node_needed[i].sort()
+        # forked local processes share a filesystem with the root process and can write their own part files,
+        # while MPI workers pass their heatmaps to the root process to be written
+        local_files = self.num_procs == 1 or isinstance(self.comm, _PipeComm)
         # produce multi-resolution heatmaps for each chromosome or pair of chromosomes
+        summaries = {}
         results = {}
-        for needed in node_needed:
+        for index in node_needed[self.rank]:
+            needed = all_needed[index]
             chrom1 = needed[0]
             chrint1 = chr2int[chrom1]
             if len(needed) == 1:
@@ -2615,27 +2887,41 @@ class HiC(object):
                 stop2 = trans_chrom_bounds[chrint2, 1]
                 minbin = trans_minbinsize
                 maxbin = trans_maxbinsize
-            # results are returned as a list containing the flattened data array and the flattened index array
-            results[needed] = hic_binning.find_multiresolution_heatmap(self, chrom=chrom1, chrom2=chrom2, start=start1,
-                              stop=stop1, start2=start2, stop2=stop2, minbinsize=minbin, maxbinsize=maxbin,
-                              minobservations=minobservations, datatype=datatype, midbinsize=midbinsize, silent=False)
-        # pass all results to the root node for writing to file
+            # results are returned as a list containing the flattened data, index, and shape arrays
+            result = hic_binning.find_multiresolution_heatmap(self, chrom=chrom1, chrom2=chrom2, start=start1,
+                     stop=stop1, start2=start2, stop2=stop2, minbinsize=minbin, maxbinsize=maxbin,
+                     minobservations=minobservations, datatype=datatype, midbinsize=midbinsize, silent=self.silent)
+            if local_files or self.rank == 0:
+                summaries[index] = _write_multiresolution_part("%s.part%i" % (filename, index), result)
+            else:
+                results[index] = result
+            del result
+        # pass part summaries (or, under MPI, complete heatmaps) to the root node
         if self.rank == 0:
             for i in range(1, self.num_procs):
-                for j in range(node_ranges[i], node_ranges[i + 1]):
-                    results[all_needed[j]] = self.comm.recv(source=i, tag=11)
+                for index in node_needed[i]:
+                    if local_files:
+                        summaries[index] = self.comm.recv(source=i, tag=11)
+                    else:
+                        summaries[index] = _write_multiresolution_part("%s.part%i" % (filename, index),
+                                                                       self.comm.recv(source=i, tag=11))
         else:
-            for i in range(node_ranges[self.rank], node_ranges[self.rank + 1]):
-                self.comm.send(results[all_needed[i]], dest=0, tag=11)
-                del results[all_needed[i]]
+            for index in node_needed[self.rank]:
+                if local_files:
+                    self.comm.send(summaries[index], dest=0, tag=11)
+                else:
+                    self.comm.send(results[index], dest=0, tag=11)
+                    del results[index]
             return None
+        needed_indices = {}
+        for i, needed in enumerate(all_needed):
+            needed_indices[needed] = i
         # calculate header size
         magic_number_size = 4 # 8 4-bit hexadecimals = 4 bytes
         name_sizes = numpy.zeros(n_chroms, dtype=numpy.int32)
         for i, chrom in enumerate(chroms):
             name_sizes[i] = len(chrom)
         int_float_size = 4 # size of int32 and float32
-        short_size = 2 # size of int32 and float32
         if includetrans:
             num_chrom_pairings = (n_chroms * (n_chroms + 1)) / 2
             repeated = 2
@@ -2667,32 +2953,18 @@ class HiC(object):
         data_indices[0] = header_size
         pos = 0
         for i, chrom in enumerate(chroms):
-            key = (chrom,)
-            if key in results:
-                valid = numpy.where(numpy.logical_not(numpy.isnan(results[key][0])))
-                min_scores[pos] = numpy.amin(results[key][0][valid])
-                max_scores[pos] = numpy.amax(results[key][0][valid])
-                data_sizes[pos] = results[key][0].shape[0]
-                index_sizes[pos] = results[key][1].shape[0]
-                data_indices[pos + 1] = ((index_sizes[pos] + data_sizes[pos]) * int_float_size +
-                                         results[key][2].shape[0] * short_size + data_indices[pos])
-            else:
-                data_indices[pos + 1] = data_indices[pos]
-            pos += 1
+            keys = [(chrom,)]
             if includetrans:
                 for chrom2 in chroms[i + 1:]:
-                    key = (chrom, chrom2)
-                    if key in results:
-                        valid = numpy.where(numpy.logical_not(numpy.isnan(results[key][0])))
-                        min_scores[pos] = numpy.amin(results[key][0][valid])
-                        max_scores[pos] = numpy.amax(results[key][0][valid])
-                        data_sizes[pos] = results[key][0].shape[0]
-                        index_sizes[pos] = results[key][1].shape[0]
-                        data_indices[pos + 1] = ((index_sizes[pos] + data_sizes[pos]) * int_float_size +
-                                                 results[key][2].shape[0] * short_size + data_indices[pos])
-                    else:
-                        data_indices[pos + 1] = data_indices[pos]
-                    pos += 1
+                    keys.append((chrom, chrom2))
+            for key in keys:
+                if key in needed_indices:
+                    min_scores[pos], max_scores[pos], data_sizes[pos], index_sizes[pos], part_size = \
+                        summaries[needed_indices[key]]
+                    data_indices[pos + 1] = data_indices[pos] + part_size
+                else:
+                    data_indices[pos + 1] = data_indices[pos]
+                pos += 1
         # write header
         output = open(filename, 'wb')
         output.write(bytearray([int('42', 16), int('05', 16), int('42', 16), int('05', 16)]))
@@ -2719,22 +2991,259 @@ class HiC(object):
         else:
             output.write(struct.pack('>ii', maxbinsize, minbinsize))
         output.write(struct.pack('>i', minobservations))
-        # write data and indices for each chrom pairing
+        # append the data, index, and shape arrays for each chrom pairing from their part files
         for i, chrom in enumerate(chroms):
             for chrom2 in chroms[i:]:
                 if chrom == chrom2:
                     key = (chrom,)
                 else:
                     key = (chrom, chrom2)
-                if key in results:
-                    output.write(results[key][0].astype('>f4').tostring())
-                    output.write(results[key][1].astype('>i4').tostring())
-                    output.write(results[key][2].astype('>i2').tostring())
+                if key in needed_indices:
+                    part_fname = "%s.part%i" % (filename, needed_indices[key])
+                    part = open(part_fname, 'rb')
+                    shutil.copyfileobj(part, output)
+                    part.close()
+                    os.remove(part_fname)
         output.close()
         if not self.silent:
             print >> sys.stderr, ("Done\n"),
         return None
 
+    def export_cooler(self, filename, binsize=10000, chroms=None, zoomify=True, blocksize=10000000):
+        """
+        Write raw interaction counts to a cooler-formatted HDF5 file, optionally as a multi-resolution pyramid.
+
+        Pixels are summed from the interaction data a block of bins at a time and appended to the file, so memory use is bounded by 'blocksize' rather than by the size of any heatmap. Each coarser resolution is found by summing pairs of bins of the previous resolution as it is read back from the file, rather than by returning to the interaction data. Interactions involving filtered fends are left out. If fend corrections are available, each resolution includes a 'weight' bin column holding the inverse of the summed corrections of each bin, scaled to a mean of one, such that balanced values are count * weight1 * weight2.
+
+        :param filename: Location to write the cooler file to.
+        :type filename: str.
+        :param binsize: The bin size of the highest resolution.
+        :type binsize: int.
+        :param chroms: A list of chromosomes to include. If None or empty, all chromosomes are included.
+        :type chroms: list
+        :param zoomify: If True, resolutions are doubled from 'binsize' until the whole genome fits in 256 bins and each is written to a group named for its zoom level, '0' being the coarsest, as read by HiGlass. The file attribute 'max-zoom' gives the finest zoom level and each zoom level attribute gives its bin size. Otherwise a single resolution is written at the root of the file.
+        :type zoomify: bool.
+        :param blocksize: The approximate number of interactions or pixels to sum at a time.
+        :type blocksize: int.
+        :returns: None
+        """
+        if chroms is None or len(chroms) == 0:
+            chroms = list(self.fends['chromosomes'][...])
+        # keep project order so bins increase with fend indices
+        chroms = [chrom for chrom in self.fends['chromosomes'][...] if chrom in chroms]
+        if self.binned is not None:
+            chr_indices = self._find_fend_array('bin_indices')
+            mids = self._find_fend_array('bins', 'mid')
+            stops = self._find_fend_array('bins', 'stop')
+        else:
+            chr_indices = self._find_fend_array('chr_indices')
+            mids = self._find_fend_array('fends', 'mid')
+            stops = self._find_fend_array('fends', 'stop')
+        lengths = numpy.zeros(len(chroms), dtype=numpy.int64)
+        for i, chrom in enumerate(chroms):
+            chrint = self.chr2int[chrom]
+            if 'chrom_sizes' in self.fends:
+                lengths[i] = self.fends['chrom_sizes'][chrint]
+            elif chr_indices[chrint + 1] > chr_indices[chrint]:
+                lengths[i] = stops[chr_indices[chrint + 1] - 1]
+        lengths = numpy.maximum(lengths, 1)
+        num_res = 1
+        if zoomify:
+            while 256 * binsize * 2 ** (num_res - 1) < numpy.sum(lengths):
+                num_res += 1
+        corrections = self['corrections']
+        assembly = os.path.basename(self.fendfilename).split('_')[0]
+        if not self.silent:
+            print >> sys.stderr, ("Exporting cooler file..."),
+        output = h5py.File(filename, 'w')
+        if zoomify:
+            output.attrs['max-zoom'] = num_res - 1
+        cis_indices = self.data['cis_indices'][...].astype(numpy.int64)
+        trans_indices = self.data['trans_indices'][...].astype(numpy.int64)
+        previous = None
+        for i in range(num_res):
+            res = binsize * 2 ** i
+            if not self.silent:
+                print >> sys.stderr, ("\r%s\rExporting cooler file... %i bp resolution") % (' ' * 80, res),
+            offsets = numpy.r_[0, numpy.cumsum((lengths - 1) / res + 1)].astype(numpy.int64)
+            num_bins = offsets[-1]
+            mapping = numpy.zeros(mids.shape[0], dtype=numpy.int64) - 1
+            for j, chrom in enumerate(chroms):
+                chrint = self.chr2int[chrom]
+                mapping[chr_indices[chrint]:chr_indices[chrint + 1]] = (
+                    mids[chr_indices[chrint]:chr_indices[chrint + 1]] / res + offsets[j])
+            mapping[numpy.where(self.filter == 0)[0]] = -1
+            if zoomify:
+                group = output.create_group(str(num_res - i - 1))
+                output.attrs[str(num_res - i - 1)] = res
+            else:
+                group = output
+            weights = self._write_cooler_bins(group, chroms, lengths, offsets, res, mapping, corrections)
+            if previous is None:
+                # sum interactions for blocks of bins, using the first fend of each bin to split the data
+                first_fends = numpy.zeros(num_bins + 1, dtype=numpy.int64)
+                for j, chrom in enumerate(chroms):
+                    chrint = self.chr2int[chrom]
+                    first_fends[offsets[j]:offsets[j + 1]] = chr_indices[chrint] + numpy.searchsorted(
+                        mids[chr_indices[chrint]:chr_indices[chrint + 1]],
+                        numpy.arange(offsets[j + 1] - offsets[j]) * res)
+                    first_fends[offsets[j + 1]] = chr_indices[chrint + 1]
+                row_bounds = cis_indices[first_fends] + trans_indices[first_fends]
+
+                def load(start, stop):
+                    bin1 = []
+                    bin2 = []
+                    counts = []
+                    # fends of excluded chromosomes falling between bins are read but have no bins
+                    startfend = first_fends[start]
+                    stopfend = first_fends[stop]
+                    for name, indices in [['cis', cis_indices], ['trans', trans_indices]]:
+                        if indices[stopfend] == indices[startfend]:
+                            continue
+                        data = self.data['%s_data' % name][indices[startfend]:indices[stopfend], :]
+                        valid = numpy.where((mapping[data[:, 0]] >= 0) & (mapping[data[:, 1]] >= 0))[0]
+                        bin1.append(mapping[data[valid, 0]])
+                        bin2.append(mapping[data[valid, 1]])
+                        counts.append(data[valid, 2])
+                    return bin1, bin2, counts
+            else:
+                # sum pairs of bins from the previous resolution, read back from the file
+                prev_group, prev_offsets = previous
+                prev_bins = prev_offsets[-1]
+                prev_chroms = numpy.repeat(numpy.arange(len(chroms)), prev_offsets[1:] - prev_offsets[:-1])
+                parents = (numpy.arange(prev_bins) - prev_offsets[prev_chroms]) / 2 + offsets[prev_chroms]
+                first_children = numpy.searchsorted(parents, numpy.arange(num_bins + 1))
+                prev_indices = prev_group['indexes/bin1_offset'][...]
+                row_bounds = prev_indices[first_children]
+
+                def load(start, stop):
+                    pixels = prev_group['pixels']
+                    start_index = row_bounds[start]
+                    stop_index = row_bounds[stop]
+                    return ([parents[pixels['bin1_id'][start_index:stop_index]]],
+                            [parents[pixels['bin2_id'][start_index:stop_index]]],
+                            [pixels['count'][start_index:stop_index]])
+            self._write_cooler_pixels(group, offsets, row_bounds, load, weights, blocksize)
+            group.attrs['bin-size'] = res
+            group.attrs['bin-type'] = 'fixed'
+            group.attrs['creation-date'] = str(datetime.datetime.now())
+            group.attrs['format'] = "HDF5::Cooler"
+            group.attrs['format-url'] = "https://github.com/mirnylab/cooler"
+            group.attrs['format-version'] = 2
+            group.attrs['generated-by'] = 'hifive'
+            group.attrs['genome-assembly'] = assembly
+            group.attrs['metadata'] = '{}'
+            group.attrs['nbins'] = num_bins
+            group.attrs['nchroms'] = len(chroms)
+            group.attrs['id'] = 'null'
+            previous = (group, offsets)
+        output.close()
+        if not self.silent:
+            print >> sys.stderr, ("\r%s\rExporting cooler file... Done\n") % (' ' * 80),
+        return None
+
+    def _write_cooler_bins(self, group, chroms, lengths, offsets, res, mapping, corrections):
+        """Write the chroms and bins tables of one cooler resolution and return the bin weights (None without fend corrections)."""
+        chr2int = {}
+        for i, chrom in enumerate(chroms):
+            chr2int[chrom] = i
+        num_bins = offsets[-1]
+        chroms_group = group.create_group('chroms')
+        chroms_group.create_dataset('name', data=numpy.array(chroms, dtype='S32'), compression='gzip',
+                                    compression_opts=6)
+        chroms_group.create_dataset('length', data=lengths.astype(numpy.int32), compression='gzip',
+                                    compression_opts=6)
+        bins_group = group.create_group('bins')
+        bins_group.create_dataset('chrom', data=numpy.repeat(numpy.arange(len(chroms)),
+                                                             offsets[1:] - offsets[:-1]).astype(numpy.int32),
+                                  dtype=h5py.special_dtype(enum=('i', chr2int)), compression='gzip',
+                                  compression_opts=6)
+        starts = numpy.zeros(num_bins, dtype=numpy.int32)
+        for i in range(len(chroms)):
+            starts[offsets[i]:offsets[i + 1]] = numpy.arange(offsets[i + 1] - offsets[i]) * res
+        stops = starts + res
+        stops[offsets[1:] - 1] = numpy.minimum(stops[offsets[1:] - 1], lengths)
+        bins_group.create_dataset('start', data=starts, compression='gzip', compression_opts=6)
+        bins_group.create_dataset('end', data=stops, compression='gzip', compression_opts=6)
+        group.create_group('indexes').create_dataset('chrom_offset', data=offsets, compression='gzip',
+                                                     compression_opts=6)
+        if corrections is None:
+            return None
+        valid = numpy.where(mapping >= 0)[0]
+        weights = numpy.bincount(mapping[valid], weights=corrections[valid], minlength=num_bins)
+        where = numpy.where(weights > 0)[0]
+        weights[where] = numpy.mean(weights[where]) / weights[where]
+        weights[numpy.where(weights <= 0)[0]] = numpy.nan
+        bins_group.create_dataset('weight', data=weights, compression='gzip', compression_opts=6)
+        return weights
+
+    def _write_cooler_pixels(self, group, offsets, row_bounds, load, weights, blocksize):
+        """Sum pixels for blocks of rows returned by 'load' and append them and the bin1 offset index to 'group'."""
+        num_bins = offsets[-1]
+        pixels = group.create_group('pixels')
+        datasets = {}
+        for name, dtype in [['bin1_id', numpy.int64], ['bin2_id', numpy.int64], ['count', numpy.int32]]:
+            datasets[name] = pixels.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                   chunks=(65536,), compression='gzip', compression_opts=6)
+        bin_counts = numpy.zeros(num_bins, dtype=numpy.int64)
+        # running total, sum of squares, minimum, and maximum of balanced intra-chromosomal values
+        stats = [0, 0.0, 0.0, numpy.inf, -numpy.inf]
+        total = 0
+        pos = 0
+        start = 0
+        while start < num_bins:
+            stop = numpy.searchsorted(row_bounds, row_bounds[start] + blocksize, side='right') - 1
+            stop = min(num_bins, max(start + 1, stop))
+            bin1, bin2, counts = load(start, stop)
+            if len(bin1) > 0:
+                keys = numpy.hstack(bin1) * num_bins + numpy.hstack(bin2)
+                counts = numpy.hstack(counts).astype(numpy.int64)
+                del bin1, bin2
+            else:
+                keys = numpy.zeros(0, dtype=numpy.int64)
+            if keys.shape[0] > 0:
+                order = numpy.argsort(keys)
+                keys = keys[order]
+                counts = counts[order]
+                del order
+                run_starts = numpy.r_[0, numpy.where(keys[1:] != keys[:-1])[0] + 1]
+                counts = numpy.add.reduceat(counts, run_starts)
+                keys = keys[run_starts]
+                del run_starts
+                bin1 = keys / num_bins
+                bin2 = keys % num_bins
+                del keys
+                for name, values in [['bin1_id', bin1], ['bin2_id', bin2], ['count', counts]]:
+                    datasets[name].resize((pos + values.shape[0],))
+                    datasets[name][pos:] = values
+                pos += bin1.shape[0]
+                total += numpy.sum(counts)
+                bin_counts[start:stop] = numpy.bincount(bin1 - start, minlength=(stop - start))
+                if weights is not None:
+                    cis = numpy.where(numpy.searchsorted(offsets, bin1, side='right') ==
+                                      numpy.searchsorted(offsets, bin2, side='right'))[0]
+                    balanced = counts[cis] * weights[bin1[cis]] * weights[bin2[cis]]
+                    balanced = balanced[numpy.where(numpy.logical_not(numpy.isnan(balanced)))[0]]
+                    if balanced.shape[0] > 0:
+                        stats[0] += balanced.shape[0]
+                        stats[1] += numpy.sum(balanced)
+                        stats[2] += numpy.sum(balanced ** 2.0)
+                        stats[3] = min(stats[3], numpy.amin(balanced))
+                        stats[4] = max(stats[4], numpy.amax(balanced))
+                del bin1, bin2, counts
+            start = stop
+        group['indexes'].create_dataset('bin1_offset', data=numpy.r_[0, numpy.cumsum(bin_counts)],
+                                        compression='gzip', compression_opts=6)
+        group.attrs['nnz'] = pos
+        group.attrs['sum'] = total
+        if stats[0] > 0:
+            mean = stats[1] / stats[0]
+            group.attrs['min_value'] = stats[3]
+            group.attrs['max_value'] = stats[4]
+            group.attrs['mean_value'] = mean
+            group.attrs['sd_value'] = max(0.0, stats[2] / stats[0] - mean ** 2.0) ** 0.5
+        return None
+
     def calculate_quality(self, filename, resolution=1000000, coverage=[1.0, 0.5, 0.25, 0.12, 0.06],
                           noise=[1.0, 0.75, 0.5, 0.25, 0.0], chroms=[]):
         """
@@ -2744,6 +3253,8 @@ class HiC(object):
 
         In order to make the quality metric more robust, values are calculated for several different coverage and noise values. Low-coverage datasets are generated by randomly removing reads. Noise is modeled as a combination of the overall distance dependence curve and bin-specific correction values found from the matrix balancing. The final quality metric is calculated by finding the overall linear regression line slope across all coverage and noise combinations, finding the 100% coverage intercept using the calculated slope, and finding the 0% noise value. This step adds slight improvements over noise injected to 100% coverage data and the original quality metric.
 
+        Coverage and noise combinations are split across MPI ranks or, without MPI, the number of local processes given when the project was opened. Combinations are grouped by chromosome so that each process reads a chromosome's data and finds its noise model only once.
+
         :param filename: The name of the file to write the results to.
         :type filename: str.
         :param resolution: The size of bins to partition the genome into prior to calculating the quality values.
@@ -2755,6 +3266,9 @@ class HiC(object):
         :param chroms: A list of chromosome name to calculate quality scores for.
         :type chroms: list
         """
+        if self._use_local_processes():
+            return self._run_local_processes('calculate_quality', filename=filename, resolution=resolution,
+                                             coverage=coverage, noise=noise, chroms=chroms)
         if isinstance(chroms, str):
             chroms = [chroms]
         if len(chroms) == 0:
@@ -2766,30 +3280,39 @@ class HiC(object):
                     needed.append((chrom, cov, noi))
         node_ranges = numpy.round(numpy.linspace(0, len(needed), self.num_procs + 1)).astype(numpy.int32)
         results = numpy.zeros((len(chroms), len(coverage), len(noise)), dtype=numpy.float64)
+        if self.binned is not None:
+            chr_indices = self._find_fend_array('bin_indices')
+            fends = self._find_fend_array('bins')
+        else:
+            chr_indices = self._find_fend_array('chr_indices')
+            fends = self._find_fend_array('fends')
+        filt = self.filter[...]
+        # combinations are grouped by chromosome, so each chromosome's binned reads and background model are only
+        # found once per process and reused for all of its coverage and noise levels
+        current_chrom = None
         for chrom, cov, noi in needed[node_ranges[self.rank]:node_ranges[self.rank + 1]]:
-            chrint = self.chr2int[chrom]
-            if self.binned is not None:
-                chr_indices = self.fends['bin_indices'][...]
-                fends = self.fends['bins'][...]
-            else:
-                chr_indices = self.fends['chr_indices'][...]
-                fends = self.fends['fends'][...]
-            start_i = self.data['cis_indices'][chr_indices[chrint]]
-            stop_i = self.data['cis_indices'][chr_indices[chrint + 1]]
-            counts = self.data['cis_data'][...][start_i:stop_i, :]
-            counts = counts[numpy.where(self.filter[counts[:, 0]] * self.filter[counts[:, 1]])[0], :]
-            start = (fends['start'][chr_indices[chrint]] / resolution) * resolution
-            stop = ((fends['stop'][chr_indices[chrint + 1] - 1] - 1) / resolution + 1) * resolution
-            counts[:, 0] = (fends['mid'][counts[:, 0]] - start) / resolution
-            counts[:, 1] = (fends['mid'][counts[:, 1]] - start) / resolution
-            N = (stop - start) / resolution
+            if chrom != current_chrom:
+                current_chrom = chrom
+                chrint = self.chr2int[chrom]
+                chrom_counts = self._find_data_slice('cis', chr_indices[chrint], chr_indices[chrint + 1])[1]
+                chrom_counts = chrom_counts[numpy.where(filt[chrom_counts[:, 0]] * filt[chrom_counts[:, 1]])[0], :]
+                start = (fends['start'][chr_indices[chrint]] / resolution) * resolution
+                stop = ((fends['stop'][chr_indices[chrint + 1] - 1] - 1) / resolution + 1) * resolution
+                chrom_counts[:, 0] = (fends['mid'][chrom_counts[:, 0]] - start) / resolution
+                chrom_counts[:, 1] = (fends['mid'][chrom_counts[:, 1]] - start) / resolution
+                num_bins = (stop - start) / resolution
+                noise_expected = None
+            if chrom_counts.shape[0] == 0:
+                continue
+            counts = numpy.copy(chrom_counts)
+            N = num_bins
             current_count = numpy.sum(counts[:, 2])
             total_target = int(round(current_count * cov))
             cov_target = int(round(total_target * (1.0 - noi)))
             noise_target = total_target - cov_target
 
             # if needed, find bg prob model
-            if noi > 0.0:
+            if noi > 0.0 and noise_expected is None:
                 data = numpy.zeros((N, N, 2), dtype=numpy.float64)
                 data[:, :, 0] = numpy.bincount(counts[:, 0] * N + counts[:, 1], weights=counts[:, 2],
                                                minlength=(N*N)).reshape(N, N)
@@ -2837,54 +3360,16 @@ class HiC(object):
                 expected = numpy.exp(expected)
                 expected[invalid_rows, :] = 0
                 expected[:, invalid_rows] = 0
-                indices = numpy.triu_indices(N, 0)
-                expected = expected[indices]
-                expected /= numpy.sum(expected)
-                for i in range(1, expected.shape[0]):
-                    expected[i] += expected[i - 1]
+                noise_indices = numpy.triu_indices(N, 0)
+                noise_expected = numpy.cumsum(expected[noise_indices] / numpy.sum(expected[noise_indices]))
                 del data
 
-            # randomly select reads to remove to lower coverage
-            if cov_target < 0.5 * current_count:
-                target_reads = cov_target
-            else:
-                target_reads = current_count - cov_target
-            reads = {}
-            while len(reads) < target_reads:
-                possible_reads = numpy.random.randint(0, current_count, 5000000)
-                for read in possible_reads:
-                    if len(reads) < target_reads and read not in reads:
-                        reads[read] = None
-            reads = reads.keys()
-            reads.sort()
-
-            # adjust reads and put into square matrix
-            pos = 0
-            count = counts[0, 2]
+            # randomly select reads to keep to lower coverage and put into square matrix
+            if cov_target < current_count:
+                counts[:, 2] = _downsample_counts(counts[:, 2], cov_target)
             data = numpy.zeros((N, N), dtype=numpy.int32)
-            if cov_target == current_count:
-                for i in range(counts.shape[0]):
-                    data[counts[i, 0], counts[i, 1]] += counts[i, 2]
-            elif cov_target < 0.5 * current_count:
-                for j in reads:
-                    while count <= j:
-                        pos += 1
-                        count += counts[pos, 2]
-                    data[counts[pos, 0], counts[pos, 1]] += 1
-                    if not self.silent and self.rank == 0:
-                        print >> sys.stderr, ("\r%s\t%07i of %07i") % (chrom, j, current_count),
-            else:
-                for j in reads:
-                    while count <= j:
-                        data[counts[pos, 0], counts[pos, 1]] += counts[pos, 2]
-                        pos += 1
-                        count += counts[pos, 2]
-                    counts[pos, 2] -= 1
-                    if not self.silent and self.rank == 0:
-                        print >> sys.stderr, ("\r%s\t%07i of %07i") % (chrom, j, current_count),
-                while pos < data.shape[0]:
-                    data[counts[pos, 0], counts[pos, 1]] += counts[pos, 2]
-                    pos += 1
+            data[:, :] = numpy.bincount(counts[:, 0] * N + counts[:, 1], weights=counts[:, 2],
+                                        minlength=(N * N)).reshape(N, N)
             del counts
             cov_count = numpy.sum(data)
 
@@ -2892,11 +3377,8 @@ class HiC(object):
             if noise_target > 0:
                 reads = numpy.random.rand(noise_target)
                 reads.sort()
-                read_indices = numpy.r_[0, numpy.searchsorted(reads, expected)]
-                for j in range(read_indices.shape[0] - 1):
-                    data[indices[0][j], indices[1][j]] += read_indices[j + 1] - read_indices[j]
-                    if not self.silent and self.rank == 0:
-                        print >> sys.stderr, ("\r%s\t%07i of %07i") % (chrom, j, read_indices.shape[0]),
+                read_indices = numpy.r_[0, numpy.searchsorted(reads, noise_expected)]
+                data[noise_indices] += read_indices[1:] - read_indices[:-1]
             noise_count = numpy.sum(data)
             data += data.T
 
@@ -3059,7 +3541,7 @@ class HiC(object):
                 fends = hic.fends['fends'][...]
             start_i = hic.data['cis_indices'][chr_indices[chrint]]
             stop_i = hic.data['cis_indices'][chr_indices[chrint + 1]]
-            counts = hic.data['cis_data'][...][start_i:stop_i, :]
+            counts = hic.data['cis_data'][start_i:stop_i, :]
             counts = counts[numpy.where(hic.filter[counts[:, 0]] * hic.filter[counts[:, 1]])[0], :]
             start = (fends['start'][chr_indices[chrint]] / resolution) * resolution
             stop = ((fends['stop'][chr_indices[chrint + 1] - 1] - 1) / resolution + 1) * resolution
@@ -3201,3 +3683,47 @@ class HiC(object):
         else:
             self.comm.send(results, dest=0, tag=11)
 
+
+def _run_local_rank(hic, name, rank, connections, kwargs):
+    """Run one non-root rank of an MPI-compatible HiC method in a forked process."""
+    for i in range(len(connections)):
+        connections[i][0].close()
+        if i != rank - 1:
+            connections[i][1].close()
+    hic.comm = _PipeComm(rank, len(connections) + 1, {0: connections[rank - 1][1]})
+    hic.rank = rank
+    hic.num_procs = len(connections) + 1
+    hic.silent = True
+    # forked processes inherit the root's random state, unlike independently started MPI ranks
+    numpy.random.seed()
+    if _openmp_started and 'threads' in kwargs:
+        kwargs['threads'] = 1
+    # reading through HDF5 handles shared with the root process can return corrupted slices, so each rank
+    # reopens the data and fend files and drops anything cached from the inherited handles
+    for key in ['data', 'fends']:
+        if isinstance(hic.__dict__.get(key), h5py.File):
+            hic[key] = _reopen_hdf5_file(hic[key])
+    hic.cache.clear()
+    getattr(hic, name)(**kwargs)
+    return None
+
+
+def _write_multiresolution_part(filename, result):
+    """Write one multi-resolution heatmap's data, index, and shape arrays to a part file and return its score range, array sizes, and size in bytes."""
+    data, indices, shapes = result[:3]
+    valid = numpy.where(numpy.logical_not(numpy.isnan(data)))
+    output = open(filename, 'wb')
+    output.write(data.astype('>f4').tostring())
+    output.write(indices.astype('>i4').tostring())
+    output.write(shapes.astype('>i2').tostring())
+    output.close()
+    return (numpy.amin(data[valid]), numpy.amax(data[valid]), data.shape[0], indices.shape[0],
+            data.shape[0] * 4 + indices.shape[0] * 4 + shapes.shape[0] * 2)
+
+
+def _note_threads(threads):
+    """Record that an OpenMP thread pool is about to be started in this process."""
+    global _openmp_started
+    if threads > 1:
+        _openmp_started = True
+    return None
@@ -91,11 +91,11 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
     chrint = hic.chr2int[chrom]
     if binned:
         includediagonal = True
-        chr_indices = hic.fends['bin_indices'][...]
-        mids = hic.fends['bins']['mid'][...]
+        chr_indices = hic._find_fend_array('bin_indices')
+        mids = hic._find_fend_array('bins', 'mid')
     else:
-        chr_indices = hic.fends['chr_indices'][...]
-        mids = hic.fends['fends']['mid'][...]
+        chr_indices = hic._find_fend_array('chr_indices')
+        mids = hic._find_fend_array('fends', 'mid')
     if maxdistance is None:
         maxdistance = 0
     # Determine start, stop, startfend, and stopfend
@@ -146,16 +146,13 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
         return None
     # If datatype is not 'expected', pull the needed slice of data
     if datatype != 'expected':
-        start_index = hic.data['cis_indices'][startfend]
-        stop_index = hic.data['cis_indices'][stopfend]
-        if start_index == stop_index:
+        data_indices, data = hic._find_data_slice('cis', startfend, stopfend)
+        if data.shape[0] == 0:
             if not silent:
                 print >> sys.stderr, ("Insufficient data\n"),
             return None
-        data_indices = hic.data['cis_indices'][startfend:(stopfend + 1)]
         # remap data indices
         data_indices -= data_indices[0]
-        data = hic.data['cis_data'][start_index:stop_index, :]
         # remap fends
         data[:, :2] -= startfend
     # map fends to cis array bins, with -1 indicating invalid fend
@@ -184,11 +181,11 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
             # find binbounds
             binbounds = numpy.zeros((num_bins, 2), dtype=numpy.int32) - 1
             if binned:
-                starts = hic.fends['bins']['start'][startfend:stopfend]
-                stops = hic.fends['bins']['stop'][startfend:stopfend]
+                starts = hic._find_fend_array('bins', 'start')[startfend:stopfend]
+                stops = hic._find_fend_array('bins', 'stop')[startfend:stopfend]
             else:
-                starts = hic.fends['fends']['start'][startfend:stopfend]
-                stops = hic.fends['fends']['stop'][startfend:stopfend]
+                starts = hic._find_fend_array('fends', 'start')[startfend:stopfend]
+                stops = hic._find_fend_array('fends', 'stop')[startfend:stopfend]
             if skipfiltered:
                 binbounds[:, 0] = starts[valid]
                 binbounds[:, 1] = stops[valid]
@@ -205,6 +202,7 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
             binbounds[:, 1] = numpy.arange(1, num_bins + 1) * binsize + start
     # if correction is requested, determine the appropriate type
     distance_parameters = None
+    distance_table = None
     chrom_mean = 0.0
     corrections = None
     correction_sums = None
@@ -243,6 +241,10 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
     # if accounting for distance, get distance parameters
     if datatype in ['distance', 'enrichment', 'expected']:
         distance_parameters = hic.distance_parameters
+        if binned:
+            distance_table = hic._find_distance_table(hic.binned)
+        else:
+            distance_table = hic._find_distance_table()
         chrom_mean = hic.chromosome_means[chrint]
     # If proportional binning is requested
     ranges = None
@@ -277,12 +279,13 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
     if arraytype == 'compact':
         if binned:
             _hic_binning.find_binned_cis_compact_expected(mapping, corrections, mids, distance_parameters,
-                                                          data_array, correction_sums, chrom_mean, startfend, 
+                                                          distance_table, hic.binned, data_array,
+                                                          correction_sums, chrom_mean, startfend,
                                                           maxdistance)
         else:
             _hic_binning.find_cis_compact_expected(mapping, corrections, binning_corrections,
                                                    binning_num_bins, fend_indices, mids, distance_parameters,
-                                                   data_array, correction_sums, ranges, overlap,
+                                                   distance_table, data_array, correction_sums, ranges, overlap,
                                                    chrom_mean, startfend, maxdistance, int(includediagonal))
         if datatype != 'expected':
             _hic_binning.find_cis_compact_observed(data, data_indices, mapping, mids, data_array,
@@ -294,19 +297,20 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
                 correction_sums = numpy.bincount(mapping[valid], minlength=num_bins).astype(numpy.float32)
             corrections.fill(0)
             corrections[valid] = 1.0
-            _hic_binning.find_cis_compact_expected(mapping, corrections, None, None, None, mids, None,
+            _hic_binning.find_cis_compact_expected(mapping, corrections, None, None, None, mids, None, None,
                                                    data_array, correction_sums, ranges, overlap,
                                                    chrom_mean, startfend, maxdistance, int(includediagonal))
             data_array = data_array[:, :, ::-1]
     else:
         if binned:
             _hic_binning.find_binned_cis_upper_expected(mapping, corrections, mids, distance_parameters,
-                                                        data_array, correction_sums, chrom_mean, startfend, 
+                                                        distance_table, hic.binned, data_array,
+                                                        correction_sums, chrom_mean, startfend,
                                                         maxdistance)
         else:
             _hic_binning.find_cis_upper_expected(mapping, corrections, binning_corrections,
                                                  binning_num_bins, fend_indices, mids, distance_parameters,
-                                                 data_array, correction_sums, ranges, overlap,
+                                                 distance_table, data_array, correction_sums, ranges, overlap,
                                                  chrom_mean, startfend, maxdistance, int(includediagonal))
         if datatype != 'expected':
             _hic_binning.find_cis_upper_observed(data, data_indices, mapping, mids, data_array,
@@ -318,7 +322,7 @@ def find_cis_signal(hic, chrom, binsize=10000, binbounds=None, start=None, stop=
                 correction_sums = numpy.bincount(mapping[valid], minlength=num_bins).astype(numpy.float64)
             corrections.fill(0)
             corrections[valid] = 1.0
-            _hic_binning.find_cis_upper_expected(mapping, corrections, None, None, None, mids, None,
+            _hic_binning.find_cis_upper_expected(mapping, corrections, None, None, None, mids, None, None,
                                                  data_array, correction_sums, ranges, overlap,
                                                  chrom_mean, startfend, maxdistance, int(includediagonal))
             data_array = data_array[:, ::-1]
@@ -390,13 +394,14 @@ def _upper_to_compact(array, maxbins=0, binned=False):
 def _find_fend_from_coord(hic, chrint, coord):
     """Find the next fend after the coordinate on chromosome 'chrint'."""
     if hic.binned is not None:
-        first_fend = hic.fends['bin_indices'][chrint]
-        last_fend = hic.fends['bin_indices'][chrint + 1]
-        return numpy.searchsorted(hic.fends['bins']['mid'][first_fend:last_fend], coord) + first_fend
-    else:
-        first_fend = hic.fends['chr_indices'][chrint]
-        last_fend = hic.fends['chr_indices'][chrint + 1]
-        return numpy.searchsorted(hic.fends['fends']['mid'][first_fend:last_fend], coord) + first_fend
+        chr_indices = hic._find_fend_array('bin_indices')
+        mids = hic._find_fend_array('bins', 'mid')
+    else:
+        chr_indices = hic._find_fend_array('chr_indices')
+        mids = hic._find_fend_array('fends', 'mid')
+    first_fend = chr_indices[chrint]
+    last_fend = chr_indices[chrint + 1]
+    return numpy.searchsorted(mids[first_fend:last_fend], coord) + first_fend
 
 def bin_cis_array(data_array, data_mapping, binsize=10000, binbounds=None, start=None, stop=None, arraytype='full',
                   returnmapping=False, diagonal_included=False, **kwargs):
@@ -786,7 +791,7 @@ def find_cis_subregion_signal(hic, chrom, binsize=10000, binbounds1=None, binbou
             print >> sys.stderr, ("Insufficient data\n"),
         return None
     # If correction is required, determine what type and get appropriate data
-    if hic.normalization != 'binning' and datatype != 'raw':
+    if hic.normalization != 'binning' and datatype not in ['raw', 'distance']:
         corrections1 = hic.corrections[startfend1:stopfend1]
         corrections2 = hic.corrections[startfend2:stopfend2]
     elif datatype == 'raw':
@@ -819,17 +824,19 @@ def find_cis_subregion_signal(hic, chrom, binsize=10000, binbounds1=None, binbou
         fend_indices = None
     # if accounting for distance, get distance parameters
     distance_parameters = None
+    distance_table = None
     chrom_mean = 0.0
     if datatype in ['distance', 'enrichment', 'expected']:
         distance_parameters = hic.distance_parameters
+        distance_table = hic._find_distance_table()
         chrom_mean = hic.chromosome_means[chrint]
     # Create data array
     data_array = numpy.zeros((num_bins1, num_bins2, 2), dtype=numpy.float32)
     # Fill in data values
     _hic_binning.find_cis_subregion_expected(mapping1, mapping2, corrections1, corrections2, binning_corrections,
                                              binning_num_bins, fend_indices, data_array, correction_sums1,
-                                             correction_sums2, mids1, mids2, distance_parameters, chrom_mean,
-                                             startfend1, startfend2)
+                                             correction_sums2, mids1, mids2, distance_parameters, distance_table,
+                                             chrom_mean, startfend1, startfend2)
     if datatype != 'expected':
         _hic_binning.find_cis_subregion_observed(mapping1, mapping2, data, data_indices, data_array, startfend1,
                                                  startfend2)
@@ -844,7 +851,7 @@ def find_cis_subregion_signal(hic, chrom, binsize=10000, binbounds1=None, binbou
         correction_sums2 = None
         _hic_binning.find_cis_subregion_expected(mapping1, mapping2, corrections1, corrections2, None, None, None,
                                                  data_array, correction_sums1, correction_sums2, mids1, mids2, None,
-                                                 0.0, startfend1, startfend2)
+                                                 None, 0.0, startfend1, startfend2)
         temp = numpy.copy(data_array[:, :, 0])
         data_array[:, :, 0] = data_array[:, :, 1]
         data_array[:, :, 1] = temp
@@ -942,11 +949,11 @@ def find_trans_signal(hic, chrom1, chrom2, binsize=10000, binbounds1=None, binbo
         return None
     binned = hic.binned is not None
     if binned:
-        chr_indices = hic.fends['bin_indices'][...]
-        mids = hic.fends['bins']['mid'][...]
+        chr_indices = hic._find_fend_array('bin_indices')
+        mids = hic._find_fend_array('bins', 'mid')
     else:
-        chr_indices = hic.fends['chr_indices'][...]
-        mids = hic.fends['fends']['mid'][...]
+        chr_indices = hic._find_fend_array('chr_indices')
+        mids = hic._find_fend_array('fends', 'mid')
     # Determine start, stop, startfend, and stopfend
     chrint1 = hic.chr2int[chrom1]
     chrint2 = hic.chr2int[chrom2]
@@ -1017,21 +1024,14 @@ def find_trans_signal(hic, chrom1, chrom2, binsize=10000, binbounds1=None, binbo
     # If datatype is not 'expected', pull the needed slice of data
     if datatype != 'expected':
         if chrint1 < chrint2:
-            start_index = hic.data['trans_indices'][startfend1]
-            stop_index = hic.data['trans_indices'][stopfend1]
+            data_indices, data = hic._find_data_slice('trans', startfend1, stopfend1)
         else:
-            start_index = hic.data['trans_indices'][startfend2]
-            stop_index = hic.data['trans_indices'][stopfend2]
-        if start_index == stop_index:
+            data_indices, data = hic._find_data_slice('trans', startfend2, stopfend2)
+        if data.shape[0] == 0:
             if not silent:
                 print >> sys.stderr, ("Insufficient data\n"),
             return None
-        if chrint1 < chrint2:
-            data_indices = hic.data['trans_indices'][startfend1:(stopfend1 + 1)]
-        else:
-            data_indices = hic.data['trans_indices'][startfend2:(stopfend2 + 1)]
         data_indices -= data_indices[0]
-        data = hic.data['trans_data'][start_index:stop_index, :]
         if chrint1 < chrint2:
             data[:, 0] -= startfend1
             data[:, 1] -= startfend2
@@ -1413,7 +1413,7 @@ def dynamically_bin_trans_array(unbinned, unbinnedpositions1, unbinnedpositions2
 
 def write_heatmap_dict(hic, filename, binsize, includetrans=True, datatype='enrichment', chroms=[], 
                        dynamically_binned=False, minobservations=0, searchdistance=0, expansion_binsize=0,
-                       removefailed=False, includediagonal=False, format='hdf5', **kwargs):
+                       removefailed=False, includediagonal=False, format='hdf5', blocksize=1000, **kwargs):
     """
     Create a file containing binned interaction arrays, bin positions, and an index of included chromosomes. This function is MPI compatible.
 
@@ -1439,8 +1439,10 @@ def write_heatmap_dict(hic, filename, binsize, includetrans=True, datatype='enri
     :type expansion_binsize: int.
     :param removefailed: If a non-zero 'searchdistance' is given, it is possible for a bin not to meet the 'minobservations' criteria before stopping looking. If this occurs and 'removefailed' is True, the observed and expected values for that bin are zero.
     :type removefailed: bool.
-    :param format: A string indicating whether to save heatmaps as text matrices ('txt'), an HDF5 file of numpy arrays ('hdf5'), or a numpy npz file ('npz').
+    :param format: A string indicating whether to save heatmaps as text matrices ('txt'), an HDF5 file of numpy arrays ('hdf5'), a numpy npz file ('npz'), or an HDF5 file of non-zero bins in coordinate format ('sparse'). Sparse heatmaps are built 'blocksize' by 'blocksize' bins at a time and are not available for dynamically binned data, unbinned data, or binned projects.
     :type format: str.
+    :param blocksize: The number of bins along each axis to find at a time when writing 'sparse' heatmaps.
+    :type blocksize: int.
     :returns: None
     """
     # check if MPI is available
@@ -1456,10 +1458,14 @@ def write_heatmap_dict(hic, filename, binsize, includetrans=True, datatype='enri
         silent = True
     else:
         silent = False
-    if format not in ['hdf5', 'txt', 'npz']:
+    if format not in ['hdf5', 'txt', 'npz', 'sparse']:
         if not silent:
             print >> sys.stderr, ("Unrecognized output format. No data written.\n"),
         return None
+    if format == 'sparse' and (dynamically_binned or binsize <= 0 or blocksize <= 0 or hic.binned is not None):
+        if not silent:
+            print >> sys.stderr, ("Sparse heatmaps require a positive binsize and blocksize, no dynamic binning, and an unbinned project. No data written.\n"),
+        return None
     if hic.binned is not None:
         includediagonal=True
     # Check if trans mean is needed and calculate if not already done
@@ -1502,6 +1508,12 @@ def write_heatmap_dict(hic, filename, binsize, includetrans=True, datatype='enri
             node_needed = needed[node_ranges[0]:node_ranges[1]]
     else:
         node_needed = comm.recv(source=0, tag=11)
+    if format == 'sparse':
+        _write_sparse_heatmap_dict(hic, filename, binsize, chroms, node_needed, datatype, includediagonal, blocksize,
+                                   comm, rank, num_procs, silent, kwargs.get('history', None))
+        if not silent:
+            print >> sys.stderr, ("Creating binned heatmap...Done\n"),
+        return None
     heatmaps = {}
     # Find heatmaps
     for chrom in node_needed:
@@ -1669,6 +1681,125 @@ def write_heatmap_dict(hic, filename, binsize, includetrans=True, datatype='enri
     return None
 
 
+def _write_sparse_heatmap_dict(hic, filename, binsize, chroms, needed, datatype, includediagonal, blocksize, comm,
+                               rank, num_procs, silent, history):
+    """Write non-zero heatmap bins for each chromosome and chromosome pair in 'needed', combining parts from all nodes at node 0."""
+    if rank == 0:
+        output = h5py.File(filename, 'w')
+    else:
+        output = h5py.File('%s.part%i' % (filename, rank), 'w')
+    positions = {}
+    if rank == 0:
+        all_chroms = chroms
+    else:
+        all_chroms = list(set([chrom for pair in needed for chrom in pair]))
+    for chrom in all_chroms:
+        positions[chrom] = _find_sparse_bin_positions(hic, chrom, binsize)
+    for pair in needed:
+        _write_sparse_heatmap(hic, output, pair, positions, datatype, includediagonal, blocksize, silent)
+    if rank > 0:
+        output.close()
+        comm.send(len(needed), dest=0, tag=11)
+        return None
+    for i in range(1, num_procs):
+        if comm.recv(source=i, tag=11) == 0:
+            subprocess.call('rm %s.part%i' % (filename, i), shell=True)
+            continue
+        part = h5py.File('%s.part%i' % (filename, i), 'r')
+        for name in part.keys():
+            output.copy(part[name], name)
+        part.close()
+        subprocess.call('rm %s.part%i' % (filename, i), shell=True)
+    for chrom in chroms:
+        output.create_dataset('%s.positions' % chrom, data=positions[chrom])
+    output.create_dataset('chromosomes', data=numpy.array(chroms))
+    output.attrs['resolution'] = binsize
+    if history is not None:
+        output.attrs['history'] = history
+    output.attrs['filetype'] = 'hic_heatmap'
+    output.attrs['format'] = 'sparse'
+    output.attrs['diagonal'] = includediagonal
+    output.close()
+    return None
+
+
+def _find_sparse_bin_positions(hic, chrom, binsize):
+    """Return the start and stop coordinates of each bin across 'chrom', matching the default bins of :func:`find_cis_signal`."""
+    chrint = hic.chr2int[chrom]
+    chr_indices = hic._find_fend_array('chr_indices')
+    mids = hic._find_fend_array('fends', 'mid')
+    start = (mids[chr_indices[chrint]] / binsize) * binsize
+    stop = ((mids[chr_indices[chrint + 1] - 1] - start) / binsize + 1) * binsize + start
+    positions = numpy.zeros(((stop - start) / binsize, 2), dtype=numpy.int32)
+    positions[:, 0] = numpy.arange(positions.shape[0]) * binsize + start
+    positions[:, 1] = positions[:, 0] + binsize
+    return positions
+
+
+def _write_sparse_heatmap(hic, output, pair, positions, datatype, includediagonal, blocksize, silent):
+    """Find a cis or trans heatmap in square blocks of bins and append its non-zero bins to chunked datasets in 'output'."""
+    chrom1 = pair[0]
+    chrom2 = pair[-1]
+    if len(pair) == 1:
+        group = output.create_group(chrom1)
+    else:
+        group = output.create_group('%s_by_%s' % (chrom1, chrom2))
+    num_bins1 = positions[chrom1].shape[0]
+    num_bins2 = positions[chrom2].shape[0]
+    datasets = {}
+    for name, dtype in [['bin1', numpy.int32], ['bin2', numpy.int32], ['observed', numpy.float32],
+                        ['expected', numpy.float32]]:
+        datasets[name] = group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(65536,))
+    indices = numpy.zeros(num_bins1 + 1, dtype=numpy.int64)
+    pos = 0
+    for start1 in range(0, num_bins1, blocksize):
+        stop1 = min(num_bins1, start1 + blocksize)
+        if not silent:
+            print >> sys.stderr, ("\r%s\rFinding sparse %s heatmap... bins %i to %i of %i") %\
+                                 (' ' * 80, '_by_'.join(pair), start1, stop1, num_bins1),
+        block = []
+        if len(pair) == 1:
+            first = start1
+        else:
+            first = 0
+        for start2 in range(first, num_bins2, blocksize):
+            stop2 = min(num_bins2, start2 + blocksize)
+            if len(pair) == 1:
+                data = find_cis_subregion_signal(hic, chrom1, binbounds1=positions[chrom1][start1:stop1, :],
+                                                 binbounds2=positions[chrom2][start2:stop2, :],
+                                                 datatype=datatype, silent=True)
+            else:
+                data = find_trans_signal(hic, chrom1, chrom2, binbounds1=positions[chrom1][start1:stop1, :],
+                                         binbounds2=positions[chrom2][start2:stop2, :], datatype=datatype,
+                                         silent=True)
+            if data is None:
+                continue
+            # only keep the upper triangle of cis blocks straddling the diagonal
+            if len(pair) == 1 and start2 == start1:
+                data[numpy.tril_indices(stop1 - start1, -int(includediagonal), stop2 - start2)] = 0
+            where = numpy.where(data[:, :, 0] > 0)
+            block.append([where[0] + start1, where[1] + start2, data[where[0], where[1], 0],
+                          data[where[0], where[1], 1]])
+            del data
+        if len(block) == 0:
+            indices[(start1 + 1):(stop1 + 1)] = pos
+            continue
+        bin1, bin2, observed, expected = [numpy.hstack([entries[i] for entries in block]) for i in range(4)]
+        del block
+        order = numpy.lexsort((bin2, bin1))
+        indices[(start1 + 1):(stop1 + 1)] = (numpy.cumsum(numpy.bincount(bin1 - start1, minlength=(stop1 - start1)))
+                                             + pos)
+        for name, values in [['bin1', bin1], ['bin2', bin2], ['observed', observed], ['expected', expected]]:
+            datasets[name].resize((pos + order.shape[0],))
+            datasets[name][pos:] = values[order]
+        pos += order.shape[0]
+        del bin1, bin2, observed, expected, order
+    group.create_dataset('indices', data=indices)
+    if not silent:
+        print >> sys.stderr, ("\r%s\r%i non-zero %s bins written\n") % (' ' * 80, pos, '_by_'.join(pair)),
+    return None
+
+
 def find_multiresolution_heatmap(hic, chrom, start, stop, chrom2=None, start2=None, stop2=None, minbinsize=5000,
                                  maxbinsize=12800000, minobservations=5, datatype='fend', midbinsize=40000,
                                  silent=True):
@@ -1775,9 +1906,11 @@ def find_multiresolution_heatmap(hic, chrom, start, stop, chrom2=None, start2=No
         fend_indices = None
     if datatype in ['distance', 'enrichment']:
         distance_parameters = hic.distance_parameters
+        distance_table = hic._find_distance_table()
         chrom_mean = hic.chromosome_means[chrint]
     else:
         distance_parameters = None
+        distance_table = None
         chrom_mean = 0.0
     if trans:
         m = span2 / midbinsize
@@ -1910,6 +2043,7 @@ def find_multiresolution_heatmap(hic, chrom, start, stop, chrom2=None, start2=No
             binning_corrections,
             fend_indices,
             distance_parameters,
+            distance_table,
             chrom_mean,
             dt_int)
     # find features for largest binned data array
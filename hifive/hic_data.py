@@ -4,6 +4,12 @@
 
 import os
 import sys
+import time
+import zlib
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 
 import numpy
 import h5py
@@ -30,6 +36,8 @@ class HiCData(object):
     :type mode: str.
     :param silent: Indicates whether to print information about function execution for this object.
     :type silent: bool.
+    :param lazy: If True, datasets are not copied into memory when the h5dict is loaded. Contiguous, uncompressed datasets are memory-mapped (copy-on-write) and all other datasets are read on first access.
+    :type lazy: bool.
     :returns: :class:`HiCData` class object.
 
     :Attributes: * **file** (*str.*) A string containing the name of the file passed during object creation for saving the object to.
@@ -37,10 +45,12 @@ class HiCData(object):
                  * **history** (*str.*) - A string containing all of the commands executed on this object and their outcomes.
     """
 
-    def __init__(self, filename, mode='r', silent=False):
+    def __init__(self, filename, mode='r', silent=False, lazy=False):
         """Create a :class:`HiCData` object."""
         self.file = os.path.abspath(filename)
         self.silent = silent
+        self.lazy = lazy
+        self._lazy = {}
         self.history = ''
         self.filetype = 'hic_data'
         self.stats = {
@@ -64,25 +74,34 @@ class HiCData(object):
         """Dictionary-like lookup."""
         if key in self.__dict__:
             return self.__dict__[key]
+        elif key in self.__dict__.get('_lazy', {}):
+            return getattr(self, key)
         else:
             return None
 
+    def __getattr__(self, key):
+        """Read lazily-loaded datasets on first access."""
+        return _read_lazy_dataset(self, key)
+
     def __setitem__(self, key, value):
         """Dictionary-like value setting."""
         self.__dict__[key] = value
         return None
 
-    def save(self):
+    def save(self, compression=None):
         """
         Save analysis parameters to h5dict.
 
+        :param compression: If specified, 'cis_data' and 'trans_data' are stored in column-wise chunks using the byte-shuffle filter and this h5py compression filter ('lzf' or 'gzip'). Region queries only decompress the chunks covering the requested 'cis_indices'/'trans_indices' range. If None, data are stored uncompressed and contiguously.
+        :type compression: str.
         :returns: None
         """
         self.history.replace("'None'", "None")
+        _materialize_lazy_datasets(self)
         datafile = h5py.File(self.file, 'w')
         chroms = self.fends['chromosomes'][...]
         for key in self.__dict__.keys():
-            if key in ['file', 'chr2int', 'fends', 'silent', 'cuts']:
+            if key in ['file', 'chr2int', 'fends', 'silent', 'cuts', 'lazy', '_lazy']:
                 continue
             elif key == 'stats':
                 stats = []
@@ -92,6 +111,11 @@ class HiCData(object):
                 datafile.create_dataset(name='stats', data=stats)
             elif self[key] is None:
                 continue
+            elif (key in ['cis_data', 'trans_data'] and compression is not None and len(self[key].shape) == 2 and
+                  self[key].shape[0] > 0):
+                # chunk each column separately so sorted fend columns compress well and row ranges stay cheap to read
+                chunks = (min(self[key].shape[0], 16384), 1)
+                datafile.create_dataset(key, data=self[key], chunks=chunks, shuffle=True, compression=compression)
             elif isinstance(self[key], numpy.ndarray):
                 datafile.create_dataset(key, data=self[key])
             elif isinstance(self[key], list):
@@ -112,12 +136,15 @@ class HiCData(object):
 
         :returns: None
         """
+        self._lazy = {}
         datafile = h5py.File(self.file, 'r')
         for key in datafile.keys():
             if key == 'stats':
                 stats = datafile[key][...]
                 for i in range(stats.shape[0]):
                     self.stats[stats['name'][i]] = stats['count'][i]
+            elif self.lazy:
+                _load_lazy_dataset(self, datafile, key)
             else:
                 self[key] = numpy.copy(datafile[key])
         for key in datafile['/'].attrs.keys():
@@ -142,6 +169,22 @@ class HiCData(object):
         datafile.close()
         return None
 
+    def _open_fends(self, fendfilename):
+        """Open the fend file and determine how reads should be assigned to fends or bins."""
+        self.fends = h5py.File(fendfilename, 'r')
+        if 'binned' in self.fends['/'].attrs and self.fends['/'].attrs['binned'] is not None:
+            self.binned = True
+        else:
+            self.binned = False
+        if 'fends' in self.fends and self.fends['fends'] is not None:
+            self.re = True
+        else:
+            self.re = False
+        self.chr2int = {}
+        for i, j in enumerate(self.fends['chromosomes'][...]):
+            self.chr2int[j] = i
+        return None
+
     def _find_cut_sites(self):
         self.cuts = []
         chroms = self.fends['chromosomes'][...]
@@ -152,7 +195,400 @@ class HiCData(object):
                 self.fends['fends']['stop'][chr_indices[i + 1] - 1]])
         return None
 
-    def load_data_from_raw(self, fendfilename, filelist, maxinsert, skip_duplicate_filtering=False):
+    def _read_raw_chunks(self, fname, chunksize):
+        """Yield arrays of chromosome indices and signed coordinates from a raw text file, 'chunksize' lines at a time."""
+        input = open(fname, 'r')
+        while True:
+            lines = list(itertools.islice(input, chunksize))
+            if len(lines) == 0:
+                break
+            fields = ''.join(lines).split()
+            # if any lines have extra or missing columns, split lines individually
+            if len(fields) != len(lines) * 6:
+                fields = []
+                for line in lines:
+                    temp = line.strip('\n').split('\t')
+                    if len(temp) >= 6:
+                        fields += temp[:6]
+            del lines
+            if len(fields) == 0:
+                continue
+            fields = numpy.array(fields).reshape(-1, 6)
+            names, chrints = numpy.unique(fields[:, [0, 3]], return_inverse=True)
+            lookup = numpy.zeros(names.shape[0], dtype=numpy.int32) - 1
+            for i, name in enumerate(names):
+                if name in self.chr2int:
+                    lookup[i] = self.chr2int[name]
+            chrints = lookup[chrints].reshape(-1, 2)
+            starts = fields[:, [1, 4]].astype(numpy.int64)
+            starts[numpy.where(fields[:, 2] == '-')[0], 0] *= -1
+            starts[numpy.where(fields[:, 5] == '-')[0], 1] *= -1
+            del fields
+            valid = numpy.where((chrints[:, 0] >= 0) & (chrints[:, 1] >= 0))[0]
+            self.stats['chr_not_in_fends'] += int(chrints.shape[0] - valid.shape[0])
+            yield chrints[valid, :], starts[valid, :]
+        input.close()
+        return
+
+    def _open_bam(self, fname, threads):
+        """Open a BAM file, using multiple decompression threads if supported by pysam."""
+        if threads > 1:
+            try:
+                return pysam.AlignmentFile(fname, 'rb', threads=threads)
+            except (AttributeError, TypeError):
+                pass
+        return pysam.Samfile(fname, 'rb')
+
+    def _read_bam_ends(self, fname, threads):
+        """Return arrays of two independent read name hashes, chromosome indices, and signed coordinates for mapped reads in a BAM file."""
+        input = self._open_bam(fname, threads)
+        idx2int = numpy.zeros(len(input.header['SQ']), dtype=numpy.int32) - 1
+        for i in range(len(input.header['SQ'])):
+            chrom = input.header['SQ'][i]['SN']
+            if chrom in self.chr2int:
+                idx2int[i] = self.chr2int[chrom]
+        # fill fixed-size blocks of arrays rather than growing python lists
+        blocksize = 1000000
+        hashes = []
+        checks = []
+        tids = []
+        starts = []
+        a = blocksize
+        for read in input.fetch(until_eof=True):
+            # Only consider reads with an alignment
+            if read.is_unmapped:
+                continue
+            if a == blocksize:
+                hashes.append(numpy.empty(blocksize, dtype=numpy.int64))
+                checks.append(numpy.empty(blocksize, dtype=numpy.int32))
+                tids.append(numpy.empty(blocksize, dtype=numpy.int32))
+                starts.append(numpy.empty(blocksize, dtype=numpy.int64))
+                a = 0
+            hashes[-1][a] = hash(read.qname)
+            checks[-1][a] = zlib.crc32(read.qname)
+            tids[-1][a] = read.tid
+            if read.is_reverse:
+                starts[-1][a] = -(read.pos + len(read.seq))
+            else:
+                starts[-1][a] = read.pos
+            a += 1
+        input.close()
+        if len(hashes) == 0:
+            return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32),
+                    numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int64))
+        hashes[-1] = hashes[-1][:a]
+        checks[-1] = checks[-1][:a]
+        tids[-1] = tids[-1][:a]
+        starts[-1] = starts[-1][:a]
+        return (numpy.concatenate(hashes), numpy.concatenate(checks), idx2int[numpy.concatenate(tids)],
+                numpy.concatenate(starts))
+
+    def _read_bam_chunks(self, filepair, chunksize, threads=1):
+        """Yield arrays of chromosome indices and signed coordinates for mate pairs from a pair of BAM files, 'chunksize' pairs at a time."""
+        # load both halves of paired ends, identifying read names by a key that needs both name hashes to match
+        hashes1, checks1, chrints1, starts1 = self._read_bam_ends(filepair[0], threads)
+        hashes2, checks2, chrints2, starts2 = self._read_bam_ends(filepair[1], threads)
+        keys1, keys2 = _find_name_keys(hashes1, checks1, hashes2, checks2)
+        del hashes1, checks1, hashes2, checks2
+        # if chromosome not in chr2int, skip
+        valid = numpy.where(chrints1 >= 0)[0]
+        self.stats['chr_not_in_fends'] += int(keys1.shape[0] - valid.shape[0])
+        # keep only the last alignment for each read name, sorted by name key
+        order = valid[numpy.argsort(keys1[valid], kind='mergesort')]
+        keys1 = keys1[order]
+        last = numpy.where(numpy.r_[keys1[1:] != keys1[:-1], True])[0]
+        keys1 = keys1[last]
+        chrints1 = chrints1[order[last]]
+        starts1 = starts1[order[last]]
+        del valid, order, last
+        if keys1.shape[0] == 0 or keys2.shape[0] == 0:
+            return
+        # find the first end with a matching read name key for each second end
+        indices = numpy.minimum(numpy.searchsorted(keys1, keys2), keys1.shape[0] - 1)
+        matched = keys1[indices] == keys2
+        del keys1, keys2
+        self.stats['chr_not_in_fends'] += int(numpy.sum(matched & (chrints2 < 0)))
+        valid = numpy.where(matched & (chrints2 >= 0))[0]
+        del matched
+        indices = indices[valid]
+        for i in range(0, valid.shape[0], chunksize):
+            chrints = numpy.empty((min(chunksize, valid.shape[0] - i), 2), dtype=numpy.int32)
+            starts = numpy.empty((chrints.shape[0], 2), dtype=numpy.int64)
+            chrints[:, 0] = chrints1[indices[i:(i + chunksize)]]
+            chrints[:, 1] = chrints2[valid[i:(i + chunksize)]]
+            starts[:, 0] = starts1[indices[i:(i + chunksize)]]
+            starts[:, 1] = starts2[valid[i:(i + chunksize)]]
+            yield chrints, starts
+        return
+
+    def _order_read_pairs(self, chrints, starts):
+        """Remove read pairs that can't be packed and order ends so the first is on the lower chromosome or upstream."""
+        # coordinates need to fit in 31 bits to be packed into keys
+        valid = numpy.where(numpy.amax(numpy.abs(starts), axis=1) < 2 ** 30)[0]
+        self.stats['out_of_bounds'] += int(starts.shape[0] - valid.shape[0])
+        chrints = chrints[valid, :]
+        starts = starts[valid, :]
+        swap = numpy.where((chrints[:, 1] < chrints[:, 0]) | ((chrints[:, 0] == chrints[:, 1]) &
+                           (numpy.abs(starts[:, 0]) > numpy.abs(starts[:, 1]))))[0]
+        chrints[swap, :] = chrints[swap, ::-1]
+        starts[swap, :] = starts[swap, ::-1]
+        return chrints, starts
+
+    def _split_read_pairs(self, chunk):
+        """Yield the upper chromosome index, lower chromosome index, and packed int64 keys for each chromosome pair in a chunk."""
+        chrints, starts = chunk
+        if chrints.shape[0] == 0:
+            return
+        pairs = chrints[:, 1].astype(numpy.int64) * (chrints[:, 1] + 1) / 2 + chrints[:, 0]
+        order = numpy.argsort(pairs)
+        bounds = numpy.r_[0, numpy.cumsum(numpy.bincount(pairs))]
+        for pair in numpy.where(bounds[1:] > bounds[:-1])[0]:
+            indices = order[bounds[pair]:bounds[pair + 1]]
+            keys = ((starts[indices, 0] + 2 ** 30) << 32) | (starts[indices, 1] + 2 ** 30)
+            yield chrints[indices[0], 1], chrints[indices[0], 0], keys
+        return
+
+    def _unpack_read_pairs(self, keys):
+        """Return an N x 2 array of signed coordinates from packed int64 keys."""
+        data = numpy.empty((keys.shape[0], 2), dtype=numpy.int32)
+        data[:, 0] = (keys >> 32) - 2 ** 30
+        data[:, 1] = (keys & (2 ** 32 - 1)) - 2 ** 30
+        return data
+
+    def _count_read_pairs(self, chunk, num_chroms):
+        """Return per-chromosome pair arrays of start1, start2, and count for unique read pairs in a chunk."""
+        data = self._empty_read_pairs(num_chroms, 3)
+        for i, j, keys in self._split_read_pairs(chunk):
+            keys, counts = numpy.unique(keys, return_counts=True)
+            self.stats['pcr_duplicates'] += int(numpy.sum(counts) - counts.shape[0])
+            data[i][j] = numpy.empty((keys.shape[0], 3), dtype=numpy.int32)
+            data[i][j][:, :2] = self._unpack_read_pairs(keys)
+            data[i][j][:, 2] = counts
+        return data
+
+    def _empty_read_pairs(self, num_chroms, columns):
+        """Return a lower-triangular list of empty per-chromosome pair read arrays."""
+        data = []
+        for i in range(num_chroms):
+            data.append([])
+            for j in range(i + 1):
+                data[i].append(numpy.zeros((0, columns), dtype=numpy.int32))
+        return data
+
+    def _add_read_pair_runs(self, chunk, runs):
+        """Add sorted unique packed keys from a chunk to each chromosome pair's list of runs."""
+        for i, j, keys in self._split_read_pairs(chunk):
+            runs[i][j].append(numpy.unique(keys))
+            self._merge_read_pair_runs(runs[i][j])
+        return None
+
+    def _merge_read_pair_runs(self, runs, final=False):
+        """Merge runs of sorted unique keys, returning the merged keys if 'final' is True."""
+        # only merge runs of similar size so each key is resorted a logarithmic number of times
+        while len(runs) > 1 and (final or runs[-1].shape[0] * 2 >= runs[-2].shape[0]):
+            last = runs.pop()
+            runs[-1] = numpy.unique(numpy.r_[runs[-1], last])
+            del last
+        if not final:
+            return None
+        if len(runs) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return runs[0]
+
+    def _spill_read_pair_runs(self, runs, spills, tempdir):
+        """Merge each chromosome pair's runs and write them to temporary files, emptying 'runs'."""
+        for i in range(len(runs)):
+            for j in range(len(runs[i])):
+                keys = self._merge_read_pair_runs(runs[i][j], final=True)
+                runs[i][j] = []
+                if keys.shape[0] > 0:
+                    self._spill_array(keys, spills, i, j, tempdir)
+                del keys
+        return None
+
+    def _spill_fend_pair_runs(self, runs, spills, tempdir):
+        """Merge each chromosome pair's fend pair runs and write their keys and counts to temporary files, emptying 'runs'."""
+        for i in range(len(runs)):
+            for j in range(len(runs[i])):
+                keys, counts = self._merge_fend_pair_runs(runs[i][j], final=True)
+                runs[i][j] = []
+                if keys.shape[0] > 0:
+                    self._spill_array(numpy.vstack((keys, counts)), spills, i, j, tempdir)
+                del keys, counts
+        return None
+
+    def _spill_array(self, array, spills, i, j, tempdir):
+        """Write an array for chromosome pair 'i', 'j' to a new temporary file and add its name to 'spills'."""
+        fname = os.path.join(tempdir, "%i_%i_%i.npy" % (i, j, len(spills[i][j])))
+        numpy.save(fname, array)
+        spills[i][j].append(fname)
+        return None
+
+    def _find_unique_read_pairs(self, runs, spills, buffersize):
+        """Yield blocks of sorted unique keys from in-memory runs and spilled runs, each block covering a distinct key range."""
+        keys = self._merge_read_pair_runs(runs, final=True)
+        if len(spills) == 0:
+            if keys.shape[0] > 0:
+                yield keys
+            return
+        sources = []
+        for fname in spills:
+            sources.append(numpy.load(fname, mmap_mode='r'))
+        if keys.shape[0] > 0:
+            sources.append(keys)
+        total = 0
+        for source in sources:
+            total += source.shape[0]
+        # pick key boundaries so that each block contains approximately 'buffersize' keys
+        num_blocks = (total - 1) / buffersize + 1
+        step = max(1, total / (num_blocks * 64))
+        samples = []
+        for source in sources:
+            samples.append(numpy.array(source[::step]))
+        samples = numpy.sort(numpy.concatenate(samples))
+        splits = samples[(numpy.arange(1, num_blocks) * samples.shape[0]) / num_blocks]
+        del samples
+        starts = numpy.zeros(len(sources), dtype=numpy.int64)
+        for i in range(num_blocks):
+            block = []
+            for j, source in enumerate(sources):
+                if i < num_blocks - 1:
+                    stop = numpy.searchsorted(source, splits[i])
+                else:
+                    stop = source.shape[0]
+                block.append(numpy.array(source[starts[j]:stop]))
+                starts[j] = stop
+            block = numpy.unique(numpy.concatenate(block))
+            if block.shape[0] > 0:
+                yield block
+            del block
+        del sources
+        return
+
+    def _load_read_pair_chunks(self, chunks, fname, fend_pairs, skip_duplicate_filtering, buffersize):
+        """Remove duplicates from chunks of read pairs and map them to fends, returning the number of reads kept."""
+        num_chroms = len(fend_pairs)
+        start_time = time.time()
+        # for duplicate filtering, keep sorted runs of unique packed read pairs for each chromosome pair
+        runs = []
+        spills = []
+        for i in range(num_chroms):
+            runs.append([])
+            spills.append([])
+            for j in range(i + 1):
+                runs[i].append([])
+                spills[i].append([])
+        tempdir = None
+        new_reads = 0
+        unique_reads = 0
+        file_reads = 0
+        # spilled runs are removed even if reading or merging fails part way through
+        try:
+            for chunk in chunks:
+                # reads with coordinates too large to pack are kept in the read total as out of bounds
+                num_reads = chunk[0].shape[0]
+                chunk = self._order_read_pairs(chunk[0], chunk[1])
+                new_reads += num_reads - chunk[0].shape[0]
+                file_reads += chunk[0].shape[0]
+                if skip_duplicate_filtering:
+                    data = self._count_read_pairs(chunk, num_chroms)
+                    for i in range(len(data)):
+                        for j in range(len(data[i])):
+                            new_reads += numpy.sum(data[i][j][:, 2])
+                    if self.re:
+                        self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
+                    else:
+                        self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
+                    del data
+                else:
+                    self._add_read_pair_runs(chunk, runs)
+                    buffered = 0
+                    for i in range(num_chroms):
+                        for j in range(i + 1):
+                            for run in runs[i][j]:
+                                buffered += run.shape[0]
+                    # if too many unique read pairs are held in memory, write them out to temporary files
+                    if buffered > buffersize:
+                        if tempdir is None:
+                            tempdir = tempfile.mkdtemp(prefix='hifive_')
+                        self._spill_read_pair_runs(runs, spills, tempdir)
+                if not self.silent:
+                    print >> sys.stderr, ("\r%s\rLoading data from %s... %i reads (%i reads/s)") % (' ' * 70,
+                        fname.split('/')[-1], file_reads, file_reads / max(time.time() - start_time, 1e-6)),
+            if not skip_duplicate_filtering:
+                # map each chromosome pair's unique read pairs to fends, one key range block at a time
+                for i in range(num_chroms):
+                    for j in range(i + 1):
+                        for keys in self._find_unique_read_pairs(runs[i][j], spills[i][j], buffersize):
+                            data = self._empty_read_pairs(num_chroms, 2)
+                            data[i][j] = self._unpack_read_pairs(keys)
+                            unique_reads += keys.shape[0]
+                            del keys
+                            if self.re:
+                                self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
+                            else:
+                                self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
+                            del data
+                        runs[i][j] = None
+                self.stats['pcr_duplicates'] += file_reads - unique_reads
+                new_reads += unique_reads
+        finally:
+            if tempdir is not None:
+                shutil.rmtree(tempdir)
+        if not self.silent:
+            print >> sys.stderr, ("\r%s\r%i validly-mapped reads pairs loaded (%i reads/s).\n") % (' ' * 70,
+                new_reads, file_reads / max(time.time() - start_time, 1e-6)),
+        return new_reads
+
+    def _load_files_in_parallel(self, fendfilename, filelist, filetype, fend_pairs, skip_duplicate_filtering,
+                                chunksize, buffersize, processes, threads=1):
+        """Load files in a pool of worker processes, combining their fend pair counts and statistics."""
+        # workers write their fend pair counts to files here rather than sending them back through the pool
+        tempdir = tempfile.mkdtemp(prefix='hifive_')
+        tasks = []
+        for fname in filelist:
+            tasks.append((fendfilename, fname, filetype, self.maxinsert, self.insert_distribution[:, 1],
+                          skip_duplicate_filtering, chunksize, buffersize, threads, tempdir))
+        if not self.silent:
+            print >> sys.stderr, ("Loading data from %i files using %i processes...\n") % (len(tasks),
+                                 min(processes, len(tasks))),
+        total_reads = 0
+        try:
+            pool = multiprocessing.Pool(min(processes, len(tasks)))
+            try:
+                for result in pool.imap_unordered(_load_read_pairs_process, tasks):
+                    fname, new_reads, spills, stats, insert_counts, extra, rate = result
+                    for i in range(len(spills)):
+                        for j in range(len(spills[i])):
+                            for spill in spills[i][j]:
+                                pairs = numpy.load(spill)
+                                os.remove(spill)
+                                fend_pairs[i][j].append((pairs[0, :], pairs[1, :]))
+                                self._merge_fend_pair_runs(fend_pairs[i][j])
+                                del pairs
+                    for key, count in stats.iteritems():
+                        self.stats[key] += count
+                    self.insert_distribution[:, 0] += insert_counts
+                    for key, count in extra.iteritems():
+                        if key in self.__dict__:
+                            self[key] += count
+                        else:
+                            self[key] = count
+                    total_reads += new_reads
+                    if not self.silent:
+                        if not isinstance(fname, str):
+                            fname = fname[1]
+                        print >> sys.stderr, ("%i validly-mapped reads pairs loaded from %s (%i reads/s).\n") % (
+                                             new_reads, fname.split('/')[-1], rate),
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            shutil.rmtree(tempdir)
+        return total_reads
+
+    def load_data_from_raw(self, fendfilename, filelist, maxinsert, skip_duplicate_filtering=False, chunksize=1000000,
+                           buffersize=100000000, processes=1):
         """
         Read interaction counts from a text file(s) and place in h5dict.
 
@@ -170,6 +606,12 @@ class HiCData(object):
         :type maxinsert: int.
         :param skip_duplicate_filtering: Do not remove PCR duplicates. This allows much lower memoer requirements since files can be processed in chunks.
         :type skip_duplicate_filtering: bool.
+        :param chunksize: The number of lines to read and parse into arrays at a time.
+        :type chunksize: int.
+        :param buffersize: The number of unique read pairs to hold in memory during duplicate filtering before sorted runs are written to temporary files. Temporary files are placed in the directory given by the TMPDIR environment variable.
+        :type buffersize: int.
+        :param processes: The number of worker processes to use for loading. If greater than one and multiple files are given, each file is loaded in a separate process and the resulting fend pair counts and statistics are combined.
+        :type processes: int.
         :returns: None
 
         :Attributes: * **fendfilename** (*str.*) - A string containing the relative path of the fend file.
@@ -180,9 +622,11 @@ class HiCData(object):
                      * **fends** (*ndarray*) - A filestream to the hdf5 fend file such that all saved fend attributes can be accessed through this class attribute.
                      * **maxinsert** (*int.*) - An interger denoting the maximum included distance sum between both read ends and their downstream RE site.
 
+        Files are read in blocks of 'chunksize' lines which are parsed into arrays of chromosome indices and signed coordinates. Read pairs are packed into int64 keys, one per chromosome pair, so duplicate removal is done by sorting rather than in dictionaries. Because of this packing, coordinates must be less than 2^30. When more than 'buffersize' unique read pairs are held in memory, they are written to temporary files and merged once the whole file has been read, so duplicate filtering does not require all unique read pairs to fit in memory.
+
         When data is loaded the 'history' attribute is updated to include the history of the fend file that becomes associated with it.
         """
-        self.history += "HiCData.load_data_from_raw(fendfilename='%s', filelist=%s, maxinsert=%i, skip_duplicate_filtering=%s) - " % (fendfilename, str(filelist), maxinsert, str(skip_duplicate_filtering))
+        self.history += "HiCData.load_data_from_raw(fendfilename='%s', filelist=%s, maxinsert=%i, skip_duplicate_filtering=%s, chunksize=%i, buffersize=%i, processes=%i) - " % (fendfilename, str(filelist), maxinsert, str(skip_duplicate_filtering), chunksize, buffersize, processes)
         # determine if fend file exists and if so, load it
         if not os.path.exists(fendfilename):
             if not self.silent:
@@ -193,20 +637,9 @@ class HiCData(object):
         self.fendfilename = "%s/%s" % (os.path.relpath(os.path.dirname(os.path.abspath(fendfilename)),
                                        os.path.dirname(self.file)), os.path.basename(fendfilename))
         self.maxinsert = maxinsert
-        self.fends = h5py.File(fendfilename, 'r')
-        if 'binned' in self.fends['/'].attrs and self.fends['/'].attrs['binned'] is not None:
-            self.binned = True
-        else:
-            self.binned = False
-        if 'fends' in self.fends and self.fends['fends'] is not None:
-            self.re = True
-        else:
-            self.re = False
+        self._open_fends(fendfilename)
         self.history = self.fends['/'].attrs['history'] + self.history
-        self.chr2int = {}
         chroms = self.fends['chromosomes'][...]
-        for i, j in enumerate(chroms):
-            self.chr2int[j] = i
         self.insert_distribution = numpy.zeros((182, 2), dtype=numpy.int32)
         self.insert_distribution[1:, 1] = numpy.round(numpy.exp(numpy.linspace(3.8, 12.8, 181))).astype(numpy.int32)
         # load data from all files, skipping if chromosome not in the fend file.
@@ -221,110 +654,32 @@ class HiCData(object):
         for i in range(len(chroms)):
             fend_pairs.append([])
             for j in range(i + 1):
-                fend_pairs[i].append({})
+                fend_pairs[i].append([])
         total_reads = 0
+        present = []
         for fname in filelist:
-            data = []
-            for i in range(len(chroms)):
-                data.append([])
-                for j in range(i + 1):
-                    data[i].append({})
             if not os.path.exists(fname):
                 if not self.silent:
                     print >> sys.stderr, ("The file %s was not found...skipped.\n") % (fname.split('/')[-1]),
                 self.history += "'%s' not found, " % fname
                 continue
-            if not self.silent:
-                print >> sys.stderr, ("Loading data from %s...") % (fname.split('/')[-1]),
-            a = 0
-            input = open(fname, 'r', 1)
-            new_reads = 0
-            for line in input:
-                temp = line.strip('\n').split('\t')
-                if temp[0] not in self.chr2int or temp[3] not in self.chr2int:
-                    self.stats['chr_not_in_fends'] += 1
-                    continue
-                chrint1 = self.chr2int[temp[0]]
-                chrint2 = self.chr2int[temp[3]]
-                start1 = int(temp[1])
-                start2 = int(temp[4])
-                if temp[2] == '-':
-                    start1 = -start1
-                if temp[5] == '-':
-                    start2 = -start2
-                if chrint1 == chrint2:
-                    if abs(start1) > abs(start2):
-                        start1, start2 = start2, start1
-                elif chrint2 < chrint1:
-                    chrint1, chrint2, start1, start2 = chrint2, chrint1, start2, start1
-                key = (start1, start2)
-                if key not in data[chrint2][chrint1]:
-                    if skip_duplicate_filtering:
-                        data[chrint2][chrint1][key] = 1
-                    else:
-                        data[chrint2][chrint1][key] = None
-                else:
-                    if skip_duplicate_filtering:
-                        data[chrint2][chrint1][key] += 1
-                    else:
-                        self.stats['pcr_duplicates'] += 1
-                a += 1
-                if skip_duplicate_filtering and a >= 10000000:
-                    for i in range(len(data)):
-                        for j in range(len(data[i])):
-                            temp = numpy.zeros((len(data[i][j]), 3), dtype=numpy.int32)
-                            k = 0
-                            for key, count in data[i][j].iteritems():
-                                temp[k, :] = (key[0], key[1], count)
-                                self.stats['pcr_duplicates'] += count - 1
-                                k += 1
-                            data[i][j] = temp
-                            new_reads += numpy.sum(data[i][j][:, 2])
-                    if self.re:
-                        self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    else:
-                        self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    if not self.silent:
-                        print >> sys.stderr, ("\r%s\rLoading data from %s...") % (' '*50, fname.split('/')[-1]),
-                    for i in range(len(data)):
-                        for j in range(len(data[i])):
-                            data[i][j] = {}
-                    a = 0
-            input.close()
-            if not skip_duplicate_filtering or a > 0:
-                for i in range(len(data)):
-                    for j in range(len(data[i])):
-                        if skip_duplicate_filtering:
-                            temp = numpy.zeros((len(data[i][j]), 3), dtype=numpy.int32)
-                            k = 0
-                            for key, count in data[i][j].iteritems():
-                                temp[k, :] = (key[0], key[1], count)
-                                self.stats['pcr_duplicates'] += count - 1
-                                k += 1
-                            data[i][j] = temp
-                            new_reads += numpy.sum(data[i][j][:, 2])
-                        else:
-                            data[i][j] = numpy.array(data[i][j].keys(), dtype=numpy.int32)
-                            new_reads += data[i][j].shape[0]
-                # map data to fends, filtering as needed
-                if new_reads > 0 and (a > 0 or not skip_duplicate_filtering):
-                    if self.re:
-                        self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    else:
-                        self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
-            total_reads += new_reads
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\r%i validly-mapped reads pairs loaded.\n") % (' ' * 50, new_reads),
+            present.append(fname)
+        if processes > 1 and len(present) > 1:
+            total_reads += self._load_files_in_parallel(fendfilename, present, 'raw', fend_pairs,
+                                                        skip_duplicate_filtering, chunksize, buffersize, processes)
+        else:
+            for fname in present:
+                if not self.silent:
+                    print >> sys.stderr, ("Loading data from %s...") % (fname.split('/')[-1]),
+                total_reads += self._load_read_pair_chunks(self._read_raw_chunks(fname, chunksize), fname,
+                                                           fend_pairs, skip_duplicate_filtering, buffersize)
         if skip_duplicate_filtering:
             self.stats['total_reads'] = total_reads + self.stats['chr_not_in_fends']
         else:
             self.stats['total_reads'] = total_reads + self.stats['chr_not_in_fends'] + self.stats['pcr_duplicates']
         if self.re:
             self._clean_fend_pairs(fend_pairs)
-        total_fend_pairs = 0
-        for i in range(len(fend_pairs)):
-            for j in range(len(fend_pairs[i])):
-                total_fend_pairs += len(fend_pairs[i][j])
+        total_fend_pairs = self._count_fend_pairs(fend_pairs)
         if total_fend_pairs == 0:
             if not self.silent:
                 print >> sys.stderr, ("No valid data was loaded.\n"),
@@ -341,7 +696,8 @@ class HiCData(object):
         self.history += 'Success\n'
         return None
 
-    def load_data_from_bam(self, fendfilename, filelist, maxinsert, skip_duplicate_filtering=False):
+    def load_data_from_bam(self, fendfilename, filelist, maxinsert, skip_duplicate_filtering=False, chunksize=1000000,
+                           buffersize=100000000, processes=1, threads=1):
         """
         Read interaction counts from pairs of BAM-formatted alignment file(s) and place in h5dict.
 
@@ -353,6 +709,14 @@ class HiCData(object):
         :type maxinsert: int.
         :param skip_duplicate_filtering: Do not remove PCR duplicates. This allows much lower memoer requirements since files can be processed in chunks.
         :type skip_duplicate_filtering: bool.
+        :param chunksize: The number of read pairs to collect into arrays at a time.
+        :type chunksize: int.
+        :param buffersize: The number of unique read pairs to hold in memory during duplicate filtering before sorted runs are written to temporary files. Temporary files are placed in the directory given by the TMPDIR environment variable.
+        :type buffersize: int.
+        :param processes: The number of worker processes to use for loading. If greater than one and multiple files are given, each file is loaded in a separate process and the resulting fend pair counts and statistics are combined.
+        :type processes: int.
+        :param threads: The number of threads pysam should use to decompress each BAM file.
+        :type threads: int.
         :returns: None
 
         :Attributes: * **fendfilename** (*str.*) - A string containing the relative path of the fend file.
@@ -363,9 +727,11 @@ class HiCData(object):
                      * **fends** (*ndarray*) - A filestream to the hdf5 fend file such that all saved fend attributes can be accessed through this class attribute.
                      * **maxinsert** (*int.*) - An interger denoting the maximum included distance sum between both read ends and their downstream RE site.
 
+        Mapped read ends from each file are collected into arrays of read name hashes, chromosome indices, and signed coordinates. Each read name is hashed twice with independent hash functions and mates are only paired if both hashes match, searching the sorted names of the first file rather than through a dictionary of read names.
+
         When data is loaded the 'history' attribute is updated to include the history of the fend file that becomes associated with it.
         """
-        self.history += "HiCData.load_data_from_bam(fendfilename='%s', filelist=%s, maxinsert=%i, skip_duplicate_filtering=%s) - " % (fendfilename, str(filelist), maxinsert, str(skip_duplicate_filtering))
+        self.history += "HiCData.load_data_from_bam(fendfilename='%s', filelist=%s, maxinsert=%i, skip_duplicate_filtering=%s, chunksize=%i, buffersize=%i, processes=%i, threads=%i) - " % (fendfilename, str(filelist), maxinsert, str(skip_duplicate_filtering), chunksize, buffersize, processes, threads)
         if 'pysam' not in sys.modules.keys():
             if not self.silent:
                 print >> sys.stderr, ("The pysam module must be installed to use this function.")
@@ -380,20 +746,9 @@ class HiCData(object):
         self.fendfilename = "%s/%s" % (os.path.relpath(os.path.dirname(os.path.abspath(fendfilename)),
                                        os.path.dirname(self.file)), os.path.basename(fendfilename))
         self.maxinsert = maxinsert
-        self.fends = h5py.File(fendfilename, 'r')
-        if 'binned' in self.fends['/'].attrs and self.fends['/'].attrs['binned'] is not None:
-            self.binned = True
-        else:
-            self.binned = False
-        if 'fends' in self.fends and self.fends['fends'] is not None:
-            self.re = True
-        else:
-            self.re = False
+        self._open_fends(fendfilename)
         self.history = self.fends['/'].attrs['history'] + self.history
-        self.chr2int = {}
         chroms = self.fends['chromosomes'][...]
-        for i, j in enumerate(chroms):
-            self.chr2int[j] = i
         self.insert_distribution = numpy.zeros((92, 2), dtype=numpy.int32)
         self.insert_distribution[1:, 1] = numpy.round(numpy.exp(numpy.linspace(3.8, 8.3, 91))).astype(numpy.int32)
         # load data from all files, skipping if chromosome not in the fend file.
@@ -411,7 +766,8 @@ class HiCData(object):
         for i in range(len(chroms)):
             fend_pairs.append([])
             for j in range(i + 1):
-                fend_pairs[i].append({})
+                fend_pairs[i].append([])
+        present_pairs = []
         for filepair in filelist:
             # determine which files have both mapped ends present
             present = True
@@ -429,138 +785,26 @@ class HiCData(object):
                 if not self.silent:
                     print >> sys.stderr, ("No data for one or both ends could be located. Skipping this run.\n")
                 continue
-            unpaired = {}
-            # load first half of paired ends
-            if not self.silent:
-                print >> sys.stderr, ("Loading data from %s...") % (filepair[0].split('/')[-1]),
-            input = pysam.Samfile(filepair[0], 'rb')
-            idx2int = {}
-            for i in range(len(input.header['SQ'])):
-                chrom = input.header['SQ'][i]['SN']
-                if chrom in self.chr2int:
-                    idx2int[i] = self.chr2int[chrom]
-            for read in input.fetch(until_eof=True):
-                # Only consider reads with an alignment
-                if read.is_unmapped:
-                    continue
-                # if chromosome not in chr2int, skip
-                if read.tid not in idx2int:
-                    self.stats['chr_not_in_fends'] += 1
-                    continue
-                if read.is_reverse:
-                    end = -(read.pos + len(read.seq))
-                else:
-                    end = read.pos
-                unpaired[read.qname] = (idx2int[read.tid], end)
-            input.close()
-            if not self.silent:
-                print >> sys.stderr, ("Done\n"),
-            # load second half of paired ends
-            if not self.silent:
-                print >> sys.stderr, ("Loading data from %s...") % (filepair[1].split('/')[-1]),
-            data = []
-            for i in range(len(chroms)):
-                data.append([])
-                for j in range(i + 1):
-                    data[i].append({})
-            input = pysam.Samfile(filepair[1], 'rb')
-            idx2int = {}
-            for i in range(len(input.header['SQ'])):
-                chrom = input.header['SQ'][i]['SN']
-                if chrom in self.chr2int:
-                    idx2int[i] = self.chr2int[chrom]
-            a = 0
-            new_reads = 0
-            for read in input.fetch(until_eof=True):
-                # Only consider reads with an alignment
-                if read.is_unmapped:
-                    continue
-                if read.qname not in unpaired:
-                    continue
-                # if chromosome not in chr2int, skip
-                if read.tid not in idx2int:
-                    self.stats['chr_not_in_fends'] += 1
-                    continue
-                if read.is_reverse:
-                    start2 = -(read.pos + len(read.seq))
-                else:
-                    start2 = read.pos
-                chr1, start1 = unpaired[read.qname]
-                chr2 = idx2int[read.tid]
-                if chr1 == chr2:
-                    if abs(start1) > abs(start2):
-                        start1, start2 = start2, start1
-                elif chr2 < chr1:
-                    chr1, chr2, start1, start2 = chr2, chr1, start2, start1
-                key = (start1, start2)
-                if key not in data[chr2][chr1]:
-                    if skip_duplicate_filtering:
-                        data[chr2][chr1][key] = 1
-                    else:
-                        data[chr2][chr1][key] = None
-                else:
-                    if skip_duplicate_filtering:
-                        data[chr2][chr1][key] += 1
-                    else:
-                        self.stats['pcr_duplicates'] += 1
-                a += 1
-                if skip_duplicate_filtering and a >= 10000000:
-                    for i in range(len(data)):
-                        for j in range(len(data[i])):
-                            temp = numpy.zeros((len(data[i][j]),3), dtype=numpy.int32)
-                            k = 0
-                            for key, count in data[i][j].iteritems():
-                                temp[k, :] = (key[0], key[1], count)
-                                self.stats['pcr_duplicates'] += count - 1
-                                k += 1
-                            data[i][j] = temp
-                            new_reads += numpy.sum(data[i][j][:, 2])
-                    if self.re:
-                        self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    else:
-                        self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    if not self.silent:
-                        print >> sys.stderr, ("\r%s\rLoading data from %s...") % (' '*50, filepair[1].split('/')[-1]),
-                    for i in range(len(data)):
-                        for j in range(len(data[i])):
-                            data[i][j] = {}
-                    a = 0
-            input.close()
-            del unpaired
-            if a > 0 or not skip_duplicate_filtering:
-                for i in range(len(data)):
-                    for j in range(len(data[i])):
-                        if skip_duplicate_filtering:
-                                temp = numpy.zeros((len(data[i][j]),3), dtype=numpy.int32)
-                                k = 0
-                                for key, count in data[i][j].iteritems():
-                                    temp[k, :] = (key[0], key[1], count)
-                                    self.stats['pcr_duplicates'] += count - 1
-                                    k += 1
-                                data[i][j] = temp
-                                new_reads += numpy.sum(data[i][j][:, 2])
-                        else:
-                            data[i][j] = numpy.array(data[i][j].keys(), dtype=numpy.int32)
-                            new_reads += data[i][j].shape[0]
-                if new_reads > 0 and (a > 0 or not skip_duplicate_filtering):
-                    if self.re:
-                        self._find_fend_pairs(data, fend_pairs, skip_duplicate_filtering)
-                    else:
-                        self._find_bin_pairs(data, fend_pairs, skip_duplicate_filtering)
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rRead %i validly-mapped read pairs.\n") % (' ' * 50, new_reads),
-            total_reads += new_reads
-            del data
+            present_pairs.append(filepair)
+        if processes > 1 and len(present_pairs) > 1:
+            total_reads += self._load_files_in_parallel(fendfilename, present_pairs, 'bam', fend_pairs,
+                                                        skip_duplicate_filtering, chunksize, buffersize, processes,
+                                                        threads)
+        else:
+            for filepair in present_pairs:
+                if not self.silent:
+                    print >> sys.stderr, ("Loading data from %s and %s...") % (filepair[0].split('/')[-1],
+                                                                              filepair[1].split('/')[-1]),
+                total_reads += self._load_read_pair_chunks(self._read_bam_chunks(filepair, chunksize, threads),
+                                                           filepair[1], fend_pairs, skip_duplicate_filtering,
+                                                           buffersize)
         if skip_duplicate_filtering:
             self.stats['total_reads'] = total_reads + self.stats['chr_not_in_fends']
         else:
             self.stats['total_reads'] = total_reads + self.stats['chr_not_in_fends'] + self.stats['pcr_duplicates']
         if self.re:
             self._clean_fend_pairs(fend_pairs)
-        total_fend_pairs = 0
-        for i in range(len(fend_pairs)):
-            for j in range(len(fend_pairs[i])):
-                total_fend_pairs += len(fend_pairs[i][j])
+        total_fend_pairs = self._count_fend_pairs(fend_pairs)
         if total_fend_pairs == 0:
             if not self.silent:
                 print >> sys.stderr, ("No valid data was loaded.\n"),
@@ -660,11 +904,11 @@ class HiCData(object):
                 fend_pairs[chr1][chr2][(fend2 - chr_indices[chr2], fend1 - chr_indices[chr1])] = count
         input.close()
         self.stats['total_reads'] = total_reads
-        self._clean_fend_pairs(fend_pairs)
-        total_fend_pairs = 0
         for i in range(len(fend_pairs)):
             for j in range(len(fend_pairs[i])):
-                total_fend_pairs += len(fend_pairs[i][j])
+                fend_pairs[i][j] = self._fend_pair_runs_from_dict(fend_pairs[i][j])
+        self._clean_fend_pairs(fend_pairs)
+        total_fend_pairs = self._count_fend_pairs(fend_pairs)
         if total_fend_pairs == 0:
             if not self.silent:
                 print >> sys.stderr, ("No valid data was loaded.\n"),
@@ -734,10 +978,10 @@ class HiCData(object):
                 bin_pairs[chr1][chr2][(bin2 - chr_indices[chr2], bin1 - chr_indices[chr1])] = count
         input.close()
         self.stats['total_reads'] = total_reads
-        total_bin_pairs = 0
         for i in range(len(bin_pairs)):
             for j in range(len(bin_pairs[i])):
-                total_bin_pairs += len(bin_pairs[i][j])
+                bin_pairs[i][j] = self._fend_pair_runs_from_dict(bin_pairs[i][j])
+        total_bin_pairs = self._count_fend_pairs(bin_pairs)
         if total_bin_pairs == 0:
             if not self.silent:
                 print >> sys.stderr, ("No valid data was loaded.\n"),
@@ -1188,20 +1432,11 @@ class HiCData(object):
                 mapped_fends[valid, :2] = mapped_fends[valid, :2] * 2 - 1 + signs[valid, :2]
                 if not self.silent:
                     print >> sys.stderr, ("\r%s\rCounting fend pairs...") % (' ' * 50),
-                for k in valid:
-                    key = (mapped_fends[k, 0], mapped_fends[k, 1])
-                    if key not in fend_pairs[i][j]:
-                        if skip_duplicate_filtering:
-                            fend_pairs[i][j][key] = data[i][j][k, 2]
-                        else:
-                            fend_pairs[i][j][key] = 1
-                    else:
-                        if skip_duplicate_filtering:
-                            fend_pairs[i][j][key] += data[i][j][k, 2]
-                        else:
-                            fend_pairs[i][j][key] += 1
-        if not self.silent and not skip_duplicate_filtering:
-            print >> sys.stderr, ("Done\n"),
+                if skip_duplicate_filtering:
+                    counts = data[i][j][valid, 2]
+                else:
+                    counts = numpy.ones(valid.shape[0], dtype=numpy.int64)
+                self._add_fend_pairs(fend_pairs[i][j], mapped_fends[valid, 0], mapped_fends[valid, 1], counts)
         return None
 
     def _find_bin_pairs(self, data, bin_pairs, skip_duplicate_filtering=False):
@@ -1252,73 +1487,74 @@ class HiCData(object):
                 # convert to bin paired
                 if not self.silent:
                     print >> sys.stderr, ("\r%s\rCounting bin pairs...") % (' ' * 50),
-                for k in valid:
-                    key = (mapped_bins[k, 0], mapped_bins[k, 1])
-                    if key not in bin_pairs[i][j]:
-                        if skip_duplicate_filtering:
-                            bin_pairs[i][j][key] = data[i][j][k, 2]
-                        else:
-                            bin_pairs[i][j][key] = 1
-                    else:
-                        if skip_duplicate_filtering:
-                            bin_pairs[i][j][key] += data[i][j][k, 2]
-                        else:
-                            bin_pairs[i][j][key] += 1
-        if not self.silent and not skip_duplicate_filtering:
-            print >> sys.stderr, ("Done\n"),
+                if skip_duplicate_filtering:
+                    counts = data[i][j][valid, 2]
+                else:
+                    counts = numpy.ones(valid.shape[0], dtype=numpy.int64)
+                self._add_fend_pairs(bin_pairs[i][j], mapped_bins[valid, 0], mapped_bins[valid, 1], counts)
+        return None
+
+    def _add_fend_pairs(self, runs, fends1, fends2, counts):
+        """Add counts for chromosome-relative fend pairs to a list of sorted runs of packed keys and counts."""
+        keys = (fends1.astype(numpy.int64) << 32) | fends2.astype(numpy.int64)
+        runs.append(self._reduce_fend_pairs(keys, counts.astype(numpy.int64)))
+        self._merge_fend_pair_runs(runs)
         return None
 
+    def _reduce_fend_pairs(self, keys, counts):
+        """Return sorted unique keys and the summed counts for each."""
+        if keys.shape[0] == 0:
+            return keys, counts
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        counts = counts[order]
+        del order
+        starts = numpy.r_[0, numpy.where(keys[1:] != keys[:-1])[0] + 1]
+        return keys[starts], numpy.add.reduceat(counts, starts)
+
+    def _merge_fend_pair_runs(self, runs, final=False):
+        """Merge runs of sorted keys and counts, returning the merged keys and counts if 'final' is True."""
+        # only merge runs of similar size so each key is resorted a logarithmic number of times
+        while len(runs) > 1 and (final or runs[-1][0].shape[0] * 2 >= runs[-2][0].shape[0]):
+            keys, counts = runs.pop()
+            runs[-1] = self._reduce_fend_pairs(numpy.r_[runs[-1][0], keys], numpy.r_[runs[-1][1], counts])
+            del keys, counts
+        if not final:
+            return None
+        if len(runs) == 0:
+            runs.append((numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)))
+        return runs[0]
+
+    def _fend_pair_runs_from_dict(self, pairs):
+        """Convert a dictionary of fend pair counts into a list of sorted runs."""
+        runs = []
+        if len(pairs) > 0:
+            fends = numpy.array(pairs.keys(), dtype=numpy.int64)
+            self._add_fend_pairs(runs, fends[:, 0], fends[:, 1], numpy.array(pairs.values(), dtype=numpy.int64))
+        return runs
+
+    def _count_fend_pairs(self, fend_pairs):
+        """Merge all fend pair runs and return the total number of unique fend pairs."""
+        total_fend_pairs = 0
+        for i in range(len(fend_pairs)):
+            for j in range(len(fend_pairs[i])):
+                total_fend_pairs += self._merge_fend_pair_runs(fend_pairs[i][j], final=True)[0].shape[0]
+        return total_fend_pairs
+
     def _clean_fend_pairs(self, fend_pairs):
-        chr_indices = self.fends['chr_indices'][...]
         # remove fend pairs from same fend or opposite strand adjacents
         for i in range(len(fend_pairs)):
-            for j in range(0, chr_indices[i + 1] - chr_indices[i] - 2, 2):
-                # same fend
-                name = (j, j)
-                if name in fend_pairs[i][i]:
-                    self.stats['same_fragment'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-                name = (j + 1, j + 1)
-                if name in fend_pairs[i][i]:
-                    self.stats['same_fragment'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-                # same fend
-                name = (j, j + 1)
-                if name in fend_pairs[i][i]:
-                    self.stats['same_fragment'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-                # same fend
-                name = (j + 1, j)
-                if name in fend_pairs[i][i]:
-                    self.stats['same_fragment'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-                # adjacent fends, opposite strands
-                name = (j, j + 3)
-                if name in fend_pairs[i][i]:
-                    self.stats['failed_cut'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-                name = (j + 1, j + 2)
-                if name in fend_pairs[i][i]:
-                    self.stats['failed_cut'] += fend_pairs[i][i][name]
-                    del fend_pairs[i][i][name]
-            j = chr_indices[i + 1] - chr_indices[i] - 2
-            # same fend
-            name = (j, j)
-            if name in fend_pairs[i][i]:
-                self.stats['same_fragment'] += fend_pairs[i][i][name]
-                del fend_pairs[i][i][name]
-            name = (j + 1, j + 1)
-            if name in fend_pairs[i][i]:
-                self.stats['same_fragment'] += fend_pairs[i][i][name]
-                del fend_pairs[i][i][name]
-            name = (j, j + 1)
-            if name in fend_pairs[i][i]:
-                self.stats['same_fragment'] += fend_pairs[i][i][name]
-                del fend_pairs[i][i][name]
-            name = (j + 1, j)
-            if name in fend_pairs[i][i]:
-                self.stats['same_fragment'] += fend_pairs[i][i][name]
-                del fend_pairs[i][i][name]
+            keys, counts = self._merge_fend_pair_runs(fend_pairs[i][i], final=True)
+            fends1 = keys >> 32
+            fends2 = keys & (2 ** 32 - 1)
+            # same fragment
+            same = (fends1 / 2) == (fends2 / 2)
+            # adjacent fends, opposite strands
+            failed = (((fends1 % 2) == 0) & (fends2 == fends1 + 3)) | (((fends1 % 2) == 1) & (fends2 == fends1 + 1))
+            self.stats['same_fragment'] += int(numpy.sum(counts[same]))
+            self.stats['failed_cut'] += int(numpy.sum(counts[failed]))
+            valid = numpy.where(numpy.logical_not(same | failed))[0]
+            fend_pairs[i][i] = [(keys[valid], counts[valid])]
         return None
 
     def _parse_fend_pairs(self, fend_pairs):
@@ -1332,32 +1568,26 @@ class HiCData(object):
         # determine number of cis pairs
         cis_count = 0
         for i in range(len(fend_pairs)):
-            cis_count += len(fend_pairs[i][i])
+            cis_count += self._merge_fend_pair_runs(fend_pairs[i][i], final=True)[0].shape[0]
         self.stats['valid_cis_pairs'] = cis_count
         # create cis array
         self.cis_data = numpy.empty((cis_count, 3), dtype=numpy.int32)
         pos = 0
-        # fill in each chromosome's cis interactions
+        # fill in each chromosome's cis interactions, already sorted by packed key
         for i in range(len(fend_pairs)):
-            if len(fend_pairs[i][i]) == 0:
-                continue
-            chr_start = pos
-            for key, count in fend_pairs[i][i].iteritems():
-                self.cis_data[pos, :2] = key
-                self.cis_data[pos, 2] = count
-                pos += 1
+            keys, counts = self._merge_fend_pair_runs(fend_pairs[i][i], final=True)
             fend_pairs[i][i] = None
-            # sort interactions
-            order = numpy.lexsort((self.cis_data[chr_start:pos, 1], self.cis_data[chr_start:pos, 0]))
-            self.cis_data[chr_start:pos, :] = self.cis_data[order + chr_start, :]
-            self.cis_data[chr_start:pos, :2] += chr_indices[i]
-            del order
+            self.cis_data[pos:(pos + keys.shape[0]), 0] = (keys >> 32) + chr_indices[i]
+            self.cis_data[pos:(pos + keys.shape[0]), 1] = (keys & (2 ** 32 - 1)) + chr_indices[i]
+            self.cis_data[pos:(pos + keys.shape[0]), 2] = counts
+            pos += keys.shape[0]
+            del keys, counts
         self.stats['valid_cis_reads'] += numpy.sum(self.cis_data[:, 2])
         # determine number of trans pairs
         trans_count = 0
         for i in range(len(fend_pairs)):
             for j in range(i + 1, len(fend_pairs)):
-                trans_count += len(fend_pairs[j][i])
+                trans_count += self._merge_fend_pair_runs(fend_pairs[j][i], final=True)[0].shape[0]
         self.stats['valid_trans_pairs'] = trans_count
         # create trans array
         self.trans_data = numpy.empty((trans_count, 3), dtype=numpy.int32)
@@ -1366,16 +1596,13 @@ class HiCData(object):
         for i in range(len(fend_pairs) - 1):
             chr1_start = pos
             for j in range(i + 1, len(fend_pairs)):
-                if len(fend_pairs[j][i]) == 0:
-                    continue
-                chr2_start = pos
-                for key, count in fend_pairs[j][i].iteritems():
-                    self.trans_data[pos, :2] = key
-                    self.trans_data[pos, 2] = count
-                    pos += 1
+                keys, counts = self._merge_fend_pair_runs(fend_pairs[j][i], final=True)
                 fend_pairs[j][i] = None
-                self.trans_data[chr2_start:pos, 0] += chr_indices[i]
-                self.trans_data[chr2_start:pos, 1] += chr_indices[j]
+                self.trans_data[pos:(pos + keys.shape[0]), 0] = (keys >> 32) + chr_indices[i]
+                self.trans_data[pos:(pos + keys.shape[0]), 1] = (keys & (2 ** 32 - 1)) + chr_indices[j]
+                self.trans_data[pos:(pos + keys.shape[0]), 2] = counts
+                pos += keys.shape[0]
+                del keys, counts
             # sort interactions
             order = numpy.lexsort((self.trans_data[chr1_start:pos, 1], self.trans_data[chr1_start:pos, 0]))
             self.trans_data[chr1_start:pos, :] = self.trans_data[order + chr1_start, :]
@@ -1423,7 +1650,7 @@ class HiCData(object):
         # determine number of cis pairs
         cis_count = 0
         for i in range(len(fend_pairs)):
-            cis_count += len(fend_pairs[i][i])
+            cis_count += self._merge_fend_pair_runs(fend_pairs[i][i], final=True)[0].shape[0]
         self.stats['valid_cis_pairs'] = cis_count
         # determine number of bin pairs present
         cis_count = 0
@@ -1435,12 +1662,13 @@ class HiCData(object):
             mapping = (self.fends['fends']['mid'][chr_indices[i]:chr_indices[i + 1]] -
                        bins['start'][bin_indices[i]]) / binsize
             n = bin_indices[i + 1] - bin_indices[i]
-            data = numpy.zeros(n * (n + 1) / 2, dtype=numpy.int32)
-            for key, count in fend_pairs[i][i].iteritems():
-                bin1 = mapping[key[0]]
-                bin2 = mapping[key[1]]
-                index = bin1 * (n - 1) - (bin1 * (bin1 - 1) / 2) + bin2
-                data[index] += count
+            keys, counts = self._merge_fend_pair_runs(fend_pairs[i][i], final=True)
+            bin1 = mapping[keys >> 32].astype(numpy.int64)
+            bin2 = mapping[keys & (2 ** 32 - 1)].astype(numpy.int64)
+            del keys
+            index = bin1 * (n - 1) - (bin1 * (bin1 - 1) / 2) + bin2
+            data = numpy.bincount(index, weights=counts, minlength=(n * (n + 1) / 2)).astype(numpy.int32)
+            del bin1, bin2, index, counts
             indices.append(numpy.where(data > 0)[0])
             cis_count += indices[-1].shape[0]
             fend_pairs[i][i] = data[indices[-1]]
@@ -1464,8 +1692,8 @@ class HiCData(object):
         trans_count = 0
         for i in range(len(fend_pairs)):
             for j in range(i + 1, len(fend_pairs)):
-                trans_count += len(fend_pairs[j][i])
-        self.stats['valid_trans_pairs'] = trans_count        
+                trans_count += self._merge_fend_pair_runs(fend_pairs[j][i], final=True)[0].shape[0]
+        self.stats['valid_trans_pairs'] = trans_count
         # determine number of bin pairs present
         trans_count = 0
         indices = []
@@ -1479,11 +1707,11 @@ class HiCData(object):
                 mapping2 = (self.fends['fends']['mid'][chr_indices[j]:chr_indices[j + 1]] -
                             bins['start'][bin_indices[j]]) / binsize
                 m = bin_indices[j + 1] - bin_indices[j]
-                data = numpy.zeros((n, m), dtype=numpy.int32)
-                for key, count in fend_pairs[j][i].iteritems():
-                    bin1 = mapping1[key[0]]
-                    bin2 = mapping2[key[1]]
-                    data[bin1, bin2] += count
+                keys, counts = self._merge_fend_pair_runs(fend_pairs[j][i], final=True)
+                index = mapping1[keys >> 32].astype(numpy.int64) * m + mapping2[keys & (2 ** 32 - 1)]
+                del keys
+                data = numpy.bincount(index, weights=counts, minlength=(n * m)).astype(numpy.int32).reshape(n, m)
+                del index, counts
                 indices[j].append(numpy.where(data > 0))
                 trans_count += indices[j][-1][0].shape[0]
                 fend_pairs[j][i] = data[indices[j][i]]
@@ -1559,3 +1787,112 @@ class HiCData(object):
         if not self.silent:
             print >> sys.stderr, ("Done\n"),
         return None
+
+
+def _find_name_keys(hashes1, checks1, hashes2, checks2):
+    """Return int64 keys for two sets of reads that are equal only for reads whose name hashes both match."""
+    # a single 64-bit hash can pair colliding read names with the wrong mates, so a second hash confirms each match
+    hashes = numpy.r_[hashes1, hashes2]
+    checks = numpy.r_[checks1, checks2]
+    if hashes.shape[0] == 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.lexsort((checks, hashes))
+    hashes = hashes[order]
+    checks = checks[order]
+    keys = numpy.empty(order.shape[0], dtype=numpy.int64)
+    keys[order] = numpy.cumsum(numpy.r_[0, (hashes[1:] != hashes[:-1]) | (checks[1:] != checks[:-1])])
+    return keys[:hashes1.shape[0]], keys[hashes1.shape[0]:]
+
+
+def _load_read_pairs_process(args):
+    """Load one RAW file or BAM file pair in a worker process, returning the files holding its fend pair counts and its statistics."""
+    (fendfilename, fname, filetype, maxinsert, insert_bins, skip_duplicate_filtering, chunksize, buffersize,
+     threads, tempdir) = args
+    start_time = time.time()
+    if filetype == 'raw':
+        data = HiCData(fname, 'w', silent=True)
+    else:
+        data = HiCData(fname[1], 'w', silent=True)
+    data.maxinsert = maxinsert
+    data._open_fends(fendfilename)
+    data.insert_distribution = numpy.zeros((insert_bins.shape[0], 2), dtype=numpy.int32)
+    data.insert_distribution[:, 1] = insert_bins
+    fend_pairs = []
+    for i in range(len(data.chr2int)):
+        fend_pairs.append([])
+        for j in range(i + 1):
+            fend_pairs[i].append([])
+    if filetype == 'raw':
+        chunks = data._read_raw_chunks(fname, chunksize)
+    else:
+        chunks = data._read_bam_chunks(fname, chunksize, threads)
+    new_reads = data._load_read_pair_chunks(chunks, fname, fend_pairs, skip_duplicate_filtering, buffersize)
+    # pickled results of 2GB or more can't be sent back through the pool, so only the file names are returned
+    spills = []
+    for i in range(len(fend_pairs)):
+        spills.append([])
+        for j in range(i + 1):
+            spills[i].append([])
+    data._spill_fend_pair_runs(fend_pairs, spills, tempfile.mkdtemp(prefix='hifive_', dir=tempdir))
+    data.fends.close()
+    extra = {}
+    for key in ['non_cis_invalid_insert', 'different_fragment_invalid_insert']:
+        if key in data.__dict__:
+            extra[key] = data[key]
+    return (fname, new_reads, spills, data.stats, data.insert_distribution[:, 0], extra,
+            new_reads / max(time.time() - start_time, 1e-6))
+
+
+def _map_dataset(filename, dataset):
+    """Return a copy-on-write memory map of a contiguous, uncompressed HDF5 dataset or None if it can't be mapped."""
+    if (dataset.chunks is not None or dataset.compression is not None or dataset.dtype.hasobject or
+            len(dataset.shape) == 0 or dataset.size == 0):
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return numpy.memmap(filename, mode='c', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+def _load_lazy_dataset(obj, datafile, key):
+    """Memory-map a dataset into obj or mark it to be read on first access."""
+    mapped = _map_dataset(obj.file, datafile[key])
+    if mapped is None:
+        obj.__dict__.pop(key, None)
+        obj._lazy[key] = True
+    else:
+        obj[key] = mapped
+    return None
+
+
+def _read_lazy_dataset(obj, key):
+    """Read a dataset marked by _load_lazy_dataset into obj."""
+    lazy = obj.__dict__.get('_lazy')
+    if lazy is None or key not in lazy:
+        raise AttributeError("'%s' object has no attribute '%s'" % (obj.__class__.__name__, key))
+    datafile = h5py.File(obj.file, 'r')
+    obj.__dict__[key] = datafile[key][...]
+    datafile.close()
+    del lazy[key]
+    return obj.__dict__[key]
+
+
+def _reopen_hdf5_file(h5file):
+    """Close every handle this process holds on h5file's file and return a new read-only handle to it."""
+    # HDF5 keeps one underlying file, and so one inherited descriptor, for all handles on the same path, so a
+    # forked process only gets its own descriptor once all of them are closed
+    filename = os.path.abspath(h5file.filename)
+    for fid in h5py.h5f.get_obj_ids(types=h5py.h5f.OBJ_FILE):
+        if os.path.abspath(fid.name) == filename:
+            h5py.File(fid).close()
+    return h5py.File(filename, 'r')
+
+
+def _materialize_lazy_datasets(obj):
+    """Read all lazily-loaded datasets of obj into memory so its h5dict can be safely overwritten."""
+    for key in obj.__dict__.get('_lazy', {}).keys():
+        _read_lazy_dataset(obj, key)
+    for key, value in obj.__dict__.items():
+        if isinstance(value, numpy.memmap):
+            obj.__dict__[key] = numpy.array(value)
+    return None
@@ -14,9 +14,11 @@ API Documentation
 """
 
 import sys
+import multiprocessing
 
 import numpy
 import scipy
+import scipy.sparse.linalg
 import h5py
 try:
     from mpi4py import MPI
@@ -28,10 +30,15 @@ except:
     pass
 
 import libraries._hic_domains as _hic_domains
+import libraries._hic_interactions as _hic_interactions
 from libraries.hmm import HMM
 import hic_binning
+from hic_data import _reopen_hdf5_file
 import plotting
 
+# the project shared with forked chromosome workers
+_TAD_project = None
+
 
 class TAD( object ):
     """
@@ -39,7 +46,18 @@ class TAD( object ):
 
     def __init__(self, hic, silent=False):
         self.hic = hic
-        self.silent = silent
+        if 'mpi4py' in sys.modules.keys():
+            self.comm = MPI.COMM_WORLD
+            self.rank = self.comm.Get_rank()
+            self.num_procs = self.comm.Get_size()
+        else:
+            self.comm = None
+            self.rank = 0
+            self.num_procs = 1
+        if self.rank == 0:
+            self.silent = silent
+        else:
+            self.silent = True
 
     def __getitem__(self, key):
         """Dictionary-like lookup."""
@@ -53,8 +71,7 @@ class TAD( object ):
         self.__dict__[key] = value
         return None
 
-    """
-    def find_BI_TADs(self, binsize, width, minbins, maxbins, chroms=[]):
+    def find_BI_TADs(self, binsize, width, minbins, maxbins, chroms=[], processes=1):
         if isinstance(chroms, str):
             chroms = [chroms]
         if len(chroms) == 0:
@@ -63,37 +80,12 @@ class TAD( object ):
         self.minsize = self.binsize * max(1, int(minbins))
         self.maxsize = self.binsize * (int(maxbins) + 1)
         self.width = int(width) * self.binsize
-        maxsize = self.binsize * (int(maxbins) + int(width) + 1)
-        self.TADs = {}
-        for chrom in chroms:
-            self.TADs[chrom] = []
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding heatmap for chromosome %s...") % (' ' * 80, chrom),
-            temp = self.hic.cis_heatmap(chrom, binsize=binsize, datatype='enrichment', arraytype='compact',
-                                        maxdistance=maxsize, returnmapping=True)
-            if temp is None:
-                continue
-            data, mapping = temp
-            print >> sys.stderr, ("\rFinding BI scores for chromosome %s...") % (chrom),
-            BIs = numpy.zeros((data.shape[0], maxbins + 1, 2), dtype=numpy.float32)
-            BIs.fill(-numpy.inf)
-            _hic_domains.find_BIs(data, BIs, minbins, maxbins, width)
-            path = numpy.zeros(data.shape[0], dtype=numpy.int32)
-            path_scores = numpy.zeros(data.shape[0], dtype=numpy.float64)
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding optimal domains for chromosome %s...") % (' ' * 80, chrom),
-            _hic_domains.find_BI_path(BIs, path, path_scores, minbins, maxbins)
-            i = path.shape[0] - 1
-            domains = []
-            while i > 0:
-                if path[i] != 1:
-                    domains.append([i - path[i] + 1, i])
-                    self.TADs[chrom].append([mapping[domains[-1][0], 0], mapping[domains[-1][1], 1]])
-                i -= path[i]
+        self.TADs = self._find_chromosome_results(_find_BI_TADs, chroms, (self.binsize, int(width), int(minbins),
+                                                  int(maxbins)), processes)
         if not self.silent:
             print >> sys.stderr, ("\r%s\rFinished finding TADs\n") % (' ' * 80),
 
-    def find_arrowhead_TADs(self, binsize, minbins, maxbins, chroms=[]):
+    def find_arrowhead_TADs(self, binsize, minbins, maxbins, chroms=[], processes=1):
         if isinstance(chroms, str):
             chroms = [chroms]
         if len(chroms) == 0:
@@ -101,63 +93,13 @@ class TAD( object ):
         self.binsize = int(binsize)
         self.minsize = self.binsize * max(1, int(minbins))
         self.maxsize = self.binsize * (int(maxbins) + 1)
-        self.TADs = {}
-        for chrom in chroms:
-            self.TADs[chrom] = []
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding heatmap for chromosome %s...") % (' ' * 80, chrom),
-            temp = self.hic.cis_heatmap(chrom, binsize=binsize * 16, datatype='fend', arraytype='full', returnmapping=True)
-            if temp is None:
-                continue
-            temp_data, mapping = temp
-            heatmap = numpy.zeros((temp_data.shape[0] * 16, temp_data.shape[0] * 16, 2), dtype=numpy.float32)
-            temp = numpy.zeros(heatmap.shape, dtype=numpy.float32)
-            for i in range(16):
-                for j in range(16):
-                    heatmap[i::16, j::16, :] += temp_data
-            temp_data = self.hic.cis_heatmap(chrom, binsize=binsize * 4, datatype='fend', arraytype='full', start=mapping[0, 0], stop=mapping[-1, 1])
-            for i in range(4):
-                for j in range(4):
-                    temp[i::4, j::4, :] += temp_data
-            where = numpy.where(temp[:, :, 0] > 0)
-            heatmap[where[0], where[1], :] = temp[where[0], where[1], :]
-            temp_data, mapping = self.hic.cis_heatmap(chrom, binsize=binsize, datatype='fend', arraytype='full', start=mapping[0, 0], stop=mapping[-1, 1], returnmapping=True)
-            where = numpy.where(temp_data[:, :, 0] > 0)
-            heatmap[where[0], where[1], :] = temp_data[where[0], where[1], :]
-            data = numpy.zeros((heatmap.shape[0], maxbins - 1, 2), dtype=numpy.float32)
-            for i in range(heatmap.shape[0] - 1):
-                data[i, :min(data.shape[1], data.shape[0] - i - 1), :] = heatmap[i, (i + 1):min(data.shape[1] + i + 1, data.shape[0]), :]
-            where = numpy.where(data[:, :, 1] > 0)
-            data[where[0], where[1], 0] /= data[where[0], where[1], 1]
-            scores = numpy.zeros((data.shape[0], data.shape[1]), dtype=numpy.float32)
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding arrowhead transformation for chromosome %s...") % (' ' * 80, chrom),
-            _hic_domains.find_arrowhead_transformation(data, scores, maxbins)
-            sums = numpy.zeros(data.shape, dtype=numpy.float32)
-            signs = numpy.zeros(data.shape, dtype=numpy.float32)
-            variances = numpy.zeros((data.shape[0], data.shape[1], 2, 2), dtype=numpy.float32)
-            domain_scores = numpy.zeros(scores.shape, dtype=numpy.float32)
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding arrowhead scoring for chromosome %s...") % (' ' * 80, chrom),
-            _hic_domains.find_arrowhead_scores(scores, sums, signs, variances, domain_scores, minbins)
-            path = numpy.zeros(data.shape[0], dtype=numpy.int32)
-            path_scores = numpy.zeros(data.shape[0], dtype=numpy.float64)
-            if not self.silent:
-                print >> sys.stderr, ("\r%s\rFinding optimal domains for chromosome %s...") % (' ' * 80, chrom),
-            _hic_domains.find_arrowhead_path(domain_scores, path, path_scores, minbins, maxbins)
-            i = path.shape[0] - 1
-            domains = []
-            while i > 0:
-                if path[i] != 1:
-                    domains.append([i - path[i], i])
-                    self.TADs[chrom].append([mapping[domains[-1][0], 0], mapping[domains[-1][1], 1]])
-                i -= path[i]
+        self.TADs = self._find_chromosome_results(_find_arrowhead_TADs, chroms, (self.binsize, int(minbins),
+                                                  int(maxbins)), processes)
         if not self.silent:
             print >> sys.stderr, ("\r%s\rFinished finding TADs\n") % (' ' * 80),
-    """
 
     def find_DI_TADs(self, binsize=20000, step=2500, window=500000, minsize=25000, maxsize=1500000, smoothing=6,
-                     joindomains=True, chroms=[]):
+                     joindomains=True, chroms=[], processes=1, blocksize=None):
         self.binsize = int(binsize)
         self.step = int(step)
         self.window = int(window)
@@ -169,6 +111,9 @@ class TAD( object ):
             chroms = [chroms]
         if len(chroms) == 0:
             chroms = list(self.hic.fends['chromosomes'][...])
+        # only the current chromosome's (or block's) compact array is held in memory by each process
+        all_scores = self._find_chromosome_results(_find_DI_scores, chroms, (self.step, self.window, steps,
+                                                   blocksize), processes)
         pos_sum = 0.0
         pos_2sum = 0.0
         pos_count = 0
@@ -177,29 +122,9 @@ class TAD( object ):
         neg_count = 0
         training_seqs = []
         for chrom in chroms:
-            temp = self.hic.cis_heatmap(chrom, binsize=self.step, maxdistance=self.window, datatype='fend',
-                                        arraytype='compact', returnmapping=True)
-            if temp is None:
+            if all_scores[chrom] is None:
                 continue
-            num_bins = temp[0].shape[1]
-            scores = []
-            positions = []
-            for i in range(num_bins, temp[0].shape[0] - num_bins - steps + 1):
-                observed0 = 0
-                expected0 = 0.0
-                observed1 = 0
-                expected1 = 0.0
-                for j in range(steps):
-                    temp1 = numpy.arange(steps - j - 1, num_bins - j)
-                    observed0 += numpy.sum(temp[0][i + j, temp1, 0])
-                    expected0 += numpy.sum(temp[0][i + j, temp1, 1])
-                    temp1 = numpy.arange(i + steps - num_bins - 1, i)
-                    temp2 = i + j - temp1 - 1
-                    observed1 += numpy.sum(temp[0][temp1, temp2, 0])
-                    expected1 += numpy.sum(temp[0][temp1, temp2, 1])
-                if observed0 > 0 and observed1 > 0:
-                    scores.append(numpy.log(observed0 * expected1 / (observed1 * expected0)))
-                    positions.append((temp[1][i, 0] + temp[1][i + steps - 1, 1]) / 2)
+            scores, positions = all_scores[chrom]
             self.DIs[chrom] = numpy.zeros(len(scores), dtype=numpy.dtype([('position', numpy.int32),
                                                                           ('score', numpy.float64)]))
             scores = numpy.array(scores)
@@ -265,7 +190,7 @@ class TAD( object ):
                     if stop - start >= minsize:
                         tads.append([start, stop])
                     start = None
-            self.TADs[chrom] = numpy.array(tads, dtype=numpy.int32)
+            self.TADs[chrom] = numpy.array(tads, dtype=numpy.int32).reshape(-1, 2)
             where = numpy.where(self.TADs[chrom][1:, 0] < self.TADs[chrom][:-1, 1])[0]
             mids = (self.TADs[chrom][where, 1] + self.TADs[chrom][where + 1, 0]) / 2
             self.TADs[chrom][where, 1] = mids
@@ -330,6 +255,64 @@ class TAD( object ):
                     stops = numpy.array(new_stops, dtype=numpy.int32)
 
 
+    def _find_chromosome_results(self, function, chroms, args, processes):
+        """Return a dictionary of function(hic, chrom, *args) for each chromosome, found across MPI ranks or a pool of 'processes' worker processes."""
+        global _TAD_project
+        if self.hic.binned is None:
+            chr_indices = self.hic._find_fend_array('chr_indices')
+            mids = self.hic._find_fend_array('fends', 'mid')
+        else:
+            chr_indices = self.hic._find_fend_array('bin_indices')
+            mids = self.hic._find_fend_array('bins', 'mid')
+        sizes = {}
+        for chrom in chroms:
+            chrint = self.hic.chr2int[chrom]
+            if chr_indices[chrint + 1] > chr_indices[chrint]:
+                sizes[chrom] = mids[chr_indices[chrint + 1] - 1] - mids[chr_indices[chrint]]
+            else:
+                sizes[chrom] = 0
+        # going through chromosomes largest first evens out the MPI ranks' loads and keeps a pool from waiting on
+        # one big chromosome after the rest have finished
+        chroms = sorted(chroms, key=lambda x: sizes[x], reverse=True)
+        results = {}
+        if self.num_procs > 1:
+            # give each chromosome to the rank with the least total sequence so far
+            loads = numpy.zeros(self.num_procs, dtype=numpy.int64)
+            for chrom in chroms:
+                rank = numpy.argmin(loads)
+                loads[rank] += sizes[chrom]
+                if rank == self.rank:
+                    results[chrom] = function(self.hic, chrom, *(args + (True,)))
+            if self.rank == 0:
+                for i in range(1, self.num_procs):
+                    results.update(self.comm.recv(source=i, tag=11))
+                for i in range(1, self.num_procs):
+                    self.comm.send(results, dest=i, tag=11)
+            else:
+                self.comm.send(results, dest=0, tag=11)
+                results = self.comm.recv(source=0, tag=11)
+        elif processes > 1 and len(chroms) > 1:
+            tasks = []
+            for chrom in chroms:
+                tasks.append((function, chrom, args + (True,)))
+            # each worker finds the project in _TAD_project when forked and reopens its files in _start_TAD_process
+            _TAD_project = self.hic
+            pool = multiprocessing.Pool(min(processes, len(tasks)), _start_TAD_process)
+            try:
+                for chrom, result in pool.imap_unordered(_find_chromosome_process, tasks):
+                    results[chrom] = result
+                    if not self.silent:
+                        print >> sys.stderr, ("\r%s\rFinished chromosome %s (%i of %i)") % (' ' * 80, chrom,
+                                                                                           len(results), len(tasks)),
+            finally:
+                pool.terminate()
+                pool.join()
+                _TAD_project = None
+        else:
+            for chrom in chroms:
+                results[chrom] = function(self.hic, chrom, *(args + (self.silent,)))
+        return results
+
     def plot_DI_tads(self, out_fname):
         if 'pyx' not in sys.modules:
             return None
@@ -437,9 +420,8 @@ class Compartment( object ):
             if self.rank == 0:
                 if (storage is None or ('%s.eigenv' % chrom not in storage and
                     '%s.correlations' % chrom not in storage)):
-                    indices = list(numpy.triu_indices(N, 1))
                     if storage is None or '%s.dbinned_expected' % chrom not in storage:
-                        if storage is None or '%s.expected' not in storage:
+                        if storage is None or '%s.expected' % chrom not in storage:
                             expected = self.hic.cis_heatmap(chrom, binsize=binsize, start=start, stop=stop,
                                 datatype='expected', arraytype='full', returnmapping=False, silent=True)[:, :, 1]
                             valid = (numpy.sum(expected > 0, axis=1) > 0).astype(numpy.int32)
@@ -447,16 +429,14 @@ class Compartment( object ):
                             positions[:, 0] = start + numpy.arange(N) * binsize
                             positions[:, 1] = positions[:, 0] + binsize
                             if storage is not None:
-                                storage.create_dataset(name='%s.expected' % chrom, data=expected[indices])
+                                _store_upper(storage, '%s.expected' % chrom, expected)
                                 storage.create_dataset(name='%s.positions' % chrom, data=positions)
                                 storage.create_dataset(name='%s.valid' % chrom, data=valid)
                         else:
-                            expected = numpy.zeros((N, N), dtype=numpy.float32)
-                            expected[indices] = storage['%s.expected' % chrom][...]
-                            expected[indices[1], indices[0]] = expected[indices]
+                            expected = _fill_symmetric(storage['%s.expected' % chrom], N, numpy.float32)
                             valid = storage['%s.valid' % chrom][...]
                             positions = storage['%s.positions' % chrom][...]
-                        if storage is None or '%s.counts' not in storage:
+                        if storage is None or '%s.counts' % chrom not in storage:
                             start_index = hic.data['cis_indices'][startfend]
                             stop_index = hic.data['cis_indices'][stopfend]
                             data = hic.data['cis_data'][start_index:stop_index, :].astype(numpy.int64)
@@ -464,36 +444,34 @@ class Compartment( object ):
                             data[:, :2] = fends['mid'][data[:, :2]]
                             data[:, :2] -= start
                             data[:, :2] /= binsize
-                            counts = numpy.bincount(data[:, 0] * N + data[:, 1], weights=data[:, 2],
-                                                    minlength=(N * N)).reshape(N, N).astype(numpy.int32)
-                            counts[indices[1], indices[0]] = counts[indices]
+                            # sum reads over only the occupied bin pairs rather than all N * N of them
+                            keys, index = numpy.unique(data[:, 0] * N + data[:, 1], return_inverse=True)
+                            counts = numpy.zeros((N, N), dtype=numpy.int32)
+                            counts.flat[keys] = numpy.bincount(index, weights=data[:, 2])
+                            del data, keys, index
+                            _mirror_upper(counts)
                             if storage is not None:
-                                storage.create_dataset(name='%s.counts' % chrom, data=counts[indices])
+                                _store_upper(storage, '%s.counts' % chrom, counts)
                         else:
-                            counts = numpy.zeros((N, N), dtype=numpy.int32)
-                            counts[indices] = storage['%s.counts' % chrom][...]
-                            counts[indices[1], indices[0]] = counts[indices]
+                            counts = _fill_symmetric(storage['%s.counts' % chrom], N, numpy.int32)
                         for i in range(1, self.num_procs):
                             self.comm.send(0, dest=i, tag=11)
                         binned_c, binned_e = self._dynamically_bin(counts, expected, valid)
+                        del counts, expected
                         if storage is not None:
-                            storage.create_dataset(name='%s.dbinned_expected' % chrom, data=binned_e[indices])
-                            storage.create_dataset(name='%s.dbinned_counts' % chrom, data=binned_c[indices])
+                            _store_upper(storage, '%s.dbinned_expected' % chrom, binned_e)
+                            _store_upper(storage, '%s.dbinned_counts' % chrom, binned_c)
                     else:
-                        binned_c = numpy.zeros((N, N), dtype=numpy.int32)
-                        binned_c[indices] = storage['%s.dbinned_counts' % chrom][...]
-                        binned_c[indices[1], indices[0]] = binned_c[indices]
-                        binned_e = numpy.zeros((N, N), dtype=numpy.float32)
-                        binned_e[indices] = storage['%s.dbinned_expected' % chrom][...]
-                        binned_e[indices[1], indices[0]] = binned_e[indices]
+                        binned_c = _fill_symmetric(storage['%s.dbinned_counts' % chrom], N, numpy.int32)
+                        binned_e = _fill_symmetric(storage['%s.dbinned_expected' % chrom], N, numpy.float32)
                         valid = storage['%s.valid' % chrom][...]
                         positions = storage['%s.positions' % chrom][...]
                         for i in range(1, self.num_procs):
                             self.comm.send(1, dest=i, tag=11)
                     corrs = self._find_correlations(binned_c, binned_e, valid)
+                    del binned_c, binned_e
                     if storage is not None:
-                        storage.create_dataset(name='%s.correlations' % chrom,
-                                               data=corrs[numpy.triu_indices(numpy.sum(valid), 1)])
+                        _store_upper(storage, '%s.correlations' % chrom, corrs)
                 else:
                     for i in range(1, self.num_procs):
                         self.comm.send(-1, dest=i, tag=11)
@@ -502,13 +480,12 @@ class Compartment( object ):
                     '%s.correlations' % chrom in storage):
                     valid = storage['%s.valid' % chrom][...]
                     N = numpy.sum(valid)
-                    indices = numpy.triu_indices(N, 1)
-                    corrs = numpy.ones((N, N), dtype=numpy.float32)
-                    corrs[indices] = storage['%s.correlations' % chrom][...]
-                    corrs[indices[1], indices[0]] = corrs[indices]
+                    corrs = _fill_symmetric(storage['%s.correlations' % chrom], N, numpy.float32)
+                    corrs[numpy.arange(N), numpy.arange(N)] = 1.0
                     positions = storage['%s.positions' % chrom][...]
                 if storage is None or '%s.eigenv' % chrom not in storage:
-                    self.eigenv[chrom] = scipy.sparse.linalg.eigs(corrs, k=1)[1][:, 0]
+                    # the correlation matrix is symmetric, so a Lanczos solver finds its leading eigenvector
+                    self.eigenv[chrom] = scipy.sparse.linalg.eigsh(corrs, k=1, which='LA')[1][:, 0]
                     if storage is not None:
                         storage.create_dataset(name="%s.eigenv" % chrom, data=self.eigenv[chrom])
                     self.positions[chrom] = positions[numpy.where(valid)[0], :]
@@ -527,7 +504,7 @@ class Compartment( object ):
                     self._find_correlations()
                 self.eigenv[chrom] = self.comm.recv(source=0, tag=11)
                 self.positions[chrom] = self.comm.recv(source=0, tag=11)
-        if self.rank == 0:
+        if self.rank == 0 and storage is not None:
             storage.close()
 
     def _dynamically_bin(self, counts=None, expected=None, valid=None):
@@ -574,46 +551,55 @@ class Compartment( object ):
             self.comm.send(binned_e[indices0, indices1], dest=0, tag=11)
         return None
 
-    def _find_correlations(self, counts=None, expected=None, valid=None):
+    def _find_correlations(self, counts=None, expected=None, valid=None, blocksize=1000):
         if self.rank == 0:
             if not self.silent:
                 print >> sys.stderr, ("\rFinding correlations"),
             valid2 = numpy.where(valid)[0]
             M = valid2.shape[0]
-            data = numpy.ones((M, M), dtype=numpy.float32)
-            indices = numpy.triu_indices(M, 1)
-            data[indices] = counts[valid2, :][:, valid2][indices]
-            data[indices] /= expected[valid2, :][:, valid2][indices]
-            data[indices[1], indices[0]] = data[indices]
+            data = counts[valid2, :][:, valid2].astype(numpy.float32)
+            data[numpy.arange(M), numpy.arange(M)] = 1.0
+            expected = expected[valid2, :][:, valid2]
+            expected[numpy.arange(M), numpy.arange(M)] = 1.0
+            data /= expected
+            del expected
             data = numpy.log(data)
             data -= numpy.mean(data, axis=1).reshape(-1, 1)
             data /= numpy.std(data, axis=1).reshape(-1, 1)
-            node_ranges = numpy.round(numpy.linspace(0, indices[0].shape[0], self.num_procs + 1)).astype(numpy.int32)
+            # split rows so each process has a similar share of the upper triangle
+            work = numpy.cumsum(M - numpy.arange(M + 1))
+            node_ranges = numpy.r_[0, numpy.searchsorted(work, numpy.linspace(0, work[-1],
+                                   self.num_procs + 1)[1:-1]), M].astype(numpy.int32)
             for i in range(1, self.num_procs):
                 self.comm.send(M, dest=i, tag=11)
                 self.comm.send(data, dest=i, tag=11)
-                self.comm.send(indices[0][node_ranges[i]:node_ranges[i + 1]], dest=i, tag=11)
-                self.comm.send(indices[1][node_ranges[i]:node_ranges[i + 1]], dest=i, tag=11)
-            indices0 = indices[0][:node_ranges[1]]
-            indices1 = indices[1][:node_ranges[1]]
+                self.comm.send(node_ranges[i:(i + 2)], dest=i, tag=11)
+            start, stop = node_ranges[:2]
         else:
             M = self.comm.recv(source=0, tag=11)
             data = self.comm.recv(source=0, tag=11)
-            indices0 = self.comm.recv(source=0, tag=11)
-            indices1 = self.comm.recv(source=0, tag=11)
-        correlations = numpy.ones((M, M), dtype=numpy.float32)
-        for i in range(indices0.shape[0]):
-            correlations[indices0[i], indices1[i]] = numpy.mean(data[indices0[i], :] * data[indices1[i], :])
+            start, stop = self.comm.recv(source=0, tag=11)
+        # correlations of standardized rows are their mean products, found a block of rows at a time as a
+        # matrix product with the rows at and after the block
+        correlations = numpy.zeros((stop - start, M - start), dtype=numpy.float32)
+        for i in range(start, stop, blocksize):
+            j = min(i + blocksize, stop)
+            correlations[(i - start):(j - start), (i - start):] = numpy.dot(data[i:j, :], data[i:, :].T)
+        correlations /= M
         if self.rank == 0:
+            del data
+            corrs = numpy.zeros((M, M), dtype=numpy.float32)
+            corrs[:stop, :] = correlations
+            del correlations
             for i in range(1, self.num_procs):
-                correlations[indices[0][node_ranges[i]:node_ranges[i + 1]],
-                      indices[1][node_ranges[i]:node_ranges[i + 1]]] = self.comm.recv(source=i, tag=11)
-            correlations[indices[1], indices[0]] = correlations[indices]
+                corrs[node_ranges[i]:node_ranges[i + 1], node_ranges[i]:] = self.comm.recv(source=i, tag=11)
+            _mirror_upper(corrs, blocksize)
+            corrs[numpy.arange(M), numpy.arange(M)] = 1.0
             if not self.silent:
                 print >> sys.stderr, ("\r%s\r") % (' ' * 80),
-            return correlations
+            return corrs
         else:
-            self.comm.send(correlations[indices0, indices1], dest=0, tag=11)
+            self.comm.send(correlations, dest=0, tag=11)
         return None
 
     def orient_eigenvectors(self, fname, storage_fname=None, higher='A'):
@@ -1052,81 +1038,89 @@ class Boundary( object ):
         windowB = window / binsize
         if 'scores' not in self.__dict__.keys():
             self.scores = {}
+        if 'binned' in self.hic.__dict__.keys() and self.hic['binned'] is not None:
+            mids = self.hic._find_fend_array('bins', 'mid')
+            chr_indices = self.hic._find_fend_array('bin_indices')
+        else:
+            mids = self.hic._find_fend_array('fends', 'mid')
+            chr_indices = self.hic._find_fend_array('chr_indices')
+        # interactions are only needed for bin offsets from 1 - widthB to windowB + widthB - 1, enough to cover
+        # every width-sized box out to window from the diagonal
+        lower = 1 - widthB
+        band_width = windowB + 2 * widthB - 1
+        num_partners = max(0, windowB - 2 * widthB + 1)
         for chrom in chroms:
             chrint = self.hic.chr2int[chrom]
-            if 'binned' in self.hic.__dict__.keys() and self.hic['binned'] is not None:
-                fends = self.hic.fends['bins'][...]
-                chr_indices = self.hic.fends['bin_indices'][...]
-            else:
-                fends = self.hic.fends['fends'][...]
-                chr_indices = self.hic.fends['chr_indices'][...]
-            start_fend = chr_indices[chrint]
-            stop_fend = chr_indices[chrint + 1]
-            while self.hic.filter[start_fend] == 0:
-                start_fend += 1
-            while self.hic.filter[stop_fend - 1] == 0:
-                stop_fend -= 1
-            start = (fends['mid'][start_fend] / binsize) * binsize
-            stop = ((fends['mid'][stop_fend - 1] - 1) / binsize + 1) * binsize
+            valid = numpy.where(self.hic.filter[chr_indices[chrint]:chr_indices[chrint + 1]] > 0)[0]
+            if valid.shape[0] == 0:
+                continue
+            start_fend = chr_indices[chrint] + valid[0]
+            stop_fend = chr_indices[chrint] + valid[-1] + 1
+            start = (mids[start_fend] / binsize) * binsize
+            stop = ((mids[stop_fend - 1] - 1) / binsize + 1) * binsize
             N = (stop - start) / binsize
-            temp = self.hic.cis_heatmap(chrom, binsize=binsize, datatype='expected', arraytype='compact',
-                                        maxdistance=window, returnmapping=False)
+            temp = self.hic.cis_heatmap(chrom, binsize=binsize, start=start, stop=stop, datatype='expected',
+                                        arraytype='compact', maxdistance=window, returnmapping=False)
             if temp is None:
                 continue
-            temp = temp[:, :, 1]
-            expected = numpy.zeros((N, N), dtype=numpy.float32)
-            for i in range(N - 1):
-                expected[i, (i + 1):min(N, i + temp.shape[1] + 1)] = temp[i, :min(N - i - 1, temp.shape[1])]
-            expected += expected.T
-            start_index = self.hic.data['cis_indices'][start_fend]
-            stop_index = self.hic.data['cis_indices'][stop_fend]
-            data = self.hic.data['cis_data'][start_index:stop_index, :].astype(numpy.int64)
-            data = data[numpy.where(self.hic.filter[data[:, 0]] * self.hic.filter[data[:, 1]])[0], :]
-            data[:, :2] = fends['mid'][data[:, :2]]
-            data[:, :2] -= start
-            data[:, :2] /= binsize
-            counts = numpy.bincount(data[:, 0] * N + data[:, 1], weights=data[:, 2],
-                                    minlength=(N * N)).reshape(N, N).astype(numpy.int32)
-            counts += counts.T
             M = N - widthB + 1
-            hm = numpy.zeros((M, M, 2), dtype=numpy.float32)
-            for i in range(widthB):
-                hm[:, :, 0] += counts[i:(M + i), :M]
-                hm[:, :, 1] += expected[i:(M + i), :M]
-            hm2 = numpy.copy(hm)
+            if M <= widthB:
+                self.scores[chrom] = numpy.zeros(0, dtype=numpy.dtype([('position', numpy.int32),
+                                                                       ('score', numpy.float32)]))
+                continue
+            band = numpy.zeros((N, band_width, 2), dtype=numpy.float64)
+            temp = temp[:, :min(temp.shape[1], band_width + lower - 1), 1]
+            band[:, (1 - lower):(temp.shape[1] + 1 - lower), 1] = temp
+            del temp
+            indices, data = self.hic._find_data_slice('cis', start_fend, stop_fend)
+            data = data[numpy.where(self.hic.filter[data[:, 0]] * self.hic.filter[data[:, 1]])[0], :]
+            bins = (mids[data[:, :2]] - start) / binsize
+            offsets = bins[:, 1] - bins[:, 0]
+            where = numpy.where(offsets < band_width + lower)[0]
+            band[:, :, 0] = numpy.bincount(bins[where, 0] * band_width + offsets[where] - lower,
+                                           weights=data[where, 2], minlength=(N * band_width)).reshape(N, -1)
+            del data
+            # mirror the diagonal and the offsets below it
+            band[:, -lower, 0] *= 2
             for i in range(1, widthB):
-                hm[:, :(M - i), :] += hm2[:, i:, :]
-                for j in range(widthB):
-                    hm[:, (M - i):, 0] += counts[j:(M + j), M:(M + i)]
-                    hm[:, (M - i):, 1] += expected[j:(M + j), M:(M + i)]
-            del counts
-            del expected
-            del hm2
-            N = hm.shape[1]
-            mapping = numpy.zeros((N, 2), dtype=numpy.int32)
-            mapping[:, 0] = numpy.arange(N) * binsize + start
-            mapping[:, 1] = numpy.arange(1, N + 1) * binsize + start
-            scores = []
-            for i in range(widthB, N):
-                if i - windowB < 0:
-                    start = i - (i / binsize) * binsize
-                else:
-                    start = i - windowB
-                if i + windowB > N:
-                    stop = i + ((N - i) / binsize) * binsize - widthB + 1
-                else:
-                    stop = i + windowB - widthB + 1
-                valid = numpy.r_[
-                            numpy.where((hm[i - widthB, start:(i - 2 * widthB + 1), 0] > 0) *
-                                        (hm[i, start:(i - 2 * widthB + 1), 0] > 0))[0] + start,
-                            numpy.where((hm[i - widthB, (i + widthB):stop, 0] > 0) *
-                                        (hm[i, (i + widthB):stop, 0] > 0))[0] + i + widthB]
-                if valid.shape[0] > 5:
-                    set1 = numpy.log(hm[i - widthB, valid, 0] / hm[i - widthB, valid, 1])
-                    set2 = numpy.log(hm[i, valid, 0] / hm[i, valid, 1])
-                    scores.append((mapping[i, 0], numpy.corrcoef(set1, set2)[0, 1]))
-            scores.sort()
-            scores = numpy.array(scores, dtype=numpy.dtype([('position', numpy.int32), ('score', numpy.float32)]))
+                band[i:, -lower - i, :] = band[:-i, i - lower, :]
+            # width-sized box sums of counts and expected for each bin and each offset out to window
+            boxes = numpy.zeros((M, windowB + 1, 2), dtype=numpy.float64)
+            where = numpy.where(numpy.arange(M).reshape(-1, 1) + numpy.arange(windowB + 1).reshape(1, -1) < M)
+            boxes[where[0], where[1], :] = _find_band_sums(band, lower, where[0], where[0] + widthB,
+                                                           where[0] + where[1], where[0] + where[1] + widthB)
+            del band
+            # compare the boxes on either side of each position across partner bins within window, skipping the
+            # boxes' own span
+            positions = numpy.arange(widthB, M).reshape(-1, 1)
+            partners = numpy.hstack((positions - windowB + numpy.arange(num_partners),
+                                     positions + widthB + numpy.arange(num_partners)))
+            valid = numpy.zeros(partners.shape, dtype=numpy.bool)
+            valid[:, :num_partners] = positions >= windowB
+            valid[:, num_partners:] = positions + windowB <= M
+            partners = numpy.minimum(numpy.maximum(partners, 0), M - 1)
+            set1 = boxes[numpy.minimum(partners, positions - widthB),
+                         numpy.minimum(numpy.abs(partners - positions + widthB), windowB), :]
+            set2 = boxes[numpy.minimum(partners, positions),
+                         numpy.minimum(numpy.abs(partners - positions), windowB), :]
+            del boxes
+            valid &= (set1[:, :, 0] > 0) & (set2[:, :, 0] > 0)
+            counts = numpy.sum(valid, axis=1)
+            old_settings = numpy.seterr(invalid='ignore', divide='ignore')
+            set1 = numpy.where(valid, numpy.log(set1[:, :, 0] / set1[:, :, 1]), 0.0)
+            set2 = numpy.where(valid, numpy.log(set2[:, :, 0] / set2[:, :, 1]), 0.0)
+            set1 -= (numpy.sum(set1, axis=1) / numpy.maximum(1, counts)).reshape(-1, 1)
+            set2 -= (numpy.sum(set2, axis=1) / numpy.maximum(1, counts)).reshape(-1, 1)
+            set1 *= valid
+            set2 *= valid
+            corrs = numpy.sum(set1 * set2, axis=1) / (numpy.sum(set1 ** 2, axis=1) *
+                                                      numpy.sum(set2 ** 2, axis=1)) ** 0.5
+            numpy.seterr(**old_settings)
+            where = numpy.where(counts > 5)[0]
+            scores = numpy.zeros(where.shape[0], dtype=numpy.dtype([('position', numpy.int32),
+                                                                    ('score', numpy.float32)]))
+            scores['position'] = positions[where, 0] * binsize + start
+            scores['score'] = numpy.clip(corrs[where], -1, 1)
             self.scores[chrom] = scores
         return None
 
@@ -1154,7 +1148,241 @@ class Boundary( object ):
         return scores
 
 
+def _upper_offset(N, row):
+    """Return the position of a row's first entry in the flattened upper triangle of an N x N matrix."""
+    return row * (N - 1) - (row * (row - 1)) / 2
+
+
+def _store_upper(storage, name, matrix, blocksize=1000):
+    """Write the flattened (row-major) upper triangle of a square matrix, excluding the diagonal, to a new
+    dataset a block of rows at a time."""
+    N = matrix.shape[0]
+    dataset = storage.create_dataset(name=name, shape=(N * (N - 1) / 2,), dtype=matrix.dtype)
+    for i in range(0, N - 1, blocksize):
+        j = min(i + blocksize, N - 1)
+        dataset[_upper_offset(N, i):_upper_offset(N, j)] = numpy.hstack([matrix[k, (k + 1):] for k in range(i, j)])
+    return None
+
+
+def _fill_symmetric(values, N, dtype, blocksize=1000):
+    """Return a symmetric N x N matrix from a flattened upper triangle, read a block of rows at a time so
+    'values' can be an HDF5 dataset."""
+    matrix = numpy.zeros((N, N), dtype=dtype)
+    for i in range(0, N - 1, blocksize):
+        j = min(i + blocksize, N - 1)
+        block = values[_upper_offset(N, i):_upper_offset(N, j)]
+        for k in range(i, j):
+            matrix[k, (k + 1):] = block[(_upper_offset(N, k) - _upper_offset(N, i)):
+                                        (_upper_offset(N, k + 1) - _upper_offset(N, i))]
+    _mirror_upper(matrix, blocksize)
+    return matrix
+
+
+def _mirror_upper(matrix, blocksize=1000):
+    """Copy the upper triangle of a square matrix into its lower triangle a block of rows at a time."""
+    N = matrix.shape[0]
+    for i in range(0, N, blocksize):
+        j = min(i + blocksize, N)
+        block = matrix[i:j, i:j]
+        lower = numpy.tril_indices(j - i, -1)
+        block[lower] = block.T[lower]
+        matrix[j:, i:j] = matrix[i:j, j:].T
+    return None
+
+
+def _find_DI_scores(hic, chrom, step, window, steps, blocksize=None, silent=True):
+    """Return the unsmoothed directionality index scores and their positions for one chromosome.
+
+    If 'blocksize' is given, the chromosome's compact heatmap is retrieved in overlapping blocks spanning about
+    this many bp so that a whole-chromosome array is never held in memory."""
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding DI scores for chromosome %s...") % (' ' * 80, chrom),
+    if blocksize is None:
+        temp = hic.cis_heatmap(chrom, binsize=step, maxdistance=window, datatype='fend', arraytype='compact',
+                               returnmapping=True)
+        if temp is None:
+            return None
+        data, mapping = temp
+        num_bins = data.shape[1]
+        first = num_bins
+        last = data.shape[0] - num_bins - steps + 1
+        start = mapping[0, 0]
+        if last <= first:
+            sums = numpy.zeros((4, 0), dtype=numpy.float64)
+        else:
+            sums = _find_DI_sums(data, steps, first, last)
+        del data
+    else:
+        # find the chromosome's bins the same way the whole-chromosome heatmap would
+        if hic.binned is None:
+            chr_indices = hic._find_fend_array('chr_indices')
+            mids = hic._find_fend_array('fends', 'mid')
+        else:
+            chr_indices = hic._find_fend_array('bin_indices')
+            mids = hic._find_fend_array('bins', 'mid')
+        chrint = hic.chr2int[chrom]
+        if chr_indices[chrint + 1] == chr_indices[chrint]:
+            return None
+        start = (mids[chr_indices[chrint]] / step) * step
+        stop = ((mids[chr_indices[chrint + 1] - 1] - start) / step + 1) * step + start
+        total_bins = (stop - start) / step
+        binbounds = numpy.zeros((total_bins, 2), dtype=numpy.int32)
+        binbounds[:, 0] = numpy.arange(total_bins) * step + start
+        binbounds[:, 1] = binbounds[:, 0] + step
+        num_bins = _hic_interactions.find_max_bin(binbounds, window) + int(hic.binned is not None)
+        first = num_bins
+        last = total_bins - num_bins - steps + 1
+        sums = numpy.zeros((4, max(0, last - first)), dtype=numpy.float64)
+        blockbins = max(1, blocksize / step)
+        found = False
+        for i in range(first, last, blockbins):
+            j = min(last, i + blockbins)
+            # each block carries a window's worth of flanking bins on either side
+            temp = hic.cis_heatmap(chrom, binsize=step, start=(start + (i - num_bins) * step),
+                                   stop=(start + (j + num_bins + steps - 1) * step), maxdistance=window,
+                                   datatype='fend', arraytype='compact')
+            if temp is None:
+                continue
+            found = True
+            sums[:, (i - first):(j - first)] = _find_DI_sums(temp, steps, num_bins, num_bins + j - i)
+            del temp
+        if not found:
+            return None
+    where = numpy.where((sums[0, :] > 0) & (sums[2, :] > 0))[0]
+    scores = numpy.log(sums[0, where] * sums[3, where] / (sums[2, where] * sums[1, where]))
+    positions = start + ((first + where) * 2 + steps) * step / 2
+    return scores, positions
+
+
+def _find_DI_sums(data, steps, first, last):
+    """Return downstream observed and expected and upstream observed and expected sums for each window of 'steps'
+    bins starting at bins 'first' through 'last' - 1 of a compact cis array."""
+    num_bins = data.shape[1]
+    positions = numpy.arange(first, last)
+    sums = _find_band_sums(data, 1, numpy.r_[positions, positions + steps - num_bins - 1],
+                           numpy.r_[positions + steps, positions], numpy.r_[positions + steps, positions],
+                           numpy.r_[positions + num_bins + 1, positions + steps])
+    return numpy.r_[sums[:positions.shape[0], :].T, sums[positions.shape[0]:, :].T]
+
+
+def _find_band_sums(data, offset, start1, stop1, start2, stop2):
+    """Return the sums of a banded array over bins 'start1' to 'stop1' by bins 'start2' to 'stop2'.
+
+    'data' holds the values for bins i and i + j + 'offset' in data[i, j] and each rectangle must lie within the
+    band."""
+    num_bins = data.shape[1]
+    width = num_bins + 2
+    shape = data.shape[2:]
+    size = ((data.shape[0] + 1) * width - 1) / (width - 1) + 1
+    diagonals = numpy.zeros((size * (width - 1),) + shape, dtype=numpy.float64)
+    # cumulative sums along each row of the band, offset by an empty leading row
+    prefix = diagonals[:((data.shape[0] + 1) * width)].reshape((-1, width) + shape)
+    numpy.cumsum(data, axis=1, dtype=numpy.float64, out=prefix[1:, 1:(num_bins + 1)])
+    # stepping down a row and back a column (a fixed partner bin) moves (width - 1) elements through the flattened
+    # array, so the band's diagonals are columns of this view and accumulating them gives 2D prefix sums
+    temp = diagonals.reshape((-1, width - 1) + shape)
+    numpy.cumsum(temp, axis=0, out=temp)
+
+    def prefix_sum(stop1, stop2):
+        return diagonals[stop1 * width + stop2 - stop1 - offset + 1]
+
+    return (prefix_sum(stop1, stop2) - prefix_sum(start1, stop2) - prefix_sum(stop1, start2) +
+            prefix_sum(start1, start2))
+
+
+def _find_BI_TADs(hic, chrom, binsize, width, minbins, maxbins, silent=True):
+    """Return the boundary index TADs for one chromosome."""
+    TADs = []
+    maxsize = binsize * (maxbins + width + 1)
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding heatmap for chromosome %s...") % (' ' * 80, chrom),
+    temp = hic.cis_heatmap(chrom, binsize=binsize, datatype='enrichment', arraytype='compact',
+                           maxdistance=maxsize, returnmapping=True)
+    if temp is None:
+        return TADs
+    data, mapping = temp
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding BI scores for chromosome %s...") % (' ' * 80, chrom),
+    BIs = numpy.zeros((data.shape[0], maxbins + 1, 2), dtype=numpy.float32)
+    BIs.fill(-numpy.inf)
+    _hic_domains.find_BIs(data, BIs, minbins, maxbins, width)
+    path = numpy.zeros(data.shape[0], dtype=numpy.int32)
+    path_scores = numpy.zeros(data.shape[0], dtype=numpy.float64)
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding optimal domains for chromosome %s...") % (' ' * 80, chrom),
+    _hic_domains.find_BI_path(BIs, path, path_scores, minbins, maxbins)
+    i = path.shape[0] - 1
+    while i > 0:
+        if path[i] != 1:
+            TADs.append([mapping[i - path[i] + 1, 0], mapping[i, 1]])
+        i -= path[i]
+    return TADs
+
+
+def _find_arrowhead_TADs(hic, chrom, binsize, minbins, maxbins, silent=True):
+    """Return the arrowhead TADs for one chromosome."""
+    TADs = []
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding heatmap for chromosome %s...") % (' ' * 80, chrom),
+    temp = hic.cis_heatmap(chrom, binsize=binsize * 16, datatype='fend', arraytype='full', returnmapping=True)
+    if temp is None:
+        return TADs
+    temp_data, mapping = temp
+    heatmap = numpy.zeros((temp_data.shape[0] * 16, temp_data.shape[0] * 16, 2), dtype=numpy.float32)
+    temp = numpy.zeros(heatmap.shape, dtype=numpy.float32)
+    for i in range(16):
+        for j in range(16):
+            heatmap[i::16, j::16, :] += temp_data
+    temp_data = hic.cis_heatmap(chrom, binsize=binsize * 4, datatype='fend', arraytype='full', start=mapping[0, 0],
+                                stop=mapping[-1, 1])
+    for i in range(4):
+        for j in range(4):
+            temp[i::4, j::4, :] += temp_data
+    where = numpy.where(temp[:, :, 0] > 0)
+    heatmap[where[0], where[1], :] = temp[where[0], where[1], :]
+    temp_data, mapping = hic.cis_heatmap(chrom, binsize=binsize, datatype='fend', arraytype='full',
+                                         start=mapping[0, 0], stop=mapping[-1, 1], returnmapping=True)
+    where = numpy.where(temp_data[:, :, 0] > 0)
+    heatmap[where[0], where[1], :] = temp_data[where[0], where[1], :]
+    data = numpy.zeros((heatmap.shape[0], maxbins - 1, 2), dtype=numpy.float32)
+    for i in range(heatmap.shape[0] - 1):
+        data[i, :min(data.shape[1], data.shape[0] - i - 1), :] = heatmap[i, (i + 1):min(data.shape[1] + i + 1,
+                                                                                         data.shape[0]), :]
+    where = numpy.where(data[:, :, 1] > 0)
+    data[where[0], where[1], 0] /= data[where[0], where[1], 1]
+    scores = numpy.zeros((data.shape[0], data.shape[1]), dtype=numpy.float32)
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding arrowhead transformation for chromosome %s...") % (' ' * 80, chrom),
+    _hic_domains.find_arrowhead_transformation(data, scores, maxbins)
+    sums = numpy.zeros(data.shape, dtype=numpy.float32)
+    signs = numpy.zeros(data.shape, dtype=numpy.float32)
+    variances = numpy.zeros((data.shape[0], data.shape[1], 2, 2), dtype=numpy.float32)
+    domain_scores = numpy.zeros(scores.shape, dtype=numpy.float32)
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding arrowhead scoring for chromosome %s...") % (' ' * 80, chrom),
+    _hic_domains.find_arrowhead_scores(scores, sums, signs, variances, domain_scores, minbins)
+    path = numpy.zeros(data.shape[0], dtype=numpy.int32)
+    path_scores = numpy.zeros(data.shape[0], dtype=numpy.float64)
+    if not silent:
+        print >> sys.stderr, ("\r%s\rFinding optimal domains for chromosome %s...") % (' ' * 80, chrom),
+    _hic_domains.find_arrowhead_path(domain_scores, path, path_scores, minbins, maxbins)
+    i = path.shape[0] - 1
+    while i > 0:
+        if path[i] != 1:
+            TADs.append([mapping[i - path[i], 0], mapping[i, 1]])
+        i -= path[i]
+    return TADs
 
 
+def _start_TAD_process():
+    """Give a pool worker its own handles to the project's data and fend files."""
+    # HDF5 file handles inherited through fork can't safely be read from several processes at once
+    for name in ['data', 'fends']:
+        _TAD_project[name] = _reopen_hdf5_file(_TAD_project[name])
+    return None
 
 
+def _find_chromosome_process(args):
+    """Find one chromosome's results in a pool worker."""
+    function, chrom, args = args
+    return chrom, function(_TAD_project, chrom, *args)
@@ -27,6 +27,58 @@ cdef extern from "math.h":
     double round(double x) nogil
     double floor(double x) nogil
     double ceil(double x) nogil
+    double frexp(double x, int* exponent) nogil
+
+# number of distance lookup table positions per doubling of distance
+cdef int distance_steps = 4096
+DISTANCE_TABLE_STEPS = distance_steps
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double find_distance_signal(
+        long long int distance,
+        double* table,
+        long long int table_size,
+        float* parameters) nogil:
+    # interpolate the distance signal between lookup table positions, falling back on the distance function for
+    # distances past the end of the table or between positions that straddle a change in line segment
+    cdef int exponent
+    cdef long long int index, k
+    cdef double position
+    if distance > 0:
+        position = (frexp(<double>distance, &exponent) * 2.0 - 1.0) * distance_steps
+        index = (exponent - 1) * distance_steps + <long long int>position
+        if index < table_size and table[index * 2 + 1] == table[index * 2 + 1]:
+            return table[index * 2] + (position - floor(position)) * table[index * 2 + 1]
+    position = log(<double>distance)
+    k = 0
+    while position > parameters[k * 3]:
+        k += 1
+    return exp(position * parameters[k * 3 + 1] + parameters[k * 3 + 2])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double find_binned_distance_signal(
+        long long int distance,
+        double* table,
+        long long int table_size,
+        long long int binsize,
+        float* parameters) nogil:
+    # look up the distance signal for distances spanning a whole number of bins, falling back on the distance
+    # function for any others
+    cdef long long int k
+    cdef double log_distance
+    if distance % binsize == 0 and distance / binsize < table_size:
+        return table[distance / binsize]
+    log_distance = log(<double>max(1, distance))
+    k = 0
+    while log_distance > parameters[k * 3]:
+        k += 1
+    return exp(log_distance * parameters[k * 3 + 1] + parameters[k * 3 + 2])
 
 
 @cython.boundscheck(False)
@@ -165,7 +217,8 @@ def find_cis_compact_expected(
         np.ndarray[DTYPE_int_t, ndim=1] binning_num_bins,
         np.ndarray[DTYPE_int_t, ndim=3] fend_indices,
         np.ndarray[DTYPE_int_t, ndim=1] mids,
-        np.ndarray[DTYPE_t, ndim=2] parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=2, mode="c"] distance_table,
         np.ndarray[DTYPE_t, ndim=3] signal not None,
         np.ndarray[DTYPE_t, ndim=1] correction_sums,
         np.ndarray[DTYPE_int_t, ndim=2] ranges,
@@ -178,6 +231,15 @@ def find_cis_compact_expected(
     cdef long long int start1, start2, stop1, stop2, l, m
     cdef double distance, value
     cdef long long int num_fends = mapping.shape[0]
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     if not fend_indices is None:
         num_parameters = fend_indices.shape[1]
     else:
@@ -191,7 +253,6 @@ def find_cis_compact_expected(
                 map1 = mapping[fend1]
                 if map1 == -1:
                     continue
-                k = 0
                 # find opposite strand adjacents, skipping same fragment and same strand adjacents
                 fend2 = fend1 + 2
                 map2 = mapping[fend2]
@@ -212,10 +273,8 @@ def find_cis_compact_expected(
                                 value *= binning_corrections[fend_indices[afend2, j, 1] + fend_indices[afend1, j, 0]]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(mids[fend2] - mids[fend1]))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                      parameter_data) * chrom_scale
                     if ranges is None:
                         signal[map1, map2 - map1 - 1 + diag, 1] += value
                     else:
@@ -262,10 +321,8 @@ def find_cis_compact_expected(
                                 value *= binning_corrections[fend_indices[afend2, j, 1] + fend_indices[afend1, j, 0]]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(mids[fend2] - mids[fend1]))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                      parameter_data) * chrom_scale
                     if ranges is None:
                         signal[map1, map2 - map1 - 1 + diag, 1] += value
                     else:
@@ -328,7 +385,8 @@ def find_cis_upper_expected(
         np.ndarray[DTYPE_int_t, ndim=1] binning_num_bins,
         np.ndarray[DTYPE_int_t, ndim=3] fend_indices,
         np.ndarray[DTYPE_int_t, ndim=1] mids,
-        np.ndarray[DTYPE_t, ndim=2] parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=2, mode="c"] distance_table,
         np.ndarray[DTYPE_t, ndim=2] signal not None,
         np.ndarray[DTYPE_t, ndim=1] correction_sums,
         np.ndarray[DTYPE_int_t, ndim=2] ranges,
@@ -343,6 +401,15 @@ def find_cis_upper_expected(
     cdef long long int num_fends = mapping.shape[0]
     cdef int diag2 = diag * 2
     cdef long long int num_bins = int(0.5 + pow(0.25 + 2 * signal.shape[0], 0.5)) - diag
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     if not fend_indices is None:
         num_parameters = fend_indices.shape[1]
     else:
@@ -353,7 +420,6 @@ def find_cis_upper_expected(
                 map1 = mapping[fend1]
                 if map1 == -1:
                     continue
-                k = 0
                 index = map1 * (num_bins - 1) - map1 * (map1 + 1 - diag2) / 2 - 1 + diag
                 # find opposite strand adjacents, skipping same fragment and same strand adjacents
                 fend2 = fend1 + 2
@@ -375,10 +441,8 @@ def find_cis_upper_expected(
                                 value *= binning_corrections[fend_indices[afend2, j, 1] + fend_indices[afend1, j, 0]]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(mids[fend2] - mids[fend1]))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                      parameter_data) * chrom_scale
                     if ranges is None:
                         signal[index + map2, 1] += value
                     else:
@@ -428,10 +492,8 @@ def find_cis_upper_expected(
                                 value *= binning_corrections[fend_indices[afend2, j, 1] + fend_indices[afend1, j, 0]]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(mids[fend2] - mids[fend1]))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                      parameter_data) * chrom_scale
                     if ranges is None:
                         signal[index + map2, 1] += value
                     else:
@@ -498,7 +560,9 @@ def find_binned_cis_compact_expected(
         np.ndarray[DTYPE_int_t, ndim=1] mapping not None,
         np.ndarray[DTYPE_t, ndim=1] corrections,
         np.ndarray[DTYPE_int_t, ndim=1] mids,
-        np.ndarray[DTYPE_t, ndim=2] parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=1, mode="c"] distance_table,
+        int binsize,
         np.ndarray[DTYPE_t, ndim=3] signal not None,
         np.ndarray[DTYPE_t, ndim=1] correction_sums,
         double chrom_mean,
@@ -507,6 +571,15 @@ def find_binned_cis_compact_expected(
     cdef long long int fend1, fend2, j, k, map1, map2, num_bins, max_bin
     cdef double distance, value
     cdef long long int num_fends = mapping.shape[0]
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     num_bins = signal.shape[0]
     max_bin = signal.shape[1]
     with nogil:
@@ -515,7 +588,6 @@ def find_binned_cis_compact_expected(
                 map1 = mapping[fend1]
                 if map1 == -1:
                     continue
-                k = 0
                 for fend2 in range(fend1, num_fends):
                     map2 = mapping[fend2]
                     if map2 == -1 or mids[fend2] - mids[fend1] > maxdistance:
@@ -527,10 +599,8 @@ def find_binned_cis_compact_expected(
                         value *= corrections[fend1] * corrections[fend2]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(max(1, mids[fend2] - mids[fend1])))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_binned_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                             binsize, parameter_data) * chrom_scale
                     signal[map1, map2 - map1, 1] += value
                 signal[map1, 0, 1] /= 2
         else:
@@ -548,7 +618,9 @@ def find_binned_cis_upper_expected(
         np.ndarray[DTYPE_int_t, ndim=1] mapping not None,
         np.ndarray[DTYPE_t, ndim=1] corrections,
         np.ndarray[DTYPE_int_t, ndim=1] mids,
-        np.ndarray[DTYPE_t, ndim=2] parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=1, mode="c"] distance_table,
+        int binsize,
         np.ndarray[DTYPE_t, ndim=2] signal not None,
         np.ndarray[DTYPE_t, ndim=1] correction_sums,
         double chrom_mean,
@@ -557,6 +629,15 @@ def find_binned_cis_upper_expected(
     cdef long long int fend1, fend2, j, k, map1, map2, index, num_bins, max_bin
     cdef double distance, value
     cdef long long int num_fends = mapping.shape[0]
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     num_bins = int(-0.5 + pow(0.25 + 2 * signal.shape[0], 0.5))
     with nogil:
         if correction_sums is None:
@@ -565,7 +646,6 @@ def find_binned_cis_upper_expected(
                 if map1 == -1:
                     continue
                 index = map1 * (num_bins - 1) - map1 * (map1 - 1) / 2
-                k = 0
                 for fend2 in range(fend1, num_fends):
                     map2 = mapping[fend2]
                     if map2 == -1 or mids[fend2] - mids[fend1] > maxdistance:
@@ -577,10 +657,8 @@ def find_binned_cis_upper_expected(
                         value *= corrections[fend1] * corrections[fend2]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = log(<double>(max(1, mids[fend2] - mids[fend1])))
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        value *= find_binned_distance_signal(mids[fend2] - mids[fend1], table_data, table_size,
+                                                             binsize, parameter_data) * chrom_scale
                     signal[index + map2, 1] += value
             for j in range(num_bins):
                 signal[j * num_bins - j * (j - 1) / 2, 1] /= 2.0
@@ -652,15 +730,25 @@ def find_cis_subregion_expected(
         np.ndarray[DTYPE_64_t, ndim=1] correction_sums2,
         np.ndarray[DTYPE_int_t, ndim=1] mids1,
         np.ndarray[DTYPE_int_t, ndim=1] mids2,
-        np.ndarray[DTYPE_t, ndim=2] parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=2, mode="c"] distance_table,
         double chrom_mean,
         int startfend1,
         int startfend2):
     cdef long long int fend1, fend2, afend1, afend2, i, j, k, map1, map2, index, num_parameters, num_bins1, num_bins2
-    cdef long long int start1, start2, stop1, stop2, l, m
+    cdef long long int start1, start2, stop1, stop2, l, m, span
     cdef double distance, value
     cdef long long int num_fends1 = mapping1.shape[0]
     cdef long long int num_fends2 = mapping2.shape[0]
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     if not fend_indices is None:
         num_parameters = fend_indices.shape[1]
     else:
@@ -681,7 +769,7 @@ def find_cis_subregion_expected(
                         continue
                     afend2 = fend2 + startfend2
                     diff = afend1 - afend2
-                    if (diff < 2 and diff > -2) or (afend1 % 2 == 0 and diff == 3) or (afend2 % 2 == 0 and diff == -3):
+                    if (diff < 2 and diff > -2) or (afend2 % 2 == 0 and diff == 3) or (afend1 % 2 == 0 and diff == -3):
                         continue
                      # give starting expected value
                     value = 1.0
@@ -697,15 +785,10 @@ def find_cis_subregion_expected(
                                 value *= binning_corrections[fend_indices[afend2, j, 1] + fend_indices[afend1, j, 0]]
                     # if finding distance, enrichment, or expected, correct for distance
                     if not parameters is None:
-                        distance = mids2[fend2] - mids1[fend1]
-                        if distance > 0:
-                            distance = log(<double>distance)
-                        else:
-                            distance = log(<double>(-distance))
-                        k = 0
-                        while distance > parameters[k, 0]:
-                            k += 1
-                        value *= exp(distance * parameters[k, 1] + parameters[k, 2] + chrom_mean)
+                        span = mids2[fend2] - mids1[fend1]
+                        if span < 0:
+                            span = -span
+                        value *= find_distance_signal(span, table_data, table_size, parameter_data) * chrom_scale
                     signal[map1, map2, 1] += value
         else:
             for i in range(num_bins1):
@@ -1546,7 +1629,7 @@ def find_trans_expected(
         num_bins2 = correction_sums2.shape[0]
     with nogil:
         if correction_sums1 is None:
-            for fend1 in range(num_fends1 - 1):
+            for fend1 in range(num_fends1):
                 map1 = mapping1[fend1]
                 if map1 == -1:
                     continue
@@ -1951,7 +2034,8 @@ def find_mrh_cis_expected(
         np.ndarray[DTYPE_t, ndim=1] correction_sums,
         np.ndarray[DTYPE_t, ndim=1] binning_corrections,
         np.ndarray[DTYPE_int_t, ndim=3] fend_indices,
-        np.ndarray[DTYPE_t, ndim=2] distance_parameters,
+        np.ndarray[DTYPE_t, ndim=2, mode="c"] parameters,
+        np.ndarray[DTYPE_64_t, ndim=2, mode="c"] distance_table,
         double chrom_mean,
         int dt_int):
     cdef long long int i, j, k, l, bin1, bin2, num, num_parameters, map1, map2
@@ -1959,6 +2043,15 @@ def find_mrh_cis_expected(
     cdef long long int n = expected.shape[0]
     cdef long long int valid_fends = binmapping.shape[0]
     cdef long long int num_fends = mapping.shape[0]
+    cdef double* table_data = NULL
+    cdef float* parameter_data = NULL
+    cdef long long int table_size = 0
+    cdef double chrom_scale = exp(chrom_mean)
+    if not parameters is None:
+        parameter_data = <float*> parameters.data
+    if not distance_table is None:
+        table_data = <double*> distance_table.data
+        table_size = distance_table.shape[0]
     if not fend_indices is None:
         num_parameters = fend_indices.shape[1]
     with nogil:
@@ -2014,7 +2107,6 @@ def find_mrh_cis_expected(
             for i in range(valid_fends - 1):
                 bin1 = binmapping[i]
                 num = fend_nums[i]
-                l = 0
                 for j in range(i + 1, min(valid_fends, i + 4)):
                     if fend_nums[i + 1] - num == 1:
                         continue
@@ -2022,11 +2114,9 @@ def find_mrh_cis_expected(
                         continue
                     if dt_int < 2:
                         value = 1.0
-                    else:                            
-                        distance = log(<double>(mids[j] - mids[i]))
-                        while distance > distance_parameters[l, 0]:
-                            l += 1
-                        value = exp(distance * distance_parameters[l, 1] + distance_parameters[l, 2] + chrom_mean)
+                    else:
+                        value = find_distance_signal(mids[j] - mids[i], table_data, table_size,
+                                                     parameter_data) * chrom_scale
                     if not corrections is None:
                         value *= corrections[i] * corrections[j]
                     if not fend_indices is None:
@@ -2039,11 +2129,9 @@ def find_mrh_cis_expected(
                 for j in range(i + 4, valid_fends):
                     if dt_int < 2:
                         value = 1.0
-                    else:                            
-                        distance = log(<double>(mids[j] - mids[i]))
-                        while distance > distance_parameters[l, 0]:
-                            l += 1
-                        value = exp(distance * distance_parameters[l, 1] + distance_parameters[l, 2] + chrom_mean)
+                    else:
+                        value = find_distance_signal(mids[j] - mids[i], table_data, table_size,
+                                                     parameter_data) * chrom_scale
                     if not corrections is None:
                         value *= corrections[i] * corrections[j]
                     if not fend_indices is None:
@@ -5,6 +5,7 @@ parameter optimization necessary for supporting hic analysis using HiFive.
 """
 
 import cython
+from cython.parallel import prange, threadid
 cimport numpy as np
 import numpy
 
@@ -66,28 +67,40 @@ def calculate_binom_gradients(
         np.ndarray[DTYPE_t, ndim=1] zero_means not None,
         np.ndarray[DTYPE_t, ndim=1] corrections not None,
         np.ndarray[DTYPE_t, ndim=1] inv_corrections not None,
-        np.ndarray[DTYPE_64_t, ndim=1] gradients not None):
-    cdef long long int i, index0, index1
-    cdef double value, distance_mean, correction0, correction1
+        np.ndarray[DTYPE_64_t, ndim=1] gradients not None,
+        int num_threads=1,
+        np.ndarray[DTYPE_64_t, ndim=2] thread_sums=None):
+    cdef long long int i, j, t, index0, index1
+    cdef double value, distance_mean
     cdef long long int num_zero_pairs = zero_indices0.shape[0]
     cdef long long int num_nonzero_pairs = nonzero_indices0.shape[0]
+    cdef long long int num_fends = gradients.shape[0]
+    # each thread accumulates into its own row of 'thread_sums', which are summed once all pairs are processed.
+    # Callers repeating the calculation can pass a zeroed (num_threads, num_fends) array to reuse between calls
+    if thread_sums is None:
+        thread_sums = numpy.zeros((num_threads, num_fends), dtype=numpy.float64)
     with nogil:
-        for i in range(num_nonzero_pairs):
+        for i in prange(num_nonzero_pairs, num_threads=num_threads, schedule='static'):
+            t = threadid()
             index0 = nonzero_indices0[i]
             index1 = nonzero_indices1[i]
-            gradients[index0] -= inv_corrections[index0]
+            thread_sums[t, index0] -= inv_corrections[index0]
             if index1 != index0:
-                gradients[index1] -= inv_corrections[index1]
-        for i in range(num_zero_pairs):
+                thread_sums[t, index1] -= inv_corrections[index1]
+        for i in prange(num_zero_pairs, num_threads=num_threads, schedule='static'):
+            t = threadid()
             index0 = zero_indices0[i]
             index1 = zero_indices1[i]
             distance_mean = zero_means[i]
-            correction0 = corrections[index0]
-            correction1 = corrections[index1]
             value = 1.0 / (1.0 - distance_mean * corrections[index0] * corrections[index1])
-            gradients[index0] += (distance_mean * corrections[index1]) * value
+            thread_sums[t, index0] += (distance_mean * corrections[index1]) * value
             if index1 != index0:
-                gradients[index1] += (distance_mean * corrections[index0]) * value
+                thread_sums[t, index1] += (distance_mean * corrections[index0]) * value
+        # sum each fend across threads, leaving the rows zeroed for the next call
+        for j in prange(num_fends, num_threads=num_threads, schedule='static'):
+            for t in range(num_threads):
+                gradients[j] += thread_sums[t, j]
+                thread_sums[t, j] = 0.0
     return None
 
 
@@ -103,18 +116,19 @@ def calculate_binom_cost(
         np.ndarray[DTYPE_t, ndim=1] nonzero_means not None,
         np.ndarray[DTYPE_t, ndim=1] zero_means not None,
         np.ndarray[DTYPE_t, ndim=1] corrections not None,
-        np.ndarray[DTYPE_t, ndim=1] log_corrections not None):
+        np.ndarray[DTYPE_t, ndim=1] log_corrections not None,
+        int num_threads=1):
     cdef long long int i
     cdef double cost
     cdef long long int num_zero_pairs = zero_indices0.shape[0]
     cdef long long int num_nonzero_pairs = nonzero_indices0.shape[0]
     with nogil:
         cost = 0.0
-        for i in range(num_nonzero_pairs):
-            cost -= nonzero_means[i] + log_corrections[nonzero_indices0[i]] + log_corrections[nonzero_indices1[i]]
-        for i in range(num_zero_pairs):
-            cost -= log(max(0.0000001, 1.0 - zero_means[i] * corrections[zero_indices0[i]] * corrections[zero_indices1[i]]))
-    return cost
+        for i in prange(num_nonzero_pairs, num_threads=num_threads, schedule='static'):
+            cost += nonzero_means[i] + log_corrections[nonzero_indices0[i]] + log_corrections[nonzero_indices1[i]]
+        for i in prange(num_zero_pairs, num_threads=num_threads, schedule='static'):
+            cost += log(max(0.0000001, 1.0 - zero_means[i] * corrections[zero_indices0[i]] * corrections[zero_indices1[i]]))
+    return -cost
 
 
 @cython.boundscheck(False)
@@ -130,23 +144,35 @@ def calculate_poisson_gradients(
         np.ndarray[DTYPE_t, ndim=1] zero_means not None,
         np.ndarray[DTYPE_t, ndim=1] corrections not None,
         np.ndarray[DTYPE_t, ndim=1] inv_corrections not None,
-        np.ndarray[DTYPE_64_t, ndim=1] gradients not None):
-    cdef long long int i, index0, index1
+        np.ndarray[DTYPE_64_t, ndim=1] gradients not None,
+        int num_threads=1,
+        np.ndarray[DTYPE_64_t, ndim=2] thread_sums=None):
+    cdef long long int i, j, t, index0, index1
     cdef long long int num_zero_pairs = zero_indices0.shape[0]
     cdef long long int num_nonzero_pairs = nonzero_indices0.shape[0]
+    cdef long long int num_fends = gradients.shape[0]
+    if thread_sums is None:
+        thread_sums = numpy.zeros((num_threads, num_fends), dtype=numpy.float64)
     with nogil:
-        for i in range(num_nonzero_pairs):
+        for i in prange(num_nonzero_pairs, num_threads=num_threads, schedule='static'):
+            t = threadid()
             index0 = nonzero_indices0[i]
             index1 = nonzero_indices1[i]
-            gradients[index0] += nonzero_means[i] * corrections[index0] - counts[i] * inv_corrections[index0]
+            thread_sums[t, index0] += nonzero_means[i] * corrections[index0] - counts[i] * inv_corrections[index0]
             if index1 != index0:
-                gradients[index1] += nonzero_means[i] * corrections[index1] - counts[i] * inv_corrections[index1]
-        for i in range(num_zero_pairs):
+                thread_sums[t, index1] += nonzero_means[i] * corrections[index1] - counts[i] * inv_corrections[index1]
+        for i in prange(num_zero_pairs, num_threads=num_threads, schedule='static'):
+            t = threadid()
             index0 = zero_indices0[i]
             index1 = zero_indices1[i]
-            gradients[index0] += zero_means[i] * corrections[index0]
+            thread_sums[t, index0] += zero_means[i] * corrections[index0]
             if index1 != index0:
-                gradients[index1] += zero_means[i] * corrections[index1]
+                thread_sums[t, index1] += zero_means[i] * corrections[index1]
+        # sum each fend across threads, leaving the rows zeroed for the next call
+        for j in prange(num_fends, num_threads=num_threads, schedule='static'):
+            for t in range(num_threads):
+                gradients[j] += thread_sums[t, j]
+                thread_sums[t, j] = 0.0
     return None
 
 
@@ -162,16 +188,17 @@ def calculate_poisson_cost(
         np.ndarray[DTYPE_t, ndim=1] nonzero_means not None,
         np.ndarray[DTYPE_t, ndim=1] zero_means not None,
         np.ndarray[DTYPE_t, ndim=1] corrections not None,
-        np.ndarray[DTYPE_t, ndim=1] log_corrections not None):
+        np.ndarray[DTYPE_t, ndim=1] log_corrections not None,
+        int num_threads=1):
     cdef long long int i
     cdef double cost
     cdef long long int num_zero_pairs = zero_indices0.shape[0]
     cdef long long int num_nonzero_pairs = nonzero_indices0.shape[0]
     with nogil:
         cost = 0.0
-        for i in range(num_nonzero_pairs):
+        for i in prange(num_nonzero_pairs, num_threads=num_threads, schedule='static'):
             cost += corrections[nonzero_indices0[i]] * corrections[nonzero_indices1[i]] * nonzero_means[i] - counts[i] * ( log(nonzero_means[i]) + log_corrections[nonzero_indices0[i]] + log_corrections[nonzero_indices1[i]] )
-        for i in range(num_zero_pairs):
+        for i in prange(num_zero_pairs, num_threads=num_threads, schedule='static'):
             cost += corrections[zero_indices0[i]] * corrections[zero_indices1[i]] * zero_means[i]
     return cost
 
@@ -188,10 +215,16 @@ def find_fend_means(
         np.ndarray[DTYPE_t, ndim=1] corrections not None,
         double mu,
         double trans_mu,
-        int binary):
-    cdef long long int i, fend1, fend2, num_trans_data, num_data
+        int binary,
+        int num_threads=1,
+        np.ndarray[DTYPE_64_t, ndim=2] thread_sums=None):
+    cdef long long int i, j, t, fend1, fend2, num_trans_data, num_data
     cdef double temp
     cdef long long int num_fends = fend_means.shape[0]
+    cdef int use_distance_means = distance_means is not None
+    cdef int use_trans_means = trans_means is not None
+    if thread_sums is None:
+        thread_sums = numpy.zeros((num_threads, num_fends), dtype=numpy.float64)
     if not trans_data is None:
         num_trans_data = trans_data.shape[0]
     else:
@@ -201,54 +234,39 @@ def find_fend_means(
     else:
         num_data = 0
     with nogil:
-        for i in range(num_fends):
-            fend_means[i] = 0.0
-        if binary == 0:
-            if distance_means is None:
-                for i in range(num_data):
-                    fend1 = data[i, 0]
-                    fend2 = data[i, 1]
-                    temp = data[i, 2] / (mu * corrections[fend1] * corrections[fend2])
-                    fend_means[fend1] += temp
-                    fend_means[fend2] += temp
+        for i in prange(num_data, num_threads=num_threads, schedule='static'):
+            t = threadid()
+            fend1 = data[i, 0]
+            fend2 = data[i, 1]
+            if binary == 0:
+                temp = data[i, 2]
             else:
-                for i in range(num_data):
-                    fend1 = data[i, 0]
-                    fend2 = data[i, 1]
-                    temp = data[i, 2] / (distance_means[i] * corrections[fend1] * corrections[fend2])
-                    fend_means[fend1] += temp
-                    fend_means[fend2] += temp
-            for i in range(num_trans_data):
-                fend1 = trans_data[i, 0]
-                fend2 = trans_data[i, 1]
-                temp = trans_data[i, 2] / (trans_mu * corrections[fend1] * corrections[fend2])
-                if not trans_means is None:
-                    temp /= trans_means[i]
-                fend_means[fend1] += temp
-                fend_means[fend2] += temp
-        else:
-            if distance_means is None:
-                for i in range(num_data):
-                    fend1 = data[i, 0]
-                    fend2 = data[i, 1]
-                    temp = 1.0 / (mu * corrections[fend1] * corrections[fend2])
-                    fend_means[fend1] += temp
-                    fend_means[fend2] += temp
+                temp = 1.0
+            if use_distance_means:
+                temp = temp / (distance_means[i] * corrections[fend1] * corrections[fend2])
+            else:
+                temp = temp / (mu * corrections[fend1] * corrections[fend2])
+            thread_sums[t, fend1] += temp
+            thread_sums[t, fend2] += temp
+        for i in prange(num_trans_data, num_threads=num_threads, schedule='static'):
+            t = threadid()
+            fend1 = trans_data[i, 0]
+            fend2 = trans_data[i, 1]
+            if binary == 0:
+                temp = trans_data[i, 2]
             else:
-                for i in range(num_data):
-                    fend1 = data[i, 0]
-                    fend2 = data[i, 1]
-                    temp = 1.0 / (distance_means[i] * corrections[fend1] * corrections[fend2])
-                    fend_means[fend1] += temp
-                    fend_means[fend2] += temp
-            for i in range(num_trans_data):
-                fend1 = trans_data[i, 0]
-                fend2 = trans_data[i, 1]
-                temp = 1.0 / (trans_mu * corrections[fend1] * corrections[fend2])
-                if not trans_means is None:
-                    temp /= trans_means[i]
-                fend_means[fend1] += temp
-                fend_means[fend2] += temp
+                temp = 1.0
+            temp = temp / (trans_mu * corrections[fend1] * corrections[fend2])
+            if use_trans_means:
+                temp = temp / trans_means[i]
+            thread_sums[t, fend1] += temp
+            thread_sums[t, fend2] += temp
+        # sum each fend across threads, leaving the rows zeroed for the next call
+        for j in prange(num_fends, num_threads=num_threads, schedule='static'):
+            fend_means[j] = 0.0
+            for t in range(num_threads):
+                fend_means[j] += thread_sums[t, j]
+                thread_sums[t, j] = 0.0
     return None
 
 
@@ -291,9 +309,14 @@ def calculate_v(
         np.ndarray[DTYPE_64_t, ndim=1] counts,
         np.ndarray[DTYPE_64_t, ndim=1] trans_counts,
         np.ndarray[DTYPE_64_t, ndim=2] corrections,
-        np.ndarray[DTYPE_64_t, ndim=2] v):
-    cdef long long int i, fend1, fend2, num_data, num_trans_data
+        np.ndarray[DTYPE_64_t, ndim=2] v,
+        int num_threads=1,
+        np.ndarray[DTYPE_64_t, ndim=2] thread_sums=None):
+    cdef long long int i, j, t, fend1, fend2, num_data, num_trans
     cdef double correction
+    cdef long long int num_fends = v.shape[0]
+    if thread_sums is None:
+        thread_sums = numpy.zeros((num_threads, num_fends), dtype=numpy.float64)
     if not data is None:
         num_data = data.shape[0]
     else:
@@ -303,18 +326,25 @@ def calculate_v(
     else:
         num_trans = 0
     with nogil:
-        for i in range(num_data):
+        for i in prange(num_data, num_threads=num_threads, schedule='static'):
+            t = threadid()
             fend1 = data[i, 0]
             fend2 = data[i, 1]
             correction = corrections[fend1, 0] * corrections[fend2, 0] * counts[i]
-            v[fend1, 0] += correction
-            v[fend2, 0] += correction
-        for i in range(num_trans):
+            thread_sums[t, fend1] += correction
+            thread_sums[t, fend2] += correction
+        for i in prange(num_trans, num_threads=num_threads, schedule='static'):
+            t = threadid()
             fend1 = trans_data[i, 0]
             fend2 = trans_data[i, 1]
             correction = corrections[fend1, 0] * corrections[fend2, 0] * trans_counts[i]
-            v[fend1, 0] += correction
-            v[fend2, 0] += correction
+            thread_sums[t, fend1] += correction
+            thread_sums[t, fend2] += correction
+        # sum each fend across threads, leaving the rows zeroed for the next call
+        for j in prange(num_fends, num_threads=num_threads, schedule='static'):
+            for t in range(num_threads):
+                v[j, 0] += thread_sums[t, j]
+                thread_sums[t, j] = 0.0
     return None
 
 
@@ -328,9 +358,14 @@ def calculate_w(
         np.ndarray[DTYPE_64_t, ndim=1] trans_counts,
         np.ndarray[DTYPE_64_t, ndim=2] corrections,
         np.ndarray[DTYPE_64_t, ndim=2] p,
-        np.ndarray[DTYPE_64_t, ndim=2] w):
-    cdef long long int i, fend1, fend2, num_data, num_trans_data
+        np.ndarray[DTYPE_64_t, ndim=2] w,
+        int num_threads=1,
+        np.ndarray[DTYPE_64_t, ndim=2] thread_sums=None):
+    cdef long long int i, j, t, fend1, fend2, num_data, num_trans
     cdef double correction
+    cdef long long int num_fends = w.shape[0]
+    if thread_sums is None:
+        thread_sums = numpy.zeros((num_threads, num_fends), dtype=numpy.float64)
     if not data is None:
         num_data = data.shape[0]
     else:
@@ -340,16 +375,23 @@ def calculate_w(
     else:
         num_trans = 0
     with nogil:
-        for i in range(num_data):
+        for i in prange(num_data, num_threads=num_threads, schedule='static'):
+            t = threadid()
             fend1 = data[i, 0]
             fend2 = data[i, 1]
             correction = corrections[fend1, 0] * corrections[fend2, 0] * counts[i]
-            w[fend1, 0] += correction * p[fend2, 0]
-            w[fend2, 0] += correction * p[fend1, 0]
-        for i in range(num_trans):
+            thread_sums[t, fend1] += correction * p[fend2, 0]
+            thread_sums[t, fend2] += correction * p[fend1, 0]
+        for i in prange(num_trans, num_threads=num_threads, schedule='static'):
+            t = threadid()
             fend1 = trans_data[i, 0]
             fend2 = trans_data[i, 1]
             correction = corrections[fend1, 0] * corrections[fend2, 0] * trans_counts[i]
-            w[fend1, 0] += correction * p[fend2, 0]
-            w[fend2, 0] += correction * p[fend1, 0]
+            thread_sums[t, fend1] += correction * p[fend2, 0]
+            thread_sums[t, fend2] += correction * p[fend1, 0]
+        # sum each fend across threads, leaving the rows zeroed for the next call
+        for j in prange(num_fends, num_threads=num_threads, schedule='static'):
+            for t in range(num_threads):
+                w[j, 0] += thread_sums[t, j]
+                thread_sums[t, j] = 0.0
     return None
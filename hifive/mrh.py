@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+"""A class for random-access queries of HiFive multi-resolution heatmap files."""
+
+import os
+
+import numpy
+
+
+class MRH(object):
+
+    """This class provides windowed access to the data stored in a multi-resolution heatmap file.
+
+    .. note::
+      This class is also available as hifive.MRH
+
+    The file is memory-mapped and its header is parsed once when the object is created. The layout of the file is described in :meth:`HiC.write_multiresolution_heatmap <hifive.hic.HiC.write_multiresolution_heatmap>`. Queries walk the partition tree one resolution level at a time, so every level is handled with array operations rather than per-bin recursion.
+
+    :param filename: The name of the multi-resolution heatmap file to read.
+    :type filename: str.
+    :returns: :class:`MRH` class object.
+
+    :Attributes: * **file** (*str.*) - A string containing the name of the multi-resolution heatmap file.
+                 * **chromosomes** (*list*) - A list of chromosome names in the order they were written.
+                 * **chr2int** (*dict.*) - A dictionary mapping chromosome names to their index in the file.
+                 * **includes_trans** (*bool.*) - Indicates whether inter-chromosomal heatmaps are present.
+                 * **minobservations** (*int.*) - The minimum number of reads used for valid bins when the file was created.
+    """
+
+    # number of set bits in each possible 4-bit partition shape
+    _popcount = numpy.array([bin(i).count('1') for i in range(16)], dtype=numpy.int64)
+
+    def __init__(self, filename):
+        """Create an :class:`MRH` object."""
+        self.file = os.path.abspath(filename)
+        self._map = numpy.memmap(self.file, dtype=numpy.uint8, mode='r')
+        if self._map.shape[0] < 12 or list(self._map[:4]) != [0x42, 0x05, 0x42, 0x05]:
+            raise TypeError('File does not appear to be a multi-resolution heatmap file')
+        trans, num_chroms = self._read(4, 2, '>i4')
+        self.includes_trans = bool(trans)
+        pos = 12
+        name_sizes = self._read(pos, num_chroms, '>i4')
+        pos += num_chroms * 4
+        self.chromosomes = []
+        for size in name_sizes:
+            self.chromosomes.append(self._map[pos:(pos + size)].tostring().strip())
+            pos += size
+        self.chr2int = {}
+        for i, chrom in enumerate(self.chromosomes):
+            self.chr2int[chrom] = i
+        if self.includes_trans:
+            num_pairings = (num_chroms * (num_chroms + 1)) / 2
+            repeated = 2
+        else:
+            num_pairings = num_chroms
+            repeated = 1
+        fields = [('data_indices', num_pairings + 1, '>i4'), ('partitions', num_chroms * repeated, '>i4'),
+                  ('data_sizes', num_pairings, '>i4'), ('index_sizes', num_pairings, '>i4'),
+                  ('starts', num_chroms * repeated, '>i4'), ('stops', num_chroms * repeated, '>i4'),
+                  ('min_scores', num_pairings, '>f4'), ('max_scores', num_pairings, '>f4'),
+                  ('binsizes', 2 * repeated, '>i4'), ('minobservations', 1, '>i4')]
+        header = {}
+        for name, count, dtype in fields:
+            header[name] = self._read(pos, count, dtype).astype(numpy.dtype(dtype).newbyteorder('='))
+            pos += count * 4
+        self.minobservations = int(header['minobservations'][0])
+        self._header = header
+        self._pairings = {}
+        return None
+
+    def _read(self, pos, count, dtype):
+        """Return a view of 'count' values of type 'dtype' starting at byte 'pos'."""
+        return numpy.frombuffer(self._map, dtype=numpy.dtype(dtype), count=count, offset=pos)
+
+    def _find_pairing(self, chrom1, chrom2):
+        """Return the parsed header and arrays for a chromosome pairing and whether the request is transposed."""
+        if chrom2 is None:
+            chrom2 = chrom1
+        if chrom1 not in self.chr2int or chrom2 not in self.chr2int:
+            raise KeyError('File does not appear to contain data for the requested chromosome(s)')
+        chrint1 = self.chr2int[chrom1]
+        chrint2 = self.chr2int[chrom2]
+        if chrint1 != chrint2 and not self.includes_trans:
+            raise KeyError('File does not appear to contain inter-chromosome data')
+        transpose = chrint1 > chrint2
+        if transpose:
+            chrint1, chrint2 = chrint2, chrint1
+        if (chrint1, chrint2) in self._pairings:
+            return self._pairings[(chrint1, chrint2)], transpose
+        header = self._header
+        num_chroms = len(self.chromosomes)
+        if self.includes_trans:
+            index = chrint1 * (num_chroms - 1) - (chrint1 * (chrint1 - 1)) / 2 + chrint2
+        else:
+            index = chrint1
+        offset = header['data_indices'][index]
+        total_bytes = header['data_indices'][index + 1] - offset
+        pairing = {'cis': chrint1 == chrint2}
+        if total_bytes == 0:
+            raise KeyError('File does not contain data for the requested chromosome(s)')
+        if pairing['cis']:
+            pairing['n'] = pairing['m'] = header['partitions'][chrint1]
+            pairing['start1'] = pairing['start2'] = header['starts'][chrint1]
+            pairing['stop1'] = pairing['stop2'] = header['stops'][chrint1]
+            pairing['lres'], pairing['hres'] = header['binsizes'][0], header['binsizes'][len(header['binsizes']) / 2]
+        else:
+            pairing['n'] = header['partitions'][chrint1 + num_chroms]
+            pairing['m'] = header['partitions'][chrint2 + num_chroms]
+            pairing['start1'] = header['starts'][chrint1 + num_chroms]
+            pairing['start2'] = header['starts'][chrint2 + num_chroms]
+            pairing['stop1'] = header['stops'][chrint1 + num_chroms]
+            pairing['stop2'] = header['stops'][chrint2 + num_chroms]
+            pairing['lres'], pairing['hres'] = header['binsizes'][1], header['binsizes'][3]
+        pairing['minscore'] = header['min_scores'][index]
+        pairing['maxscore'] = header['max_scores'][index]
+        data_bins = header['data_sizes'][index]
+        index_bins = header['index_sizes'][index]
+        shape_bins = (total_bytes - (data_bins + index_bins) * 4) / 2
+        pairing['data'] = self._read(offset, data_bins, '>f4')
+        pairing['indices'] = self._read(offset + data_bins * 4, index_bins, '>i4')
+        pairing['shapes'] = self._read(offset + (data_bins + index_bins) * 4, shape_bins, '>i2')
+        self._pairings[(chrint1, chrint2)] = pairing
+        return pairing, transpose
+
+    def get_header(self, chrom1, chrom2=None):
+        """
+        Return the bounds, resolutions, and score range for a chromosome or chromosome pair.
+
+        :param chrom1: The first (or only) chromosome.
+        :type chrom1: str.
+        :param chrom2: The second chromosome. If None, the intra-chromosomal heatmap header for 'chrom1' is returned.
+        :type chrom2: str.
+        :returns: A dictionary with keys 'start1', 'stop1', 'start2', 'stop2' (coordinate bounds of the lowest-resolution bins, oriented as requested), 'lres' (largest bin size), 'hres' (smallest bin size), 'minscore', and 'maxscore'.
+        """
+        pairing, transpose = self._find_pairing(chrom1, chrom2)
+        header = {}
+        for key in ['lres', 'hres', 'minscore', 'maxscore']:
+            header[key] = pairing[key]
+        for key in ['start', 'stop']:
+            if transpose:
+                header['%s1' % key], header['%s2' % key] = pairing['%s2' % key], pairing['%s1' % key]
+            else:
+                header['%s1' % key], header['%s2' % key] = pairing['%s1' % key], pairing['%s2' % key]
+        return header
+
+    def get_squares(self, chrom1, start1=None, stop1=None, chrom2=None, start2=None, stop2=None,
+                    minresolution=None, maxresolution=None):
+        """
+        Return all valid multi-resolution bins overlapping a query window as sparse coordinate arrays.
+
+        Bins are ordered from lowest to highest resolution, so drawing them in order leaves the finest available data on top. A bin is only included if it is not completely covered by valid higher-resolution bins within the requested resolution range.
+
+        :param chrom1: The chromosome for the first axis.
+        :type chrom1: str.
+        :param start1: The first axis window start coordinate. If None, the start of the heatmap is used.
+        :type start1: int.
+        :param stop1: The first axis window stop coordinate. If None, the end of the heatmap is used.
+        :type stop1: int.
+        :param chrom2: The chromosome for the second axis. If None, 'chrom1' is used.
+        :type chrom2: str.
+        :param start2: The second axis window start coordinate. If None, 'start1' is used for intra-chromosomal queries and the start of the heatmap otherwise.
+        :type start2: int.
+        :param stop2: The second axis window stop coordinate. If None, 'stop1' is used for intra-chromosomal queries and the end of the heatmap otherwise.
+        :type stop2: int.
+        :param minresolution: The largest bin size to return. If None, the largest bin size in the file is used.
+        :type minresolution: int.
+        :param maxresolution: The smallest bin size to return. If None, the smallest bin size in the file is used.
+        :type maxresolution: int.
+        :returns: A tuple of four numpy arrays containing the first axis bin starts, second axis bin starts, bin sizes, and bin values.
+        """
+        pairing, transpose = self._find_pairing(chrom1, chrom2)
+        start1, stop1, start2, stop2 = self._fill_window(pairing, transpose, start1, stop1, start2, stop2)
+        if minresolution is None:
+            minresolution = pairing['lres']
+        if maxresolution is None:
+            maxresolution = pairing['hres']
+        if transpose:
+            start1, stop1, start2, stop2 = start2, stop2, start1, stop1
+        squares = self._find_squares(pairing, start1, stop1, start2, stop2, minresolution, maxresolution)
+        if transpose:
+            squares = (squares[1], squares[0], squares[2], squares[3])
+        return squares
+
+    def get_tile(self, chrom1, start1=None, stop1=None, chrom2=None, start2=None, stop2=None, binsize=None,
+                 minresolution=None):
+        """
+        Return a dense array of the finest available data for a query window, sampled at a fixed bin size.
+
+        :param chrom1: The chromosome for the first axis.
+        :type chrom1: str.
+        :param start1: The first axis window start coordinate. If None, the start of the heatmap is used.
+        :type start1: int.
+        :param stop1: The first axis window stop coordinate. If None, the end of the heatmap is used.
+        :type stop1: int.
+        :param chrom2: The chromosome for the second axis. If None, 'chrom1' is used.
+        :type chrom2: str.
+        :param start2: The second axis window start coordinate. If None, 'start1' is used for intra-chromosomal queries and the start of the heatmap otherwise.
+        :type start2: int.
+        :param stop2: The second axis window stop coordinate. If None, 'stop1' is used for intra-chromosomal queries and the end of the heatmap otherwise.
+        :type stop2: int.
+        :param binsize: The size of each array cell and the smallest bin size to draw data from. If None, the smallest bin size in the file is used.
+        :type binsize: int.
+        :param minresolution: The largest bin size to draw data from. If None, the largest bin size in the file is used.
+        :type minresolution: int.
+        :returns: A 2D float32 numpy array with the first axis corresponding to 'chrom1'. Cells without valid data are NaN.
+        """
+        pairing, transpose = self._find_pairing(chrom1, chrom2)
+        start1, stop1, start2, stop2 = self._fill_window(pairing, transpose, start1, stop1, start2, stop2)
+        if binsize is None:
+            binsize = pairing['hres']
+        x, y, sizes, values = self.get_squares(chrom1, start1, stop1, chrom2, start2, stop2,
+                                               minresolution=minresolution, maxresolution=binsize)
+        n = int(numpy.ceil((stop1 - start1) / float(binsize)))
+        m = int(numpy.ceil((stop2 - start2) / float(binsize)))
+        tile = numpy.empty((max(n, 0), max(m, 0)), dtype=numpy.float32)
+        tile.fill(numpy.nan)
+        if tile.size == 0 or x.shape[0] == 0:
+            return tile
+        x1 = numpy.clip(numpy.floor((x - start1) / float(binsize)).astype(numpy.int64), 0, n)
+        x2 = numpy.clip(numpy.ceil((x + sizes - start1) / float(binsize)).astype(numpy.int64), 0, n)
+        y1 = numpy.clip(numpy.floor((y - start2) / float(binsize)).astype(numpy.int64), 0, m)
+        y2 = numpy.clip(numpy.ceil((y + sizes - start2) / float(binsize)).astype(numpy.int64), 0, m)
+        # bins of one size never overlap, so each resolution level can be painted in a single assignment
+        for size in numpy.unique(sizes)[::-1]:
+            where = numpy.where(sizes == size)[0]
+            widths = x2[where] - x1[where]
+            heights = y2[where] - y1[where]
+            areas = widths * heights
+            if numpy.sum(areas) == 0:
+                continue
+            square = numpy.repeat(numpy.arange(where.shape[0]), areas)
+            cell = numpy.arange(square.shape[0]) - numpy.repeat(numpy.cumsum(areas) - areas, areas)
+            tile[x1[where][square] + cell / heights[square],
+                 y1[where][square] + cell % heights[square]] = values[where][square]
+        return tile
+
+    def _fill_window(self, pairing, transpose, start1, stop1, start2, stop2):
+        """Replace missing window coordinates with the heatmap bounds, oriented as requested."""
+        if transpose:
+            bounds = (pairing['start2'], pairing['stop2'], pairing['start1'], pairing['stop1'])
+        else:
+            bounds = (pairing['start1'], pairing['stop1'], pairing['start2'], pairing['stop2'])
+        if start1 is None:
+            start1 = bounds[0]
+        if stop1 is None:
+            stop1 = bounds[1]
+        if pairing['cis']:
+            if start2 is None:
+                start2 = start1
+            if stop2 is None:
+                stop2 = stop1
+        else:
+            if start2 is None:
+                start2 = bounds[2]
+            if stop2 is None:
+                stop2 = bounds[3]
+        return start1, stop1, start2, stop2
+
+    def _find_squares(self, pairing, start1, stop1, start2, stop2, minresolution, maxresolution):
+        """Walk the partition tree level by level, keeping bins overlapping the window."""
+        data = pairing['data']
+        indices = pairing['indices']
+        shapes = pairing['shapes']
+        cis = pairing['cis']
+        res = pairing['lres']
+        n = pairing['n']
+        m = pairing['m']
+        # find the top-level bins overlapping the window (and its reflection for intra-chromosomal data)
+        first1 = max(0, (start1 - pairing['start1']) / res)
+        last1 = min(n, (stop1 - pairing['start1'] - 1) / res + 1)
+        first2 = max(0, (start2 - pairing['start2']) / res)
+        last2 = min(m, (stop2 - pairing['start2'] - 1) / res + 1)
+        rows = numpy.repeat(numpy.arange(first1, max(first1, last1), dtype=numpy.int64), max(0, last2 - first2))
+        cols = numpy.tile(numpy.arange(first2, max(first2, last2), dtype=numpy.int64), max(0, last1 - first1))
+        if cis:
+            rows, cols = numpy.minimum(rows, cols), numpy.maximum(rows, cols)
+            positions = numpy.unique(rows * n + cols)
+            rows = positions / n
+            cols = positions % n
+            bins = rows * (n - 1) - (rows * (rows - 1)) / 2 + cols
+        else:
+            bins = rows * m + cols
+        x = rows * res + pairing['start1']
+        y = cols * res + pairing['start2']
+        values = data[bins]
+        valid = numpy.where(numpy.logical_not(numpy.isnan(values)))[0]
+        bins, x, y, values = bins[valid], x[valid], y[valid], values[valid]
+        all_x, all_y, all_sizes, all_values = [], [], [], []
+        while bins.shape[0] > 0:
+            if cis:
+                diagonal = x == y
+            else:
+                diagonal = numpy.zeros(bins.shape[0], dtype=numpy.bool)
+            num_valid = numpy.zeros(bins.shape[0], dtype=numpy.int64)
+            half = res / 2
+            if half >= maxresolution and half > 0:
+                # find bins partitioned into valid higher-resolution bins
+                parents = numpy.where(bins < indices.shape[0])[0]
+                parents = parents[indices[bins[parents]] != -1]
+                child_starts = indices[bins[parents]].astype(numpy.int64)
+                parent_shapes = shapes[bins[parents]].astype(numpy.int64) & 15
+                child_parents, child_bins, child_x, child_y = [], [], [], []
+                for i in range(4):
+                    where = numpy.where((parent_shapes >> i) & 1)[0]
+                    child_parents.append(parents[where])
+                    child_bins.append(child_starts[where] + self._popcount[parent_shapes[where] & ((1 << i) - 1)])
+                    child_x.append(x[parents[where]] + (i / 2) * half)
+                    child_y.append(y[parents[where]] + (i % 2) * half)
+                child_parents = numpy.concatenate(child_parents)
+                child_bins = numpy.concatenate(child_bins)
+                child_x = numpy.concatenate(child_x)
+                child_y = numpy.concatenate(child_y)
+                child_values = data[child_bins]
+                valid = numpy.logical_not(numpy.isnan(child_values))
+                num_valid += numpy.bincount(child_parents[valid], minlength=bins.shape[0])
+                # only descend into valid bins that overlap the window
+                valid[valid] = self._overlaps(child_x[valid], child_y[valid], half, start1, stop1, start2, stop2,
+                                              cis)
+                child_bins, child_x, child_y = child_bins[valid], child_x[valid], child_y[valid]
+                child_values = child_values[valid]
+            else:
+                child_bins = child_x = child_y = numpy.zeros(0, dtype=numpy.int64)
+                child_values = numpy.zeros(0, dtype=numpy.float32)
+            # keep bins that aren't completely covered by their valid partitions
+            if res <= minresolution:
+                keep = numpy.where(num_valid < numpy.where(diagonal, 3, 4))[0]
+                kx, ky, kvalues = x[keep], y[keep], values[keep]
+                if cis:
+                    # intra-chromosomal bins are stored once, so draw whichever orientations fall in the window
+                    forward = self._overlaps(kx, ky, res, start1, stop1, start2, stop2, False)
+                    reverse = numpy.logical_and(kx != ky, self._overlaps(ky, kx, res, start1, stop1, start2, stop2,
+                                                                         False))
+                    kx, ky, kvalues = (numpy.r_[kx[forward], ky[reverse]], numpy.r_[ky[forward], kx[reverse]],
+                                       numpy.r_[kvalues[forward], kvalues[reverse]])
+                else:
+                    forward = self._overlaps(kx, ky, res, start1, stop1, start2, stop2, False)
+                    kx, ky, kvalues = kx[forward], ky[forward], kvalues[forward]
+                all_x.append(kx)
+                all_y.append(ky)
+                all_sizes.append(numpy.repeat(res, kx.shape[0]).astype(numpy.int64))
+                all_values.append(kvalues)
+            bins, x, y, values = child_bins, child_x, child_y, child_values
+            res = half
+        if len(all_x) == 0:
+            return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64),
+                    numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.float32))
+        return (numpy.concatenate(all_x), numpy.concatenate(all_y), numpy.concatenate(all_sizes),
+                numpy.concatenate(all_values).astype(numpy.float32))
+
+    @staticmethod
+    def _overlaps(x, y, size, start1, stop1, start2, stop2, symmetric):
+        """Find which bins overlap the window (or, if 'symmetric', the window or its reflection)."""
+        overlap = numpy.logical_and(numpy.logical_and(x < stop1, x + size > start1),
+                                    numpy.logical_and(y < stop2, y + size > start2))
+        if symmetric:
+            overlap = numpy.logical_or(overlap, numpy.logical_and(numpy.logical_and(y < stop1, y + size > start1),
+                                                                  numpy.logical_and(x < stop2, x + size > start2)))
+        return overlap
@@ -4,6 +4,7 @@
 
 import os
 import sys
+import multiprocessing
 from math import ceil, floor
 
 import numpy
@@ -22,6 +23,9 @@ except:
 
 import libraries._quasar as _quasar
 
+# the downsampled reads shared with forked transformation workers
+_transformation_data = None
+
 
 class Quasar(object):
 
@@ -139,7 +143,7 @@ class Quasar(object):
         return None
 
     def find_transformation(self, hic, chroms=[], resolutions=[1000000, 200000, 40000, 10000],
-        coverages=[0, 40000000, 20000000, 10000000, 5000000, 2000000, 1000000], seed=None):
+        coverages=[0, 40000000, 20000000, 10000000, 5000000, 2000000, 1000000], seed=None, processes=1):
         """
         Find QuASAR transformation from the specified HiC project.
 
@@ -149,9 +153,11 @@ class Quasar(object):
         :type mode: list
         :param resolutions: A list of binning resolutions to find transformed matrices for.
         :type resolutions: list
-        :param coverages: A list of cis read counts to downsample to prior to finding transformed matrices. A value of 0 indicates to use all reads. Coverages are calculated across only chromosomes specified in the 'chroms' argument.
+        :param coverages: A list of cis read counts to downsample to prior to finding transformed matrices. A value of 0 indicates to use all reads. Coverages are calculated across only chromosomes specified in the 'chroms' argument. Each coverage level is drawn exactly, without replacement, from the reads of the next higher level.
         :type coverages: list
         :param seed: An integer to use as the initialization value for the random number generator.
+        :param processes: The number of worker processes to find transformed matrices with when not run under MPI. Each coverage, resolution, and chromosome combination is an independent task and results are written as they finish. Combinations with results already in the file are skipped. All downsampled coverage levels are held in memory at once while the workers run, each no larger than the reads it was drawn from.
+        :type processes: int.
 
         :returns: :class:`Quasar` class object.
         """
@@ -275,6 +281,13 @@ class Quasar(object):
                 raw[indices[i]:indices[i + 1], :] = remapped[chrom]
             del remapped
 
+        if self.rank == 0 and self.num_procs == 1 and processes > 1:
+            self._find_transformations_in_parallel(raw, indices, mids, chroms, coverages, resolutions, total_reads,
+                                                   RNG, processes)
+            if not self.silent:
+                print >> sys.stderr, ("\r%s\r") % (' ' * 120),
+            return None
+
         # cycle through coverages
         for c, cov in enumerate(coverages):
             if self.rank == 0:
@@ -537,6 +550,52 @@ class Quasar(object):
             self._print_html_report(filename, qscores, rscores, scores_only)
         return None
 
+    def _find_transformations_in_parallel(self, raw, indices, mids, chroms, coverages, resolutions, total_reads,
+                                          rng, processes):
+        """Downsample to each coverage and find transformed matrices for all remaining combinations in a pool of worker processes."""
+        global _transformation_data
+        levels = []
+        tasks = []
+        for c, cov in enumerate(coverages):
+            if not self.silent:
+                print >> sys.stderr, ("\r%s\rDownsampling to %i coverage") % (' ' * 120, cov),
+            raw, indices = self._downsample(raw, indices, cov, rng)
+            levels.append((raw, indices))
+            for res in resolutions:
+                for h, chrom in enumerate(chroms):
+                    if cov == total_reads:
+                        key = '%s.0C.%iR' % (chrom, res)
+                    else:
+                        key = '%s.%iC.%iR' % (chrom, cov, res)
+                    if 'valid.%s' % key not in self.storage:
+                        tasks.append((key, c, h, res))
+        if len(tasks) == 0:
+            return None
+        # a task's matrix size follows its chromosome span over its resolution, so queue the biggest ones first and
+        # let the smaller ones fill in around them
+        tasks.sort(key=lambda x: (mids[chroms[x[2]]][-1] - mids[chroms[x[2]]][0]) / x[3], reverse=True)
+        # every downsampled level is reached through _transformation_data after the fork, so only the short task
+        # tuples are sent to workers
+        _transformation_data = (self, levels, mids, chroms)
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            for i, result in enumerate(pool.imap_unordered(_find_transformation_process, tasks)):
+                key, valid_rows, dist, corrs = result
+                if corrs is None:
+                    self.storage.attrs['%s.invalid' % (key)] = True
+                else:
+                    self.storage.create_dataset(name="valid.%s" % (key), data=valid_rows)
+                    self.storage.create_dataset(name="dist.%s" % (key), data=dist)
+                    self.storage.create_dataset(name="corr.%s" % (key), data=corrs)
+                if not self.silent:
+                    print >> sys.stderr, ("\r%s\rFinding transformations... %i of %i") % (' ' * 120, i + 1,
+                                                                                           len(tasks)),
+        finally:
+            pool.terminate()
+            pool.join()
+            _transformation_data = None
+        return None
+
     def _transfer_dict(self, data, dest, source):
         if self.rank == dest:
             key = self.comm.recv(source=source, tag=5)
@@ -566,48 +625,9 @@ class Quasar(object):
             return numpy.copy(data), numpy.copy(indices)
         if rng is None:
             rng = numpy.random.RandomState()
-        initial_count = numpy.sum(data[:, 2])
-        percent = target_count / float(initial_count)
-
-        # select which reads to keep, based on percent of reads to keep
-        keep = rng.rand(initial_count) < percent
-
-        # adjust mismatch between selected read count and target read count by selecting reads to add/remove
-        kept = numpy.sum(keep)
-        if kept > target_count:
-            pool_size = kept
-            adjust_size = kept - target_count
-            remove = True
-        elif kept < target_count:
-            pool_size = initial_count - kept
-            adjust_size = target_count - kept
-            remove = False
-        else:
-            adjust_size = 0
-        reads = {}
-        while len(reads) < adjust_size:
-            temp_rand = rng.randint(0, pool_size, adjust_size * 2)
-            for i in range(temp_rand.shape[0]):
-                reads[temp_rand[i]] = None
-                if len(reads) == adjust_size:
-                    break
-        if adjust_size > 0:
-            if remove:
-                where = numpy.where(keep)[0]
-                for i in where[reads.keys()]:
-                    keep[i] = False
-            else:
-                where = numpy.where(numpy.logical_not(keep))[0]
-                for i in where[reads.keys()]:
-                    keep[i] = True
-
-        # adjust read counts in data
-        counts = numpy.repeat(numpy.arange(data.shape[0]), data[:, 2])
         new_data = numpy.copy(data)
-        new_data[:, 2] = numpy.bincount(counts, weights=keep, minlength=data.shape[0])
-        new_indices = numpy.zeros(indices.shape[0], dtype=numpy.int64)
-        for i in range(1, new_indices.shape[0]):
-            new_indices[i] = numpy.sum(new_data[indices[i - 1]:indices[i], 2] > 0) + new_indices[i - 1]
+        new_data[:, 2] = _downsample_counts(data[:, 2], target_count, rng)
+        new_indices = numpy.r_[0, numpy.cumsum(new_data[:, 2] > 0)][indices].astype(numpy.int64)
         new_data = new_data[numpy.where(new_data[:, 2] > 0)[0], :]
         return new_data, new_indices
 
@@ -1225,4 +1245,65 @@ class Quasar(object):
             n1 = n1[:-3]
         if len(n1) > 0:
             s = [n1] + s
-        return ','.join(s)
\ No newline at end of file
+        return ','.join(s)
+
+
+def _downsample_counts(counts, target_count, rng=None):
+    """Return counts holding exactly 'target_count' reads drawn without replacement from the reads in 'counts'.
+
+    This is a multivariate hypergeometric draw made by repeatedly splitting ranges of rows in half and dividing each range's reads between its halves with a single hypergeometric draw. All ranges at one level are drawn together, so memory use depends on the number of rows rather than the number of reads.
+    """
+    if rng is None:
+        rng = numpy.random
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    cumulative = numpy.r_[0, numpy.cumsum(counts)]
+    if target_count >= cumulative[-1]:
+        return numpy.copy(counts)
+    kept = numpy.zeros(counts.shape[0], dtype=numpy.int64)
+    full = numpy.zeros(counts.shape[0] + 1, dtype=numpy.int64)
+    starts = numpy.zeros(1, dtype=numpy.int64)
+    stops = numpy.array([counts.shape[0]], dtype=numpy.int64)
+    targets = numpy.array([target_count], dtype=numpy.int64)
+    while starts.shape[0] > 0:
+        totals = cumulative[stops] - cumulative[starts]
+        # ranges keeping all of their reads are filled in at the end
+        where = numpy.where(targets == totals)[0]
+        numpy.add.at(full, starts[where], 1)
+        numpy.add.at(full, stops[where], -1)
+        where = numpy.where((targets > 0) & (targets < totals))[0]
+        starts = starts[where]
+        stops = stops[where]
+        targets = targets[where]
+        totals = totals[where]
+        where = numpy.where(stops - starts == 1)[0]
+        kept[starts[where]] = targets[where]
+        where = numpy.where(stops - starts > 1)[0]
+        starts = starts[where]
+        stops = stops[where]
+        targets = targets[where]
+        totals = totals[where]
+        mids = (starts + stops) / 2
+        left = cumulative[mids] - cumulative[starts]
+        left_targets = numpy.where(left == totals, targets, 0)
+        where = numpy.where((left > 0) & (left < totals))[0]
+        if where.shape[0] > 0:
+            left_targets[where] = rng.hypergeometric(left[where], totals[where] - left[where], targets[where])
+        starts = numpy.r_[starts, mids]
+        stops = numpy.r_[mids, stops]
+        targets = numpy.r_[left_targets, targets - left_targets]
+    where = numpy.where(numpy.cumsum(full[:-1]) > 0)[0]
+    kept[where] = counts[where]
+    return kept
+
+
+def _find_transformation_process(args):
+    """Find one chromosome's transformed matrices at one coverage and resolution in a pool worker."""
+    key, c, h, res = args
+    quasar, levels, mids, chroms = _transformation_data
+    # each worker finds whole correlation matrices by itself
+    quasar.comm = None
+    raw, indices = levels[c]
+    chrom = chroms[h]
+    norm, dist, valid_rows = quasar._normalize(chrom, raw[indices[h]:indices[h + 1]], mids[chrom], res)
+    corrs = quasar._find_correlations(norm, valid_rows)
+    return key, valid_rows, dist, corrs
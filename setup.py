@@ -149,6 +149,11 @@ def setup_package():
 
 def get_extension_modules(include_dirs):
     extensions = []
+    # Apple's default compiler doesn't support OpenMP, in which case parallel loops run on a single thread
+    if sys.platform == 'darwin':
+        openmp_args = []
+    else:
+        openmp_args = ['-fopenmp']
     # Distance functions
     extensions.append(Extension("hifive.libraries._hic_distance", ["hifive/libraries/_hic_distance.pyx"],
                                 include_dirs=include_dirs, language="c++",
@@ -167,7 +172,7 @@ def get_extension_modules(include_dirs):
     # Optimization functions
     extensions.append(Extension("hifive.libraries._hic_optimize", ["hifive/libraries/_hic_optimize.pyx"],
                                 include_dirs=include_dirs, language="c++",
-                                extra_compile_args=[]))
+                                extra_compile_args=openmp_args, extra_link_args=openmp_args))
     extensions.append(Extension("hifive.libraries._fivec_optimize", ["hifive/libraries/_fivec_optimize.pyx",
                                 "hifive/libraries/_normal.cpp"],
                                 include_dirs=include_dirs, language="c++",
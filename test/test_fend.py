@@ -38,8 +38,45 @@ class Fends(unittest.TestCase):
         fends = h5py.File('test/data/test_temp.fends', 'r')
         self.compare_hdf5_dicts(self.len_fends, fends, 'binned fends')
 
+    def test_add_hdf5_feature(self):
+        rng = numpy.random.RandomState(3)
+        tracks = h5py.File('test/data/test_temp.features', 'w')
+        for chrom in ['chr1', 'chr2']:
+            tracks.create_dataset(name='%s.gc' % chrom, data=rng.rand(800000).astype(numpy.float32))
+            tracks.create_dataset(name='%s.map' % chrom, data=rng.rand(800000).astype(numpy.float32),
+                                  compression='gzip')
+        tracks.close()
+        tracks = h5py.File('test/data/test_temp.features', 'r')
+        window = 2000
+        for fname in ['test/data/test.fends', 'test/data/test_len.fends']:
+            fends = fend.Fend(fname, silent=True)
+            fends.add_hdf5_feature(['gc', 'map'], 'test/data/test_temp.features', window, blocksize=50000)
+            if fends.binned is None:
+                bins, indices = fends.fends, fends.chr_indices
+            else:
+                bins, indices = fends.bins, fends.bin_indices
+            for name in ['gc', 'map']:
+                target = numpy.zeros(bins.shape[0], dtype=numpy.float64)
+                for i, chrom in enumerate(['chr1', 'chr2']):
+                    track = tracks['%s.%s' % (chrom, name)][...]
+                    for j in range(indices[i], indices[i + 1]):
+                        start, stop = bins['start'][j], bins['stop'][j]
+                        if fends.binned is not None:
+                            if start + window >= stop - window:
+                                target[j] = numpy.mean(track[start:stop])
+                            else:
+                                target[j] = numpy.mean(numpy.r_[track[start:(start + window)],
+                                                                track[(stop - window):stop]])
+                        elif j % 2 == 1:
+                            target[j] = numpy.mean(track[max(bins['start'][j - 1], stop - window):stop])
+                        else:
+                            target[j] = numpy.mean(track[start:min(bins['stop'][j + 1], start + window)])
+                self.assertTrue(numpy.allclose(bins[name], target),
+                    "%s feature values for %s don't match target values" % (name, fname))
+        tracks.close()
+
     def tearDown(self):
-        subprocess.call('rm -f test/data/test_temp.fends', shell=True)
+        subprocess.call('rm -f test/data/test_temp.fends test/data/test_temp.features', shell=True)
 
     def compare_arrays(self, array1, array2, name):
         self.assertTrue(array1.shape == array2.shape,
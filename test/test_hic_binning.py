@@ -8,7 +8,7 @@ from operator import mul
 
 import numpy
 
-from hifive import hic
+from hifive import hic, hic_binning
 import h5py
 
 
@@ -29,6 +29,16 @@ class HiCBinning(unittest.TestCase):
         self.compare_arrays(self.data['hic_cis'][...], cis, 'cis binned enrichments')
         self.compare_arrays(self.data['hic_mapping'][...], mapping, 'cis mappings')
 
+    def test_cached_cis_binning(self):
+        for i in range(2):
+            cis, mapping = self.project.cis_heatmap('chr1', start=50000, stop=200000, binsize=25000,
+                                                    datatype='enrichment', arraytype='compact', maxdistance=0,
+                                                    skipfiltered=False, returnmapping=True, dynamically_binned=True,
+                                                    minobservations=10, searchdistance=0, expansion_binsize=0,
+                                                    removefailed=False)
+            self.compare_arrays(self.data['hic_cis'][...], cis, 'cached cis binned enrichments')
+        self.assertTrue(self.project.cache.hits > 0, "repeated cis query wasn't served from cache")
+
     def test_trans_binning(self):
         trans, mapping1, mapping2 = self.project.trans_heatmap('chr1', 'chr2', binsize=50000, datatype='enrichment',
                                                                returnmapping=True, dynamically_binned=True,
@@ -43,7 +53,65 @@ class HiCBinning(unittest.TestCase):
                         self.project_fname, shell=True)
         heatmap = h5py.File("test/data/test_temp.hch")
         self.compare_hdf5_dicts(self.heatmap, heatmap, 'heatmap')
-        
+
+    def test_generate_sparse_heatmap(self):
+        subprocess.call("./bin/hifive hic-heatmap -q -b 20000 -t -F sparse --block-size 7 -d enrichment %s test/data/test_temp.hch" %
+                        self.project_fname, shell=True)
+        heatmap = h5py.File("test/data/test_temp.hch", 'r')
+        positions1 = heatmap['chr1.positions'][...]
+        positions2 = heatmap['chr2.positions'][...]
+        cis = hic_binning.find_cis_signal(self.project, 'chr1', binbounds=positions1, datatype='enrichment',
+                                          arraytype='full', silent=True)
+        where = numpy.where(numpy.triu(cis[:, :, 0], 1) > 0)
+        self.compare_arrays(where[0].astype(numpy.int32), heatmap['chr1/bin1'][...], 'sparse cis rows')
+        self.compare_arrays(where[1].astype(numpy.int32), heatmap['chr1/bin2'][...], 'sparse cis columns')
+        self.compare_arrays(cis[where[0], where[1], 0], heatmap['chr1/observed'][...], 'sparse cis observed')
+        self.compare_arrays(cis[where[0], where[1], 1], heatmap['chr1/expected'][...], 'sparse cis expected')
+        indices = numpy.r_[0, numpy.cumsum(numpy.bincount(where[0], minlength=positions1.shape[0]))]
+        self.compare_arrays(indices, heatmap['chr1/indices'][...], 'sparse cis indices')
+        trans = hic_binning.find_trans_signal(self.project, 'chr1', 'chr2', binbounds1=positions1,
+                                              binbounds2=positions2, datatype='enrichment', silent=True)
+        where = numpy.where(trans[:, :, 0] > 0)
+        self.compare_arrays(where[1].astype(numpy.int32), heatmap['chr1_by_chr2/bin2'][...], 'sparse trans columns')
+        self.compare_arrays(trans[where[0], where[1], 1], heatmap['chr1_by_chr2/expected'][...],
+                            'sparse trans expected')
+        heatmap.close()
+
+    def test_sparse_heatmap_blocksize(self):
+        hic_binning.write_heatmap_dict(self.project, 'test/data/test_temp.hch', 20000, format='sparse', blocksize=0,
+                                       silent=True)
+        self.assertTrue(not os.path.exists('test/data/test_temp.hch'),
+            "sparse heatmap written with a non-positive block size")
+
+    def test_cis_subregion_expected(self):
+        positions = hic_binning._find_sparse_bin_positions(self.project, 'chr1', 2000)
+        cis = hic_binning.find_cis_signal(self.project, 'chr1', binbounds=positions, datatype='enrichment',
+                                          arraytype='full', silent=True)
+        subregion = hic_binning.find_cis_subregion_signal(self.project, 'chr1', binbounds1=positions,
+                                                          binbounds2=positions, datatype='enrichment', silent=True)
+        upper = numpy.triu_indices(positions.shape[0], 1)
+        self.compare_arrays(cis[upper[0], upper[1], 1], subregion[upper[0], upper[1], 1],
+                            'subregion same-strand expected')
+
+    def test_cis_subregion_distance(self):
+        positions = hic_binning._find_sparse_bin_positions(self.project, 'chr1', 20000)
+        cis = hic_binning.find_cis_signal(self.project, 'chr1', binbounds=positions, datatype='distance',
+                                          arraytype='full', silent=True)
+        subregion = hic_binning.find_cis_subregion_signal(self.project, 'chr1', binbounds1=positions,
+                                                          binbounds2=positions, datatype='distance', silent=True)
+        upper = numpy.triu_indices(positions.shape[0], 1)
+        self.compare_arrays(cis[upper[0], upper[1], :], subregion[upper[0], upper[1], :],
+                            'subregion distance signal')
+
+    def test_trans_expected(self):
+        # end the first region on a valid fend so the last fend's contribution is checked
+        fend = hic_binning.find_trans_signal(self.project, 'chr1', 'chr2', binsize=20000, stopfend1=50,
+                                             datatype='fend', silent=True)
+        enrichment = hic_binning.find_trans_signal(self.project, 'chr1', 'chr2', binsize=20000, stopfend1=50,
+                                                   datatype='enrichment', silent=True)
+        self.assertTrue(numpy.allclose(fend[:, :, 1] * self.project.trans_means[0], enrichment[:, :, 1]),
+            "trans expected values don't match target values")
+
     def tearDown(self):
         subprocess.call('rm -f test/data/test_temp.hch', shell=True)
 
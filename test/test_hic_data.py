@@ -3,6 +3,7 @@
 import os
 import sys
 import subprocess
+import tempfile
 import unittest
 from operator import mul
 
@@ -39,6 +40,68 @@ class HiCData(unittest.TestCase):
         data = h5py.File('test/data/test_temp.hcd', 'r')
         self.compare_hdf5_dicts(self.raw_data, data, 'data')
 
+    def test_hic_raw_data_spilled(self):
+        os.mkdir('test/data/test_temp_spill')
+        tempfile.tempdir = 'test/data/test_temp_spill'
+        try:
+            data = hic_data.HiCData('test/data/test_temp.hcd', 'w', silent=True)
+            data.load_data_from_raw(self.fend_fname, self.raw_fname, 500, chunksize=4, buffersize=2)
+            data.save()
+            self.assertTrue(len(os.listdir('test/data/test_temp_spill')) == 0,
+                "spilled read pairs weren't removed after loading")
+            self.compare_hdf5_dicts(self.raw_data, h5py.File('test/data/test_temp.hcd', 'r'), 'data')
+
+            def fail(*args):
+                raise IOError("failed merge")
+            data = hic_data.HiCData('test/data/test_temp.hcd', 'w', silent=True)
+            data._find_unique_read_pairs = fail
+            self.assertRaises(IOError, data.load_data_from_raw, self.fend_fname, self.raw_fname, 500,
+                              chunksize=4, buffersize=2)
+            self.assertTrue(len(os.listdir('test/data/test_temp_spill')) == 0,
+                "spilled read pairs weren't removed after a failed load")
+        finally:
+            tempfile.tempdir = None
+
+    def test_hic_raw_data_processes(self):
+        os.mkdir('test/data/test_temp_spill')
+        tempfile.tempdir = 'test/data/test_temp_spill'
+        try:
+            data = hic_data.HiCData('test/data/test_temp.hcd', 'w', silent=True)
+            data.load_data_from_raw(self.fend_fname, [self.raw_fname, self.raw_fname], 500)
+            data.save()
+            data = hic_data.HiCData('test/data/test_temp2.hcd', 'w', silent=True)
+            data.load_data_from_raw(self.fend_fname, [self.raw_fname, self.raw_fname], 500, processes=2)
+            data.save()
+            self.assertTrue(len(os.listdir('test/data/test_temp_spill')) == 0,
+                "fend pair files written by worker processes weren't removed after loading")
+            self.compare_hdf5_dicts(h5py.File('test/data/test_temp.hcd', 'r'),
+                                    h5py.File('test/data/test_temp2.hcd', 'r'), 'data')
+        finally:
+            tempfile.tempdir = None
+
+    def test_hic_compressed_raw_data_creation(self):
+        subprocess.call("./bin/hifive hic-data -q -R %s -i 500 --compression lzf %s test/data/test_temp.hcd" %
+                        (self.raw_fname, self.fend_fname), shell=True)
+        data = h5py.File('test/data/test_temp.hcd', 'r')
+        self.assertTrue(data['cis_data'].compression == 'lzf',
+            "cis_data wasn't stored compressed")
+        self.compare_hdf5_dicts(self.raw_data, data, 'data')
+
+    def test_hic_combine_replicates(self):
+        subprocess.call("./bin/hifive hic-combine-replicates -q -b 1000 test/data/test.hcd test/data/test.hcd test/data/test.hcd test/data/test_temp.hcd", shell=True)
+        data = h5py.File('test/data/test_temp.hcd', 'r')
+        replicate = h5py.File('test/data/test.hcd', 'r')
+        for name in ['cis', 'trans']:
+            target = replicate['%s_data' % name][...]
+            target[:, 2] *= 3
+            self.compare_arrays(target, data['%s_data' % name][...], '%s combined data' % name)
+            self.compare_arrays(replicate['%s_indices' % name][...], data['%s_indices' % name][...],
+                                '%s combined indices' % name)
+
+    def test_hic_combine_single_replicate(self):
+        subprocess.call("./bin/hifive hic-combine-replicates -q test/data/test.hcd test/data/test_temp.hcd", shell=True)
+        self.assertFalse(os.path.exists('test/data/test_temp.hcd'), "a single replicate was combined")
+
     def test_hic_mat_data_creation(self):
         subprocess.call("./bin/hifive hic-data -q -M %s -i 500 %s test/data/test_temp.hcd" %
                         (self.mat_fname, self.fend_fname), shell=True)
@@ -93,9 +156,25 @@ class HiCData(unittest.TestCase):
         self.assertEqual(data1, data2,
                 "generated mat file doesn't match original")
 
+    def test_hic_bam_name_collision(self):
+        data = hic_data.HiCData('test/data/test_temp.hcd', 'w', silent=True)
+        data._open_fends(self.fend_fname)
+        # every read name has the same hash, so mates can only be told apart by the second name hash
+        ends = {
+            'test_temp1.bam': [('read1', 1000), ('read2', 2000), ('read3', 3000)],
+            'test_temp2.bam': [('read3', 3500), ('read1', 1500), ('read2', 2500)],
+            }
+        data._open_bam = lambda fname, threads: _FakeBam(ends[fname])
+        chunks = list(data._read_bam_chunks(['test_temp1.bam', 'test_temp2.bam'], 10))
+        self.assertTrue(len(chunks) == 1, "BAM read pairs weren't returned in a single chunk")
+        pairs = sorted(map(tuple, chunks[0][1].tolist()))
+        self.assertTrue(pairs == [(1000, 1500), (2000, 2500), (3000, 3500)],
+            "reads with colliding name hashes were paired with the wrong mates")
+
     def tearDown(self):
-        subprocess.call('rm -f test/data/test_temp.hcd', shell=True)
+        subprocess.call('rm -f test/data/test_temp.hcd test/data/test_temp2.hcd', shell=True)
         subprocess.call('rm -f test/data/test_temp.mat', shell=True)
+        subprocess.call('rm -rf test/data/test_temp_spill', shell=True)
 
     def compare_arrays(self, array1, array2, name):
         self.assertTrue(array1.shape == array2.shape,
@@ -135,5 +214,32 @@ class HiCData(unittest.TestCase):
         return None
 
 
+class _CollidingName(str):
+    def __hash__(self):
+        return 1
+
+
+class _FakeRead(object):
+    def __init__(self, name, pos):
+        self.qname = _CollidingName(name)
+        self.tid = 0
+        self.pos = pos
+        self.seq = 'A' * 50
+        self.is_unmapped = False
+        self.is_reverse = False
+
+
+class _FakeBam(object):
+    def __init__(self, ends):
+        self.header = {'SQ': [{'SN': 'chr1'}]}
+        self.reads = [_FakeRead(name, pos) for name, pos in ends]
+
+    def fetch(self, until_eof=False):
+        return iter(self.reads)
+
+    def close(self):
+        return None
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import subprocess
+import unittest
+
+import numpy
+
+from hifive import hic, hic_domains
+import h5py
+
+
+class HiCDomains(unittest.TestCase):
+    def setUp(self):
+        self.project = hic.HiC('test/data/test_probbin.hcp', 'r', silent=True)
+
+    def test_BI_TADs_processes(self):
+        serial = hic_domains.TAD(self.project, silent=True)
+        serial.find_BI_TADs(10000, 3, 2, 20)
+        parallel = hic_domains.TAD(self.project, silent=True)
+        parallel.find_BI_TADs(10000, 3, 2, 20, processes=2)
+        self.compare_TADs(serial.TADs, parallel.TADs, 'BI')
+
+    def test_arrowhead_TADs_processes(self):
+        serial = hic_domains.TAD(self.project, silent=True)
+        serial.find_arrowhead_TADs(10000, 3, 30)
+        parallel = hic_domains.TAD(self.project, silent=True)
+        parallel.find_arrowhead_TADs(10000, 3, 30, processes=2)
+        self.compare_TADs(serial.TADs, parallel.TADs, 'arrowhead')
+
+    def test_DI_TADs_processes(self):
+        serial = hic_domains.TAD(self.project, silent=True)
+        serial.find_DI_TADs(binsize=10000, step=2500, window=100000, minsize=10000, maxsize=500000, smoothing=3,
+                            joindomains=False)
+        parallel = hic_domains.TAD(self.project, silent=True)
+        parallel.find_DI_TADs(binsize=10000, step=2500, window=100000, minsize=10000, maxsize=500000, smoothing=3,
+                              joindomains=False, processes=2)
+        self.assertTrue(sorted(serial.DIs.keys()) == sorted(parallel.DIs.keys()),
+            "DI chromosomes using multiple processes don't match single process chromosomes")
+        for chrom in serial.DIs:
+            self.assertTrue(numpy.array_equal(serial.DIs[chrom], parallel.DIs[chrom]),
+                "DI scores using multiple processes don't match single process scores for %s" % chrom)
+        self.compare_TADs(serial.TADs, parallel.TADs, 'DI')
+
+    def test_DI_sums(self):
+        rng = numpy.random.RandomState(3)
+        for shape in [(300, 20, 8), (50, 5, 1), (60, 4, 5), (40, 6, 6)]:
+            num_bins, steps = shape[1], shape[2]
+            data = rng.randint(0, 10, (shape[0], num_bins, 2)).astype(numpy.float32)
+            first = num_bins
+            last = shape[0] - num_bins - steps + 1
+            target = numpy.zeros((4, last - first), dtype=numpy.float64)
+            for i in range(first, last):
+                for j in range(steps):
+                    temp = numpy.arange(steps - j - 1, num_bins - j)
+                    target[:2, i - first] += numpy.sum(data[i + j, temp, :], axis=0)
+                    temp = numpy.arange(i + steps - num_bins - 1, i)
+                    target[2:, i - first] += numpy.sum(data[temp, i + j - temp - 1, :], axis=0)
+            sums = hic_domains._find_DI_sums(data, steps, first, last)
+            self.assertTrue(numpy.allclose(sums, target),
+                "DI sums don't match target values for array shape %s" % str(shape))
+
+    def test_DI_scores_blocks(self):
+        for chrom in ['chr1', 'chr2']:
+            target = hic_domains._find_DI_scores(self.project, chrom, 2500, 100000, 4)
+            for blocksize in [20000, 100000, 10000000]:
+                scores = hic_domains._find_DI_scores(self.project, chrom, 2500, 100000, 4, blocksize)
+                self.assertTrue(numpy.array_equal(target[1], scores[1]),
+                    "DI positions using blocks of %i bp don't match whole-chromosome positions" % blocksize)
+                self.assertTrue(numpy.allclose(target[0], scores[0]),
+                    "DI scores using blocks of %i bp don't match whole-chromosome scores" % blocksize)
+        serial = hic_domains.TAD(self.project, silent=True)
+        serial.find_DI_TADs(binsize=10000, step=2500, window=100000, minsize=10000, maxsize=500000, smoothing=3,
+                            joindomains=False)
+        blocks = hic_domains.TAD(self.project, silent=True)
+        blocks.find_DI_TADs(binsize=10000, step=2500, window=100000, minsize=10000, maxsize=500000, smoothing=3,
+                            joindomains=False, processes=2, blocksize=50000)
+        for chrom in serial.DIs:
+            self.assertTrue(numpy.allclose(serial.DIs[chrom]['score'], blocks.DIs[chrom]['score']),
+                "DI scores using blocks and multiple processes don't match single process scores for %s" % chrom)
+        self.compare_TADs(serial.TADs, blocks.TADs, 'DI')
+
+    def test_BI_scores(self):
+        # the dense implementation sliced back past the chromosome start for positions within twice the box width
+        # of it, giving NaN or scores from the wrong partners
+        near_start = {(10000, 'chr1'): [60000, 70000, 80000, 90000],
+                      (10000, 'chr2'): [60000, 70000, 80000, 90000],
+                      (5000, 'chr1'): [35000, 40000, 45000],
+                      (5000, 'chr2'): [35000, 40000, 45000]}
+        for binsize, width, window in [(10000, 50000, 250000), (5000, 20000, 100000)]:
+            boundary = hic_domains.Boundary(self.project, silent=True)
+            boundary.find_BI_scores(binsize, width, window, chroms=['chr1', 'chr2', 'chr3'])
+            self.assertTrue('chr3' not in boundary.scores, "BI scores found for chromosome without valid fends")
+            for chrom in ['chr1', 'chr2']:
+                target = self.find_dense_BI_scores(chrom, binsize, width, window)
+                scores = dict(zip(boundary.scores[chrom]['position'], boundary.scores[chrom]['score']))
+                for position in near_start[(binsize, chrom)]:
+                    self.assertTrue(position not in scores or numpy.isfinite(scores[position]),
+                        "BI score near the start of %s isn't finite at %i" % (chrom, position))
+                    target.pop(position, None)
+                    scores.pop(position, None)
+                positions = sorted(target.keys())
+                self.assertTrue(positions == sorted(scores.keys()),
+                    "BI score positions don't match target values for %s at %i bp" % (chrom, binsize))
+                self.assertTrue(numpy.allclose([scores[x] for x in positions], [target[x] for x in positions],
+                                               atol=1e-6, equal_nan=True),
+                    "BI scores don't match target values for %s at %i bp" % (chrom, binsize))
+
+    def test_compartment_correlations(self):
+        compartment = hic_domains.Compartment(self.project, 10000, chroms=['chr1', 'chr2'],
+                                              out_fname='test/data/test_temp.hdf5', silent=True)
+        rng = numpy.random.RandomState(5)
+        N = 60
+        counts = rng.randint(1, 20, (N, N)).astype(numpy.int32)
+        counts += counts.T
+        expected = rng.uniform(5.0, 20.0, (N, N)).astype(numpy.float32)
+        expected += expected.T
+        valid = (rng.uniform(0.0, 1.0, N) > 0.2).astype(numpy.int32)
+        corrs = compartment._find_correlations(counts, expected, valid, blocksize=7)
+        valid2 = numpy.where(valid)[0]
+        M = valid2.shape[0]
+        data = numpy.ones((M, M), dtype=numpy.float32)
+        indices = numpy.triu_indices(M, 1)
+        data[indices] = counts[valid2, :][:, valid2][indices]
+        data[indices] /= expected[valid2, :][:, valid2][indices]
+        data[indices[1], indices[0]] = data[indices]
+        data = numpy.log(data)
+        data -= numpy.mean(data, axis=1).reshape(-1, 1)
+        data /= numpy.std(data, axis=1).reshape(-1, 1)
+        target = numpy.ones((M, M), dtype=numpy.float32)
+        for i in range(M - 1):
+            for j in range(i + 1, M):
+                target[i, j] = numpy.mean(data[i, :] * data[j, :])
+                target[j, i] = target[i, j]
+        self.assertTrue(numpy.allclose(corrs, target, atol=1e-5),
+            "compartment correlations don't match target values")
+        storage = h5py.File('test/data/test_temp.hdf5', 'r')
+        for chrom in ['chr1', 'chr2']:
+            valid = storage['%s.valid' % chrom][...]
+            M = numpy.sum(valid)
+            corrs = hic_domains._fill_symmetric(storage['%s.correlations' % chrom], M, numpy.float64, blocksize=7)
+            corrs[numpy.arange(M), numpy.arange(M)] = 1.0
+            self.assertTrue(numpy.array_equal(corrs[numpy.triu_indices(M, 1)], storage['%s.correlations' % chrom]),
+                "stored correlations for %s don't match their filled matrix" % chrom)
+            target = numpy.linalg.eigh(corrs)[1][:, -1]
+            eigenv = compartment.eigenv[chrom] * numpy.sign(numpy.dot(compartment.eigenv[chrom], target))
+            self.assertTrue(numpy.allclose(eigenv, target, atol=1e-4),
+                "compartment eigenvector for %s doesn't match target values" % chrom)
+        storage.close()
+
+    def tearDown(self):
+        subprocess.call('rm -f test/data/test_temp.hdf5', shell=True)
+
+    def find_dense_BI_scores(self, chrom, binsize, width, window):
+        widthB = width / binsize
+        windowB = window / binsize
+        hic = self.project
+        chrint = hic.chr2int[chrom]
+        mids = hic.fends['fends']['mid'][...]
+        chr_indices = hic.fends['chr_indices'][...]
+        valid = numpy.where(hic.filter[chr_indices[chrint]:chr_indices[chrint + 1]] > 0)[0]
+        start_fend = chr_indices[chrint] + valid[0]
+        stop_fend = chr_indices[chrint] + valid[-1] + 1
+        start = (mids[start_fend] / binsize) * binsize
+        stop = ((mids[stop_fend - 1] - 1) / binsize + 1) * binsize
+        N = (stop - start) / binsize
+        temp = hic.cis_heatmap(chrom, binsize=binsize, datatype='expected', arraytype='compact',
+                               maxdistance=window, returnmapping=False)[:, :, 1]
+        expected = numpy.zeros((N, N), dtype=numpy.float32)
+        for i in range(N - 1):
+            expected[i, (i + 1):min(N, i + temp.shape[1] + 1)] = temp[i, :min(N - i - 1, temp.shape[1])]
+        expected += expected.T
+        data = hic.data['cis_data'][hic.data['cis_indices'][start_fend]:hic.data['cis_indices'][stop_fend], :]
+        data = data.astype(numpy.int64)
+        data = data[numpy.where(hic.filter[data[:, 0]] * hic.filter[data[:, 1]])[0], :]
+        data[:, :2] = (mids[data[:, :2]] - start) / binsize
+        counts = numpy.bincount(data[:, 0] * N + data[:, 1], weights=data[:, 2],
+                                minlength=(N * N)).reshape(N, N).astype(numpy.int32)
+        counts += counts.T
+        M = N - widthB + 1
+        hm = numpy.zeros((M, M, 2), dtype=numpy.float32)
+        for i in range(widthB):
+            hm[:, :, 0] += counts[i:(M + i), :M]
+            hm[:, :, 1] += expected[i:(M + i), :M]
+        hm2 = numpy.copy(hm)
+        for i in range(1, widthB):
+            hm[:, :(M - i), :] += hm2[:, i:, :]
+            for j in range(widthB):
+                hm[:, (M - i):, 0] += counts[j:(M + j), M:(M + i)]
+                hm[:, (M - i):, 1] += expected[j:(M + j), M:(M + i)]
+        scores = {}
+        old_settings = numpy.seterr(invalid='ignore', divide='ignore')
+        for i in range(widthB, M):
+            if i < windowB:
+                lower = i
+            else:
+                lower = i - windowB
+            if i + windowB > M:
+                upper = i - widthB + 1
+            else:
+                upper = i + windowB - widthB + 1
+            valid = numpy.r_[
+                numpy.where((hm[i - widthB, lower:(i - 2 * widthB + 1), 0] > 0) *
+                            (hm[i, lower:(i - 2 * widthB + 1), 0] > 0))[0] + lower,
+                numpy.where((hm[i - widthB, (i + widthB):upper, 0] > 0) *
+                            (hm[i, (i + widthB):upper, 0] > 0))[0] + i + widthB]
+            if valid.shape[0] > 5:
+                set1 = numpy.log(hm[i - widthB, valid, 0] / hm[i - widthB, valid, 1])
+                set2 = numpy.log(hm[i, valid, 0] / hm[i, valid, 1])
+                scores[i * binsize + start] = numpy.corrcoef(set1, set2)[0, 1]
+        numpy.seterr(**old_settings)
+        return scores
+
+    def compare_TADs(self, TADs1, TADs2, name):
+        self.assertTrue(sorted(TADs1.keys()) == sorted(TADs2.keys()),
+            "%s TAD chromosomes using multiple processes don't match single process chromosomes" % name)
+        for chrom in TADs1:
+            self.assertTrue(numpy.array_equal(numpy.array(TADs1[chrom]), numpy.array(TADs2[chrom])),
+                "%s TADs using multiple processes don't match single process TADs for %s" % (name, chrom))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -43,6 +43,13 @@ class HiCProject(unittest.TestCase):
         project = h5py.File('test/data/test_temp.hcp', 'r')
         self.compare_hdf5_dicts(self.bin_data, project, 'project')
 
+    def test_hic_project_preanalysis_processes(self):
+        subprocess.call("./bin/hifive hic-project -q -m 20000 -f 10 -j 30000 -n 5 --processes 2 %s test/data/test_temp.hcp" %
+                        (self.data_fname), shell=True)
+        project = h5py.File('test/data/test_temp.hcp', 'r')
+        for key in ['filter', 'distance_parameters', 'chromosome_means']:
+            self.compare_arrays(self.data[key][...], project[key][...], key)
+
     def test_hic_project_probability_binomial(self):
         subprocess.call("./bin/hifive hic-normalize probability -q -m 20000 -o test/data/test_temp.hcp -b 15 -l 0.4 -g 0.0015 -p %s" %
                         (self.project_fname), shell=True)
@@ -70,6 +77,52 @@ class HiCProject(unittest.TestCase):
         self.assertTrue(numpy.allclose(self.express.chromosome_means, project.chromosome_means),
             "chromosome means don't match target values")
 
+    def test_hic_project_express_processes(self):
+        subprocess.call("./bin/hifive hic-normalize express -q -m 20000 -o test/data/test_temp.hcp -e 100 -w cis -f 10 --processes 2 %s" %
+                        (self.project_fname), shell=True)
+        project = hic.HiC("test/data/test_temp.hcp", 'r', silent=True)
+        self.assertTrue(numpy.allclose(self.express.corrections, project.corrections),
+            "learned express correction values using multiple processes don't match target values")
+
+    def test_hic_project_express_kr_processes(self):
+        subprocess.call("./bin/hifive hic-normalize express -q -m 20000 -o test/data/test_temp.hcp -e 100 -w cis -f 10 -z %s" %
+                        (self.project_fname), shell=True)
+        subprocess.call("./bin/hifive hic-normalize express -q -m 20000 -o test/data/test_temp2.hcp -e 100 -w cis -f 10 -z --processes 2 %s" %
+                        (self.project_fname), shell=True)
+        project1 = hic.HiC("test/data/test_temp.hcp", 'r', silent=True)
+        project2 = hic.HiC("test/data/test_temp2.hcp", 'r', silent=True)
+        self.assertTrue(numpy.allclose(project1.corrections, project2.corrections),
+            "KR correction values using multiple processes don't match single process values")
+        self.assertTrue(numpy.allclose(project1.chromosome_means, project2.chromosome_means),
+            "KR chromosome means using multiple processes don't match single process values")
+
+    def test_hic_project_probability_processes(self):
+        subprocess.call("./bin/hifive hic-normalize probability -q -m 20000 -o test/data/test_temp.hcp -b 15 -l 0.4 -g 0.0015 -p --processes 2 %s" %
+                        (self.project_fname), shell=True)
+        project = hic.HiC("test/data/test_temp.hcp", 'r', silent=True)
+        self.assertTrue(numpy.allclose(self.probbin.corrections, project.corrections, atol=1e-4),
+            "learned correction values using multiple processes don't match target values")
+        self.assertTrue(numpy.allclose(self.probbin.chromosome_means, project.chromosome_means, atol=1e-4),
+            "chromosome means using multiple processes don't match target values")
+
+    def test_hic_project_probability_threads(self):
+        subprocess.call("./bin/hifive hic-normalize probability -q -m 20000 -o test/data/test_temp.hcp -b 15 -l 0.4 -g 0.0015 -p --threads 2 %s" %
+                        (self.project_fname), shell=True)
+        project = hic.HiC("test/data/test_temp.hcp", 'r', silent=True)
+        self.assertTrue(numpy.allclose(self.probbin.corrections, project.corrections, atol=1e-4),
+            "learned correction values using multiple threads don't match target values")
+
+    def test_hic_project_invalid_threads(self):
+        project = hic.HiC(self.project_fname, 'r', silent=True)
+        corrections = numpy.copy(project.corrections)
+        project.find_probability_fend_corrections(mindistance=20000, threads=0)
+        project.find_express_fend_corrections(mindistance=20000, threads=0)
+        project.find_express_fend_corrections(mindistance=20000, kr=True, threads=0)
+        self.assertTrue(project.history.count("Error: '0' not a valid value for 'threads'") == 3,
+            "normalization didn't reject zero threads")
+        self.assertTrue(numpy.array_equal(corrections, project.corrections),
+            "correction values were changed when normalizing with zero threads")
+
     def test_hic_project_binning(self):
         subprocess.call("./bin/hifive hic-normalize binning -q -m 20000 -o test/data/test_temp.hcp -r 5 -y cis -t 1.0 -v len,distance -s 3,3 -u even,fixed-const %s" %
                         (self.project_fname), shell=True)
@@ -86,8 +139,96 @@ class HiCProject(unittest.TestCase):
         self.assertTrue(numpy.allclose(self.bin_express.chromosome_means, project.chromosome_means),
             "chromosome means don't match target values")
 
+    def test_hic_project_lazy_load(self):
+        project = hic.HiC(self.binning_fname, 'r', silent=True, lazy=True)
+        for key in self.binning.__dict__.keys():
+            if isinstance(self.binning[key], numpy.ndarray):
+                self.compare_arrays(self.binning[key], project[key], key)
+        project.filter.fill(0)
+        project.save('test/data/test_temp.hcp')
+        self.assertTrue(numpy.sum(hic.HiC(self.binning_fname, 'r', silent=True).filter) > 0,
+            "lazily-loaded array changes were written to the original project file")
+        self.assertTrue(numpy.sum(hic.HiC("test/data/test_temp.hcp", 'r', silent=True).filter) == 0,
+            "lazily-loaded array changes were not saved")
+
+    def test_hic_project_distance_table(self):
+        parameters = self.probbin.distance_parameters.astype(numpy.float64)
+        table = self.probbin._find_distance_table()
+        self.assertTrue(table is self.probbin._find_distance_table(), "distance table wasn't cached")
+        steps = hic._binning.DISTANCE_TABLE_STEPS
+        indices = numpy.arange(0, table.shape[0], 97)
+        distances = 2.0 ** (indices / steps) * (1.0 + (indices % steps) / float(steps))
+        segments = numpy.searchsorted(parameters[:, 0], numpy.log(distances))
+        target = numpy.exp(numpy.log(distances) * parameters[segments, 1] + parameters[segments, 2])
+        self.compare_arrays(table[indices, 0], target, 'distance table')
+        table = self.bin_express._find_distance_table(self.bin_express.binned)
+        distances = numpy.maximum(1, numpy.arange(table.shape[0]) * self.bin_express.binned)
+        parameters = self.bin_express.distance_parameters.astype(numpy.float64)
+        segments = numpy.searchsorted(parameters[:, 0], numpy.log(distances))
+        target = numpy.exp(numpy.log(distances) * parameters[segments, 1] + parameters[segments, 2])
+        self.compare_arrays(table, target, 'binned distance table')
+
+    def test_hic_project_export_cooler(self):
+        subprocess.call("./bin/hifive hic-cooler -q -b 1000 --block-size 500 %s test/data/test_temp.cool" %
+                        self.probbin_fname, shell=True)
+        cooler = h5py.File('test/data/test_temp.cool', 'r')
+        maxzoom = cooler.attrs['max-zoom']
+        self.assertTrue(cooler.attrs[str(maxzoom)] == 1000 and maxzoom >= 3, "finest zoom level bin size doesn't match")
+        self.probbin.silent = True
+        self.probbin.export_cooler('test/data/test_temp2.cool', binsize=4000, zoomify=False)
+        direct = h5py.File('test/data/test_temp2.cool', 'r')
+        for key in ['bins/start', 'bins/end', 'pixels/bin1_id', 'pixels/bin2_id', 'pixels/count',
+                    'indexes/chrom_offset', 'indexes/bin1_offset']:
+            self.compare_arrays(direct[key][...], cooler['%i/%s' % (maxzoom - 2, key)][...], key)
+        weights = cooler['%i/bins/weight' % (maxzoom - 2)][...]
+        self.assertTrue(numpy.array_equal(numpy.isnan(direct['bins/weight'][...]), numpy.isnan(weights)),
+            "zoomed cooler weights don't match direct export")
+        self.compare_arrays(numpy.nan_to_num(direct['bins/weight'][...]), numpy.nan_to_num(weights), 'bins/weight')
+        fends = self.probbin.fends['fends'][...]
+        chr_indices = self.probbin.fends['chr_indices'][...]
+        offsets = direct['indexes/chrom_offset'][...]
+        mapping = numpy.zeros(fends.shape[0], dtype=numpy.int64) - 1
+        for i in range(chr_indices.shape[0] - 1):
+            mapping[chr_indices[i]:chr_indices[i + 1]] = fends['mid'][chr_indices[i]:chr_indices[i + 1]] / 4000 + offsets[i]
+        mapping[numpy.where(self.probbin.filter == 0)[0]] = -1
+        data = numpy.r_[self.probbin.data['cis_data'][...], self.probbin.data['trans_data'][...]]
+        data = data[numpy.where((mapping[data[:, 0]] >= 0) & (mapping[data[:, 1]] >= 0))[0], :]
+        num_bins = offsets[-1]
+        counts = numpy.bincount(mapping[data[:, 0]] * num_bins + mapping[data[:, 1]], weights=data[:, 2],
+                                minlength=num_bins * num_bins)
+        where = numpy.where(counts > 0)[0]
+        self.compare_arrays(where / num_bins, direct['pixels/bin1_id'][...], 'cooler bin1 ids')
+        self.compare_arrays(where % num_bins, direct['pixels/bin2_id'][...], 'cooler bin2 ids')
+        self.compare_arrays(counts[where].astype(numpy.int32), direct['pixels/count'][...], 'cooler counts')
+        cooler.close()
+        direct.close()
+
+    def test_hic_project_quality_processes(self):
+        self.probbin.silent = True
+        self.probbin.calculate_quality('test/data/test_temp.txt', resolution=50000, coverage=[1.0, 0.5],
+                                       noise=[0.0], chroms=['chr1', 'chr2'])
+        project = hic.HiC(self.probbin_fname, 'r', silent=True, processes=2)
+        project.calculate_quality('test/data/test_temp2.txt', resolution=50000, coverage=[1.0, 0.5],
+                                  noise=[0.0], chroms=['chr1', 'chr2'])
+        lines1 = open('test/data/test_temp.txt').readlines()
+        lines2 = open('test/data/test_temp2.txt').readlines()
+        self.assertTrue(len(lines1) == len(lines2), "quality files from multiple processes have different lengths")
+        # full coverage without noise involves no sampling, so those scores must match exactly
+        self.assertTrue(lines1[-2] == lines2[-2], "full coverage quality scores from multiple processes don't match")
+
+    def test_hic_project_process_data_slices(self):
+        project = _SliceCheckingHiC(self.probbin_fname, 'r', silent=True, processes=3)
+        expected = {}
+        for datatype in ['cis', 'trans']:
+            expected[datatype] = (project.data['%s_indices' % datatype][...], project.data['%s_data' % datatype][...])
+        project._run_local_processes('check_data_slices', expected=expected)
+        self.assertTrue(len(project.slice_mismatches) == 3, "not every rank reported the data slices it read")
+        for rank, mismatches in enumerate(project.slice_mismatches):
+            self.assertTrue(mismatches == 0, "data slices read by rank %i don't match the project's data" % rank)
+
     def tearDown(self):
-        subprocess.call('rm -f test/data/test_temp.hcp', shell=True)
+        subprocess.call('rm -f test/data/test_temp.hcp test/data/test_temp2.hcp test/data/test_temp.cool test/data/test_temp2.cool ' +
+                        'test/data/test_temp.txt test/data/test_temp2.txt', shell=True)
 
     def compare_arrays(self, array1, array2, name):
         self.assertTrue(array1.shape == array2.shape,
@@ -127,5 +268,29 @@ class HiCProject(unittest.TestCase):
         return None
 
 
+class _SliceCheckingHiC(hic.HiC):
+    def check_data_slices(self, expected):
+        # every rank reads every slice several times, so reads from different processes overlap
+        mismatches = 0
+        for i in range(20):
+            for datatype in ['cis', 'trans']:
+                all_indices, all_data = expected[datatype]
+                num_fends = all_indices.shape[0] - 1
+                for start in range((i + self.rank) % 7, num_fends, 7):
+                    stop = min(start + 7, num_fends)
+                    self.cache.clear()
+                    indices, data = self._find_data_slice(datatype, start, stop)
+                    if (not numpy.array_equal(indices, all_indices[start:(stop + 1)]) or
+                            not numpy.array_equal(data, all_data[all_indices[start]:all_indices[stop], :])):
+                        mismatches += 1
+        if self.rank == 0:
+            self.slice_mismatches = [mismatches]
+            for i in range(1, self.num_procs):
+                self.slice_mismatches.append(self.comm.recv(source=i))
+        else:
+            self.comm.send(mismatches, dest=0)
+        return None
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import subprocess
+import unittest
+
+import numpy
+
+from hifive import hic, mrh
+
+
+class MRHReader(unittest.TestCase):
+    def setUp(self):
+        self.project = hic.HiC('test/data/test_probbin.hcp', 'r', silent=True)
+        self.project.write_multiresolution_heatmap('test/data/test_temp.mrh', datatype='fend', maxbinsize=320000,
+                                                   minbinsize=5000, minobservations=1, includetrans=True)
+        self.heatmap = mrh.MRH('test/data/test_temp.mrh')
+
+    def test_mrh_header(self):
+        self.assertTrue(self.heatmap.chromosomes == list(self.project.fends['chromosomes'][...]),
+            "chromosome names don't match project")
+        header = self.heatmap.get_header('chr1', 'chr2')
+        self.assertTrue(header['lres'] == 320000 and header['hres'] == 5000,
+            "resolution limits don't match target values")
+        self.assertTrue((header['stop1'] - header['start1']) % 320000 == 0,
+            "heatmap bounds aren't a multiple of the largest bin size")
+
+    def test_mrh_lowest_resolution_tile(self):
+        tile = self.heatmap.get_tile('chr1', binsize=320000, minresolution=320000)
+        data = self.heatmap._find_pairing('chr1', None)[0]['data']
+        n = tile.shape[0]
+        upper = numpy.triu_indices(n)
+        self.assertTrue(numpy.allclose(numpy.nan_to_num(tile[upper]), numpy.nan_to_num(data[:upper[0].shape[0]])),
+            "lowest resolution tile doesn't match stored data")
+        self.assertTrue(numpy.array_equal(numpy.isnan(tile), numpy.isnan(tile.T)),
+            "intra-chromosomal tile isn't symmetric")
+
+    def test_mrh_windowed_tiles(self):
+        header = self.heatmap.get_header('chr1')
+        full = self.heatmap.get_tile('chr1', binsize=5000)
+        start1 = header['start1'] + 40 * 5000
+        start2 = header['start1'] + 70 * 5000
+        window = self.heatmap.get_tile('chr1', start1, start1 + 30 * 5000, 'chr1', start2, start2 + 20 * 5000,
+                                       binsize=5000)
+        target = full[40:70, 70:90]
+        self.assertTrue(numpy.array_equal(numpy.isnan(target), numpy.isnan(window)) and
+                        numpy.allclose(numpy.nan_to_num(target), numpy.nan_to_num(window)),
+            "windowed tile doesn't match full tile")
+        trans = self.heatmap.get_tile('chr1', chrom2='chr2', binsize=10000)
+        transposed = self.heatmap.get_tile('chr2', chrom2='chr1', binsize=10000)
+        self.assertTrue(numpy.array_equal(numpy.isnan(trans), numpy.isnan(transposed.T)) and
+                        numpy.allclose(numpy.nan_to_num(trans), numpy.nan_to_num(transposed.T)),
+            "transposed trans tile doesn't match")
+        x, y, sizes, values = self.heatmap.get_squares('chr1', start1, start1 + 30 * 5000, 'chr1', start2,
+                                                       start2 + 20 * 5000)
+        self.assertTrue(numpy.all(x < start1 + 30 * 5000) and numpy.all(x + sizes > start1) and
+                        numpy.all(y < start2 + 20 * 5000) and numpy.all(y + sizes > start2),
+            "returned bins fall outside of query window")
+
+    def test_mrh_processes(self):
+        subprocess.call("./bin/hifive hic-mrheatmap -q -t -f 1 -B 320000 -b 5000 -d fend --processes 3 %s test/data/test_temp2.mrh" %
+                        self.project.file, shell=True)
+        self.assertTrue(open('test/data/test_temp.mrh', 'rb').read() == open('test/data/test_temp2.mrh', 'rb').read(),
+            "multi-resolution heatmap written with multiple processes doesn't match")
+        self.assertTrue(len([fname for fname in os.listdir('test/data') if fname.count('.part') > 0]) == 0,
+            "temporary part files weren't removed")
+
+    def tearDown(self):
+        subprocess.call('rm -f test/data/test_temp.mrh test/data/test_temp2.mrh', shell=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
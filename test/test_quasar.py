@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import subprocess
+import unittest
+
+import numpy
+
+from hifive import hic, quasar
+import h5py
+
+
+class QuasarDownsampling(unittest.TestCase):
+    def setUp(self):
+        self.quasar = quasar.Quasar('test/data/test_temp.quasar', 'w', silent=True)
+        rng = numpy.random.RandomState(7)
+        self.data = numpy.zeros((300, 3), dtype=numpy.int64)
+        self.data[:, 0] = numpy.arange(300) / 20
+        self.data[:, 1] = numpy.arange(300) % 20
+        self.data[:, 2] = rng.randint(1, 50, 300)
+        self.indices = numpy.array([0, 100, 180, 300], dtype=numpy.int64)
+
+    def test_downsample_exact(self):
+        rng = numpy.random.RandomState(1)
+        data, indices = self.data, self.indices
+        for target in [5000, 1000, 10]:
+            previous = data
+            data, indices = self.quasar._downsample(data, indices, target, rng)
+            self.assertTrue(numpy.sum(data[:, 2]) == target, "downsampled read count doesn't match target")
+            self.assertTrue(numpy.all(data[:, 2] > 0), "empty rows were kept")
+            positions = numpy.searchsorted(previous[:, 0] * 20 + previous[:, 1], data[:, 0] * 20 + data[:, 1])
+            self.assertTrue(numpy.all(data[:, 2] <= previous[positions, 2]),
+                "downsampled counts exceed the counts they were drawn from")
+            for i in range(indices.shape[0] - 1):
+                chrom = numpy.where((data[:, 0] >= self.indices[i] / 20) & (data[:, 0] < self.indices[i + 1] / 20))[0]
+                self.assertTrue(indices[i + 1] - indices[i] == chrom.shape[0], "chromosome indices don't match")
+
+    def test_downsample_distribution(self):
+        rng = numpy.random.RandomState(2)
+        counts = self.data[:, 2]
+        total = numpy.zeros(counts.shape[0], dtype=numpy.float64)
+        for i in range(2000):
+            total += quasar._downsample_counts(counts, 1000, rng)
+        expected = counts * 1000.0 / numpy.sum(counts)
+        self.assertTrue(numpy.allclose(total / 2000.0, expected, atol=0.25),
+            "downsampled reads aren't drawn uniformly")
+
+    def tearDown(self):
+        self.quasar.close()
+        subprocess.call('rm -f test/data/test_temp.quasar', shell=True)
+
+
+class QuasarTransformation(unittest.TestCase):
+    def setUp(self):
+        self.project = hic.HiC('test/data/test_probbin.hcp', 'r', silent=True)
+        self.quasar = quasar.Quasar('test/data/test_temp.quasar', 'w', silent=True)
+        self.quasar.find_transformation(self.project, resolutions=[100000, 50000], coverages=[0, 4000], seed=1)
+
+    def test_transformation_processes(self):
+        subprocess.call("./bin/hifive quasar -q -p %s -r 100000,50000 -d 0,4000 --seed 1 --processes 2 %s" %
+                        (self.project.file, 'test/data/test_temp2.quasar'), shell=True)
+        self.compare_quasar_files('test/data/test_temp2.quasar', 'transformation using multiple processes')
+        # resume from a partially-complete file
+        storage = h5py.File('test/data/test_temp2.quasar', 'a')
+        for key in storage.keys():
+            if key.count('chr1.4000C') > 0:
+                del storage[key]
+        storage.close()
+        partial = quasar.Quasar('test/data/test_temp2.quasar', 'a', silent=True)
+        partial.find_transformation(self.project, resolutions=[100000, 50000], coverages=[0, 4000], seed=1,
+                                    processes=2)
+        partial.close()
+        self.compare_quasar_files('test/data/test_temp2.quasar', 'resumed transformation')
+
+    def compare_quasar_files(self, fname, name):
+        storage = h5py.File(fname, 'r')
+        self.assertTrue(sorted(storage.keys()) == sorted(self.quasar.storage.keys()),
+            "%s datasets don't match" % name)
+        for key in self.quasar.storage.keys():
+            self.assertTrue(numpy.array_equal(numpy.nan_to_num(self.quasar.storage[key][...]),
+                                              numpy.nan_to_num(storage[key][...])),
+                "%s %s doesn't match" % (name, key))
+        storage.close()
+
+    def tearDown(self):
+        self.quasar.close()
+        subprocess.call('rm -f test/data/test_temp.quasar test/data/test_temp2.quasar', shell=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
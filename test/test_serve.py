@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import subprocess
+import unittest
+import threading
+import urllib2
+import json
+from cStringIO import StringIO
+
+import numpy
+
+from hifive import hic, mrh
+from hifive.hic_binning import find_cis_subregion_signal
+from hifive.commands.serve_heatmaps import create_server
+
+
+class HeatmapServer(unittest.TestCase):
+    def setUp(self):
+        self.project = hic.HiC('test/data/test_probbin.hcp', 'r', silent=True)
+        self.project.write_multiresolution_heatmap('test/data/test_temp.mrh', datatype='fend', maxbinsize=320000,
+                                                   minbinsize=5000, minobservations=1, includetrans=True)
+        self.server = create_server(['test/data/test_temp.mrh', 'test/data/test_probbin.hcp'], port=0, silent=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+
+    def test_mrh_tiles(self):
+        tile = mrh.MRH('test/data/test_temp.mrh').get_tile('chr1', binsize=10000)
+        results = []
+
+        def fetch():
+            results.append(json.loads(urllib2.urlopen(self.url + 'test_temp.mrh?chrom1=chr1&binsize=10000').read()))
+
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(results) == 4, "concurrent requests failed")
+        for result in results:
+            scores = numpy.array([[numpy.nan if value is None else value for value in row]
+                                  for row in result['scores']])
+            self.assertTrue(numpy.array_equal(numpy.isnan(scores), numpy.isnan(tile)) and
+                            numpy.allclose(numpy.nan_to_num(scores), numpy.nan_to_num(tile)),
+                "served tile doesn't match MRH tile")
+        response = urllib2.urlopen(self.url + 'test_temp.mrh?chrom1=chr1&binsize=10000')
+        self.assertTrue(response.info()['X-Cache'] == 'hit', "repeated request wasn't served from cache")
+
+    def test_project_matrix(self):
+        response = urllib2.urlopen(self.url + 'test_probbin.hcp?chrom1=chr1&start1=50000&stop1=200000&'
+                                   'start2=100000&stop2=300000&binsize=25000&format=npy')
+        scores = numpy.load(StringIO(response.read()))
+        data = find_cis_subregion_signal(self.project, 'chr1', binsize=25000, start1=50000, stop1=200000,
+                                         start2=100000, stop2=300000, datatype='fend', silent=True)
+        valid = numpy.where((data[:, :, 0] > 0) & (data[:, :, 1] > 0))
+        target = numpy.empty(data.shape[:2], dtype=numpy.float32)
+        target.fill(numpy.nan)
+        target[valid] = numpy.log2(data[valid[0], valid[1], 0] / data[valid[0], valid[1], 1])
+        self.assertTrue(numpy.array_equal(numpy.isnan(scores), numpy.isnan(target)) and
+                        numpy.allclose(numpy.nan_to_num(scores), numpy.nan_to_num(target)),
+            "served matrix doesn't match binned project data")
+        try:
+            urllib2.urlopen(self.url + 'test_probbin.hcp?chrom1=chrX')
+            status = 200
+        except urllib2.HTTPError, error:
+            status = error.code
+        self.assertTrue(status == 404, "request for a missing chromosome didn't fail")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        subprocess.call('rm -f test/data/test_temp.mrh', shell=True)
+
+
+if __name__ == "__main__":
+    unittest.main()